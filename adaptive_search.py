@@ -0,0 +1,66 @@
+"""
+This script decides how much engine search each position gets when annotating in adaptive mode.
+Every position is first searched at a shallow depth; the full depth is only spent where the expected score
+(and hence GPL) is sensitive to the evaluation, and never once the per-game node or time budget is used up.
+"""
+
+import threading
+
+from wdl_model import expectation_table
+
+
+# Expected score (1, 0.5, 0 scoring) of a centipawn evaluation from the side to move's point of view,
+# from the precomputed WDL table (same counts as Cp(cp).wdl())
+def expectation(cp):
+    wins, draws, losses = expectation_table().wdl(cp)
+    return (wins + 0.5 * draws) / 1000
+
+
+class AdaptiveSearch:
+    def __init__(self, shallow_depth=8, decided_cp=1000, swing_cp=50, tolerance=0.02,
+                 nodes_per_game=None, seconds_per_game=None, skip_forced=True):
+        # shallow_depth: depth of the first, cheap pass over every position
+        # decided_cp: positions at or beyond this evaluation (incl. mate scores) keep the shallow result
+        # swing_cp, tolerance: a position is searched deeper only if moving its evaluation by +-swing_cp
+        #     changes the expected score by at least tolerance
+        # nodes_per_game, seconds_per_game: once a game has used this budget, its remaining positions stay shallow
+        # skip_forced: positions where the side to move has a single legal move take the value of the next position
+        self.shallow_depth = shallow_depth
+        self.decided_cp = decided_cp
+        self.swing_cp = swing_cp
+        self.tolerance = tolerance
+        self.nodes_per_game = nodes_per_game
+        self.seconds_per_game = seconds_per_game
+        self.skip_forced = skip_forced
+        self.counts = {"positions": 0, "shallow": 0, "deep": 0, "forced": 0, "budget_limited": 0, "nodes": 0}
+        self._lock = threading.Lock()
+
+    def settings(self):
+        # The parameters that affect the evaluations, e.g. to tell whether earlier annotations are still current
+        return {"shallow_depth": self.shallow_depth, "decided_cp": self.decided_cp, "swing_cp": self.swing_cp,
+                "tolerance": self.tolerance, "nodes_per_game": self.nodes_per_game,
+                "seconds_per_game": self.seconds_per_game, "skip_forced": self.skip_forced}
+
+    def needs_deep_search(self, cp):
+        if abs(cp) >= self.decided_cp:
+            return False
+        swing = abs(expectation(cp + self.swing_cp) - expectation(cp - self.swing_cp))
+        return swing >= self.tolerance
+
+    def budget_exhausted(self, nodes, seconds):
+        if self.nodes_per_game is not None and nodes >= self.nodes_per_game:
+            return True
+        return self.seconds_per_game is not None and seconds >= self.seconds_per_game
+
+    def record(self, **counts):
+        with self._lock:
+            for name, count in counts.items():
+                self.counts[name] += count
+
+    def report(self):
+        positions = self.counts["positions"] or 1
+        return (f"Adaptive search: {self.counts['positions']} positions, "
+                f"{100 * self.counts['deep'] / positions:.1f}% searched at full depth, "
+                f"{100 * self.counts['shallow'] / positions:.1f}% shallow only, "
+                f"{100 * self.counts['forced'] / positions:.1f}% forced, "
+                f"{self.counts['budget_limited']} limited by the game budget, {self.counts['nodes']} nodes")
@@ -0,0 +1,265 @@
+"""
+This script annotates PGN files with engine evaluations like stockfish_pgn_annotator.py, but drives the engines with
+asyncio (chess.engine.popen_uci coroutines) from one event loop instead of a thread per engine around SimpleEngine.
+Every engine has a worker that takes the next job from a shared, bounded queue as soon as it is done with the last
+one, so no engine waits on Python-side bookkeeping, and the annotated games are written back in their original order
+while the engines keep working.
+
+Jobs are whole games (schedule='games', the default: the positions of a game go to one engine in order, after a
+ucinewgame, as in main_stockfish, so the output is the same) or single positions (schedule='positions': the positions
+of all games in flight are spread over all engines, which keeps them busy when there are fewer games than engines or
+a few very long ones; with a real engine the scores can differ slightly, since the hash holds other games' positions).
+
+Backpressure: at most max_in_flight games are read ahead of the writer, and the job queue holds at most two jobs per
+engine. A position_timeout (seconds) stops a search that takes longer and keeps the deepest score it reached (such
+scores are not cached). If the run is cancelled or fails, the games written so far are complete and checkpointed,
+like main_stockfish's, and resume=True continues from there; games that were still being analyzed are dropped.
+"""
+
+import asyncio
+import functools
+import time
+
+import chess
+import chess.engine
+
+import metrics
+from eval_cache import EvalCache
+from stockfish_pgn_annotator import _white_evaluation, add_scores_to_game, annotation_inputs, iter_files_to_annotate
+
+
+class AsyncEngine:
+    # One engine process, restarted when it dies
+    def __init__(self, engine_path, engine_options=None):
+        self.engine_path = engine_path
+        self.engine_options = dict(engine_options or {})
+        self.protocol = None
+        self._transport = None
+
+    async def start(self):
+        self._transport, self.protocol = await chess.engine.popen_uci(self.engine_path)
+        if self.engine_options:
+            await self.protocol.configure(self.engine_options)
+
+    async def restart(self):
+        self.close()
+        await self.start()
+
+    async def quit(self):
+        try:
+            await asyncio.wait_for(self.protocol.quit(), 5)
+        except Exception:
+            self.close()
+
+    def close(self):
+        if self._transport is not None:
+            self._transport.close()
+
+
+class PositionTimeouts:
+    def __init__(self):
+        self.count = 0
+
+
+async def analyse_cp(engine, board, depth, game=None, eval_cache=None, timeout=None, timeouts=None):
+    # Score of the position in centipawns relative to the side to move (None if the engine gave none), as
+    # stockfish_pgn_annotator._analyse_cp; after timeout seconds the search is stopped and its last score is used
+    if eval_cache is not None:
+        cp = eval_cache.get(board, depth)
+        if cp is not None:
+            return cp
+    start = time.perf_counter()
+    timed_out = False
+    with await engine.analysis(board, chess.engine.Limit(depth=depth), game=game) as analysis:
+        # Shielded, so that a timeout or a cancellation does not cancel the analysis itself, which is stopped instead
+        # (by the with block) and runs to its bestmove, leaving the engine ready for the next command
+        finished = asyncio.ensure_future(analysis.wait())
+        try:
+            await asyncio.wait_for(asyncio.shield(finished), timeout)
+        except asyncio.TimeoutError:
+            timed_out = True
+            analysis.stop()
+            await finished
+        info = analysis.info
+    metrics.add("annotate.engine", time.perf_counter() - start, positions=1, nodes=info.get("nodes", 0))
+    if timed_out:
+        metrics.count("annotate.engine", timeouts=1)
+        if timeouts is not None:
+            timeouts.count += 1
+    score = info.get("score", None)
+    if score is None:
+        return None
+    cp = score.relative.score(mate_score=10000)
+    if eval_cache is not None and not timed_out:
+        eval_cache.put(board, depth, cp)
+    return cp
+
+
+async def _analyze_game(engine, game, depth, eval_cache, timeout, timeouts):
+    # Same scores as stockfish_pgn_annotator._analyze_positions
+    scores = []
+    board = game.board()
+    for move in game.mainline_moves():
+        board.push(move)
+        cp = await analyse_cp(engine, board, depth, game, eval_cache, timeout, timeouts)
+        if cp is not None:
+            scores.append(_white_evaluation(cp, board))
+    return scores
+
+
+async def _analyze_position(engine, board, depth, eval_cache, timeout, timeouts):
+    # No game object, so that the engine does not get a ucinewgame (and lose its hash) between positions
+    cp = await analyse_cp(engine, board, depth, None, eval_cache, timeout, timeouts)
+    return _white_evaluation(cp, board) if cp is not None else None
+
+
+async def _gather_scores(position_futures):
+    evaluations = await asyncio.gather(*position_futures)
+    return [evaluation for evaluation in evaluations if evaluation is not None]
+
+
+async def _engine_worker(engine, jobs, max_restarts):
+    # Run jobs (coroutine function of the engine, future for its result) until a None job. If the engine dies, it is
+    # restarted and the job is run again from scratch.
+    while True:
+        job = await jobs.get()
+        if job is None:
+            return
+        run, future = job
+        for attempt in range(max_restarts + 1):
+            if future.cancelled():
+                break
+            try:
+                result = await run(engine.protocol)
+            except chess.engine.EngineTerminatedError as exc:
+                print(f"Engine terminated ({exc}), restarting")
+                await engine.restart()
+                if attempt == max_restarts:
+                    future.set_exception(exc)
+                continue
+            except Exception as exc:
+                if not future.cancelled():
+                    future.set_exception(exc)
+                break
+            if not future.cancelled():
+                future.set_result(result)
+            break
+
+
+async def _read_games(files, jobs, in_order, writers, depth, eval_cache, schedule, timeout, timeouts):
+    # Queue the games of every file for the engines, and in their original order for the writer
+    loop = asyncio.get_running_loop()
+    options = {"depth": depth, "eval_cache": eval_cache, "timeout": timeout, "timeouts": timeouts}
+    for writer, games in files:
+        writers.append(writer)
+        for game, offset in games:
+            if schedule == "positions":
+                position_futures = []
+                board = game.board()
+                for move in game.mainline_moves():
+                    board.push(move)
+                    position_futures.append(loop.create_future())
+                    await jobs.put((functools.partial(_analyze_position, board=board.copy(), **options),
+                                    position_futures[-1]))
+                future = asyncio.ensure_future(_gather_scores(position_futures))
+                await in_order.put((writer, game, offset, future))
+            else:
+                future = loop.create_future()
+                # Queued for the writer first, so that the writer is never more than max_in_flight games behind
+                await in_order.put((writer, game, offset, future))
+                await jobs.put((functools.partial(_analyze_game, game=game, **options), future))
+        # Marks the end of the file: the writer is finalized once all of its games are written
+        await in_order.put((writer, None, None, None))
+    await in_order.put(None)
+
+
+async def _write_games(in_order, manifest):
+    while True:
+        item = await in_order.get()
+        if item is None:
+            return
+        writer, game, offset, future = item
+        if game is None:
+            writer.close()
+            if manifest is not None:
+                manifest.record(writer.file_path, [writer.output_path])
+            continue
+        scores = await future
+        add_scores_to_game(game, scores)
+        start = time.perf_counter()
+        # Written (and fsynced) in a thread, while the loop keeps the engines busy
+        await asyncio.to_thread(writer.write, game, offset)
+        metrics.add("annotate.write", time.perf_counter() - start, games=1)
+        metrics.count("annotate", games=1, plies=len(scores))
+
+
+async def annotate_games_async(file_paths, engine_path, depth, output_directory, input_dir_path, engines=1,
+                               engine_options=None, eval_cache=None, resume=False, manifest=None, force=False,
+                               selection=None, schedule="games", max_in_flight=None, position_timeout=None,
+                               max_restarts=2):
+    # The asyncio counterpart of stockfish_pgn_annotator.annotate_games, with engines engine processes
+    if schedule not in ("games", "positions"):
+        raise ValueError(f"Unknown schedule {schedule!r}: 'games' or 'positions'")
+    max_in_flight = max_in_flight or 4 * engines
+    jobs = asyncio.Queue(maxsize=2 * engines)
+    in_order = asyncio.Queue(maxsize=max_in_flight)
+    timeouts = PositionTimeouts()
+    writers = []
+    pool = [AsyncEngine(engine_path, engine_options) for _ in range(engines)]
+    tasks = []
+    try:
+        await asyncio.gather(*(engine.start() for engine in pool))
+        workers = [asyncio.ensure_future(_engine_worker(engine, jobs, max_restarts)) for engine in pool]
+        tasks += workers
+        files = iter_files_to_annotate(file_paths, output_directory, input_dir_path, resume, manifest, force, selection)
+        reader = asyncio.ensure_future(_read_games(files, jobs, in_order, writers, depth, eval_cache, schedule,
+                                                   position_timeout, timeouts))
+        writer_task = asyncio.ensure_future(_write_games(in_order, manifest))
+        tasks += [reader, writer_task]
+        # The writer finishes last; an error in any task ends the run
+        pending = set(tasks)
+        while not writer_task.done():
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    raise task.exception()
+        for _ in workers:
+            await jobs.put(None)
+        await asyncio.gather(*workers)
+    except BaseException:
+        # Leave the temporary outputs and checkpoints in place so the run can be resumed
+        for writer in writers:
+            writer.abort()
+        raise
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.gather(*(engine.quit() for engine in pool if engine.protocol is not None), return_exceptions=True)
+    if timeouts.count:
+        print(f"Searches stopped after {position_timeout} s: {timeouts.count}")
+    return timeouts.count
+
+
+@metrics.timed("annotate")
+def main_stockfish_async(input_dir_path, output_directory, stockfish_path, DEPTH, engines=1, engine_options=None,
+                         cache_path=None, cache_size=1_000_000, resume=False, force=False, query=None, index_path=None,
+                         schedule="games", max_in_flight=None, position_timeout=None):
+    # Same inputs and outputs as main_stockfish (without adaptive search), with engines engine processes; see the
+    # module docstring for schedule, max_in_flight and position_timeout
+    eval_cache = EvalCache(cache_path, cache_size) if cache_path else None
+    file_paths, selection, manifest = annotation_inputs(
+        input_dir_path, output_directory, query, index_path, engine=stockfish_path, engine_options=engine_options or {},
+        depth=DEPTH, adaptive=None)
+    try:
+        asyncio.run(annotate_games_async(file_paths, stockfish_path, DEPTH, output_directory, input_dir_path, engines,
+                                         engine_options, eval_cache, resume, manifest, force, selection, schedule,
+                                         max_in_flight, position_timeout))
+        metrics.set_values("engine_pool", size=engines, schedule=schedule)
+    finally:
+        if eval_cache is not None:
+            stats = eval_cache.stats()
+            eval_cache.close()
+            metrics.set_values("eval_cache", **stats)
+            print(f"Evaluation cache: {stats['hits']} hits, {stats['misses']} misses "
+                  f"({100 * stats['hit_rate']:.1f}% hit rate), {stats['entries']} entries, {stats['evictions']} evicted")
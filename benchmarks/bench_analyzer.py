@@ -0,0 +1,160 @@
+"""
+Benchmarks for the GI/GPL analyzer.
+
+Compares the per-ply Python gi_and_gpl/calculate_acpl with the vectorized and batched NumPy versions,
+and checks that all of them give identical results:
+    python benchmarks/bench_analyzer.py gi --games 100000
+Compares reading headers and evaluations with python-chess and with the lightweight scanner:
+    python benchmarks/bench_analyzer.py scan <pgn_file>
+Compares the memory taken by the analyzed games of a PGN directory (as the analyzer keeps them until a file ends) as
+one dict per game with the parser's header strings, as the analyzer kept them before, and as GameRecords:
+    python benchmarks/bench_analyzer.py records <pgn_dir> --games 100000
+"""
+
+import argparse
+import gc
+import itertools
+import multiprocessing
+import os
+import pickle
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pgn_evaluation_fast_analyzer import (analyze_game, calculate_acpl, calculate_acpl_vectorized, gi_and_gpl,
+                                          gi_and_gpl_batch, gi_and_gpl_vectorized, iter_game_evals, iter_pgn_files)
+from pgn_scanner import validate_scanner
+
+RESULTS = ["1-0", "0-1", "1/2-1/2", "*"]
+
+
+def random_eval_games(games, seed=0):
+    # Random-walk evaluations (in pawns, two decimals as in [%eval] comments) with occasional mate scores
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(games):
+        evaluation = round(rng.gauss(0.2, 0.3), 2)
+        pawns_list = []
+        for _ in range(rng.randint(20, 160)):
+            evaluation = round(evaluation + rng.gauss(0, 0.4), 2)
+            pawns_list.append(evaluation if rng.random() > 0.005 else rng.choice([99.97, -99.98]))
+        pawns_list.insert(0, pawns_list[0])
+        corpus.append((pawns_list, rng.choice(RESULTS), rng.randint(1800, 2850), rng.randint(1800, 2850)))
+    return corpus
+
+
+def bench_gi(games, wdl_values=(1, 0.5, 0), weighted=True):
+    corpus = random_eval_games(games)
+    plies = sum(len(pawns_list) - 1 for pawns_list, _, _, _ in corpus)
+    print(f"{games} games, {plies} plies")
+
+    start = time.perf_counter()
+    scalar = [(gi_and_gpl(p, result, white_elo, black_elo, wdl_values, weighted), calculate_acpl(p))
+              for p, result, white_elo, black_elo in corpus]
+    scalar_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    vectorized = [(gi_and_gpl_vectorized(p, result, white_elo, black_elo, wdl_values, weighted), calculate_acpl_vectorized(p))
+                  for p, result, white_elo, black_elo in corpus]
+    vectorized_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    pawns_lists, results, white_elos, black_elos = zip(*corpus)
+    batch = list(zip(gi_and_gpl_batch(pawns_lists, results, white_elos, black_elos, wdl_values, weighted),
+                     [calculate_acpl_vectorized(p) for p in pawns_lists]))
+    batch_seconds = time.perf_counter() - start
+
+    for name, seconds, values in [("per-ply Python", scalar_seconds, scalar), ("vectorized per game", vectorized_seconds, vectorized),
+                                  ("batched per file", batch_seconds, batch)]:
+        print(f"{name:>20}: {seconds:8.2f} s {games / seconds:>10.0f} games/s  speedup {scalar_seconds / seconds:5.1f}x  "
+              f"identical {values == scalar}")
+
+
+def bench_scan(pgn_file_path):
+    size_mb = os.path.getsize(pgn_file_path) / 1e6
+    timings = {}
+    # The unchecked scanner does not play the moves, so it is only right for games known to be legal
+    readers = [("python-chess", lambda: iter_game_evals(pgn_file_path, False)),
+               ("scanner", lambda: iter_game_evals(pgn_file_path, True)),
+               ("unchecked", lambda: iter_game_evals(pgn_file_path, 'unchecked'))]
+    for name, read in readers:
+        start = time.perf_counter()
+        games = sum(1 for _ in read())
+        timings[name] = time.perf_counter() - start
+        print(f"{name:>13}: {timings[name]:8.2f} s {games / timings[name]:>10.0f} games/s {size_mb / timings[name]:>8.1f} MB/s")
+    print(f"speedup: {timings['python-chess'] / timings['scanner']:.1f}x (unchecked {timings['python-chess'] / timings['unchecked']:.1f}x), "
+          f"mismatches: {len(validate_scanner(pgn_file_path))}")
+
+
+def current_rss_mb():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def _hold_games(input_dir, games, layout):
+    # Runs in a fresh process: analyze the first games of input_dir and keep them in the given layout; returns the
+    # memory they hold (RSS growth), the time taken, the pickled size of the first 10000 and their JSON dicts
+    wdl_values = [1, 0.5, 0]
+    game_evals = itertools.chain.from_iterable(iter_game_evals(pgn_file_path, fast_scan=True)
+                                               for pgn_file_path in sorted(iter_pgn_files(input_dir)))
+    # The first game builds the expectation table, which is not counted
+    analyze_game(*next(game_evals), wdl_values, True)
+    gc.collect()
+    rss_before = current_rss_mb()
+    start = time.perf_counter()
+    held = []
+    for headers, pawns_list in itertools.islice(game_evals, games):
+        record = analyze_game(headers, pawns_list, wdl_values, True)
+        if record is None:
+            continue
+        if layout == "dict":
+            # The JSON dict, holding the header strings of the game's own headers
+            game_data = record.as_dict()
+            game_data.update((name, headers.get(name, None))
+                             for name in ("White", "Black", "Event", "Site", "Round", "WhiteElo", "BlackElo", "Date"))
+            held.append(game_data)
+        else:
+            held.append(record)
+    seconds = time.perf_counter() - start
+    gc.collect()
+    held_mb = current_rss_mb() - rss_before
+    pickled = len(pickle.dumps(held[:10000]))
+    dicts = [game if layout == "dict" else game.as_dict() for game in held]
+    return len(held), held_mb, seconds, pickled / min(len(held), 10000), dicts
+
+
+def bench_records(input_dir, games):
+    results = {}
+    print(f"{'layout':>12} {'games':>8} {'held MB':>9} {'bytes/game':>11} {'MB/100k':>8} {'seconds':>8} {'pickled B/game':>15}")
+    for layout in ("dict", "GameRecord"):
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+            count, held_mb, seconds, pickled, results[layout] = executor.submit(_hold_games, input_dir, games, layout).result()
+        print(f"{layout:>12} {count:>8} {held_mb:>9.1f} {held_mb * 2 ** 20 / count:>11.0f} {held_mb * 100000 / count:>8.1f} "
+              f"{seconds:>8.1f} {pickled:>15.0f}")
+    print(f"identical output: {results['dict'] == results['GameRecord']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    gi = subparsers.add_parser("gi", help="gi_and_gpl/calculate_acpl, Python versus NumPy")
+    gi.add_argument("--games", type=int, default=100000)
+    scan = subparsers.add_parser("scan", help="python-chess read_game versus the lightweight scanner")
+    scan.add_argument("pgn_file")
+    records = subparsers.add_parser("records", help="memory of the analyzed games, dicts versus GameRecords")
+    records.add_argument("input_dir")
+    records.add_argument("--games", type=int, default=100000)
+    args = parser.parse_args()
+
+    if args.benchmark == "gi":
+        bench_gi(args.games)
+    elif args.benchmark == "scan":
+        bench_scan(args.pgn_file)
+    elif args.benchmark == "records":
+        bench_records(args.input_dir, args.games)
@@ -0,0 +1,217 @@
+"""
+Benchmarks for the Stockfish annotator.
+
+Measures how annotation throughput scales with the number of engine workers, e.g.:
+    python benchmarks/bench_annotator.py scaling <pgn_dir> <engine_path> --depth 12 --workers 1 2 4 8
+Compares adaptive search budgets with fixed-depth analysis (GI/GPL difference versus engine time):
+    python benchmarks/bench_annotator.py adaptive <pgn_dir> <engine_path> --depth 18 --shallow-depth 8 --tolerance 0.02
+Compares the asyncio annotator (one event loop driving all engines) with the thread-per-engine pool, for several
+engine counts and both job schedules; without an engine path, the stub UCI engine is used, with --latency ms per depth:
+    python benchmarks/bench_annotator.py async <pgn_dir> --depth 10 --latency 1 --engines 1 2 4
+Compares the cost of setting up the position at every ply (no engine needed):
+    python benchmarks/bench_annotator.py setup --games 100 --plies 200
+"""
+
+import argparse
+import filecmp
+import os
+import random
+import sys
+import tempfile
+import time
+
+import chess
+import chess.pgn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from adaptive_search import AdaptiveSearch
+from async_annotator import main_stockfish_async
+from engine_pool import EnginePool
+from pgn_evaluation_fast_analyzer import gi_and_gpl
+from stockfish_pgn_annotator import analyze_game_scores, iter_games, iter_pgn_files, main_stockfish
+
+
+def count_games_and_plies(input_dir):
+    games, plies = 0, 0
+    for file_path, game in iter_games(iter_pgn_files(input_dir)):
+        games += 1
+        plies += sum(1 for _ in game.mainline_moves())
+    return games, plies
+
+
+def same_outputs(dir_a, dir_b, extension=None):
+    # With an extension, only those files are compared (the manifests hold absolute output paths)
+    for subdir, dirs, files in os.walk(dir_a):
+        for file in files:
+            if extension is not None and not file.endswith(extension):
+                continue
+            path_a = os.path.join(subdir, file)
+            path_b = os.path.join(dir_b, os.path.relpath(path_a, dir_a))
+            if not os.path.exists(path_b) or not filecmp.cmp(path_a, path_b, shallow=False):
+                return False
+    return True
+
+
+def bench_scaling(input_dir, engine_path, depth, worker_counts, engine_options=None):
+    games, plies = count_games_and_plies(input_dir)
+    print(f"{games} games, {plies} plies, depth {depth}")
+    print(f"{'workers':>8} {'seconds':>9} {'games/s':>9} {'plies/s':>9} {'speedup':>8} {'same output':>12}")
+    with tempfile.TemporaryDirectory() as tmp:
+        reference_dir, base_seconds = None, None
+        for workers in worker_counts:
+            output_dir = os.path.join(tmp, f"workers_{workers}")
+            start = time.perf_counter()
+            main_stockfish(input_dir, output_dir, engine_path, depth, pool_size=workers, engine_options=engine_options)
+            seconds = time.perf_counter() - start
+            if reference_dir is None:
+                reference_dir, base_seconds = output_dir, seconds
+            same = same_outputs(reference_dir, output_dir)
+            print(f"{workers:>8} {seconds:>9.2f} {games / seconds:>9.1f} {plies / seconds:>9.1f} {base_seconds / seconds:>8.2f} {str(same):>12}")
+
+
+def bench_async(input_dir, engine_path, depth, engine_counts, engine_options=None):
+    # main_stockfish (threads around SimpleEngine) versus main_stockfish_async with each schedule; the output of every
+    # run is checked against the first one
+    games, plies = count_games_and_plies(input_dir)
+    print(f"{games} games, {plies} plies, depth {depth}")
+    print(f"{'annotator':>18} {'engines':>8} {'seconds':>9} {'games/s':>9} {'plies/s':>9} {'same output':>12}")
+    runs = [("pool", None), ("async games", "games"), ("async positions", "positions")]
+    with tempfile.TemporaryDirectory() as tmp:
+        reference_dir = None
+        for engines in engine_counts:
+            for name, schedule in runs:
+                output_dir = os.path.join(tmp, f"{name.replace(' ', '_')}_{engines}")
+                start = time.perf_counter()
+                if schedule is None:
+                    main_stockfish(input_dir, output_dir, engine_path, depth, pool_size=engines, engine_options=engine_options)
+                else:
+                    main_stockfish_async(input_dir, output_dir, engine_path, depth, engines=engines,
+                                         engine_options=engine_options, schedule=schedule)
+                seconds = time.perf_counter() - start
+                if reference_dir is None:
+                    reference_dir = output_dir
+                same = same_outputs(reference_dir, output_dir, ".pgn")
+                print(f"{name:>18} {engines:>8} {seconds:>9.2f} {games / seconds:>9.1f} {plies / seconds:>9.1f} {str(same):>12}")
+
+
+def game_metrics(scores, game):
+    # GPL and raw GI of both players, computed the way the analyzer does from an annotated game
+    if len(scores) < 2:
+        return None
+    pawns_list = [scores[0]] + scores
+    white_gi, black_gi, white_gpl, black_gpl, white_gi_raw, black_gi_raw, _, _ = gi_and_gpl(
+        pawns_list, game.headers.get("Result"), None, None, [1, 0.5, 0], False)
+    return white_gpl, black_gpl, white_gi_raw, black_gi_raw
+
+
+def bench_adaptive(input_dir, engine_path, depth, adaptive, engine_options=None):
+    # Games are read twice so that the adaptive pass does not reuse the engine hash of the fixed-depth pass
+    fixed_games = [game for _, game in iter_games(iter_pgn_files(input_dir))]
+    adaptive_games = [game for _, game in iter_games(iter_pgn_files(input_dir))]
+    with EnginePool(engine_path, 1, engine_options) as pool:
+        start = time.perf_counter()
+        fixed_scores = [analyze_game_scores(game, pool, depth) for game in fixed_games]
+        fixed_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        adaptive_scores = [analyze_game_scores(game, pool, depth, adaptive=adaptive) for game in adaptive_games]
+        adaptive_seconds = time.perf_counter() - start
+
+    gpl_errors, gi_errors = [], []
+    for game, fixed, adapted in zip(fixed_games, fixed_scores, adaptive_scores):
+        fixed_metrics, adaptive_metrics = game_metrics(fixed, game), game_metrics(adapted, game)
+        if fixed_metrics is None or adaptive_metrics is None:
+            continue
+        gpl_errors += [abs(a - b) for a, b in zip(fixed_metrics[:2], adaptive_metrics[:2])]
+        gi_errors += [abs(a - b) for a, b in zip(fixed_metrics[2:], adaptive_metrics[2:])]
+
+    print(f"{len(fixed_games)} games, full depth {depth}, shallow depth {adaptive.shallow_depth}, tolerance {adaptive.tolerance}")
+    print(adaptive.report())
+    print(f"engine time: fixed {fixed_seconds:.2f} s, adaptive {adaptive_seconds:.2f} s "
+          f"({100 * adaptive_seconds / fixed_seconds:.1f}% of fixed)")
+    if gpl_errors:
+        within = sum(error <= adaptive.tolerance for error in gpl_errors) / len(gpl_errors)
+        print(f"per-player GPL difference: mean {sum(gpl_errors) / len(gpl_errors):.4f}, max {max(gpl_errors):.4f}, "
+              f"{100 * within:.1f}% within {adaptive.tolerance}")
+        print(f"per-player raw GI difference: mean {sum(gi_errors) / len(gi_errors):.4f}, max {max(gi_errors):.4f}")
+
+
+def random_game(plies, seed):
+    # A game of exactly `plies` random legal moves; restarts with another seed if the game ends early
+    rng = random.Random(seed)
+    while True:
+        board = chess.Board()
+        while len(board.move_stack) < plies and not board.is_game_over():
+            board.push(rng.choice(list(board.legal_moves)))
+        if len(board.move_stack) == plies:
+            return chess.pgn.Game.from_board(board)
+
+
+def setup_by_node_board(game):
+    # Previous approach: every node replays the game from the root
+    node = game
+    while node.variations:
+        node = node.variations[0]
+        node.board()
+
+
+def setup_by_push(game):
+    board = game.board()
+    for move in game.mainline_moves():
+        board.push(move)
+
+
+def bench_setup(games, plies, seed=0):
+    corpus = [random_game(plies, seed + i) for i in range(games)]
+    print(f"{games} games of {plies} plies")
+    results = {}
+    for name, setup in [("node.board() per ply", setup_by_node_board), ("incremental push", setup_by_push)]:
+        start = time.perf_counter()
+        for game in corpus:
+            setup(game)
+        results[name] = time.perf_counter() - start
+        print(f"{name:>22}: {results[name]:.3f} s ({1e6 * results[name] / (games * plies):.1f} us/ply)")
+    print(f"speedup: {results['node.board() per ply'] / results['incremental push']:.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    scaling = subparsers.add_parser("scaling", help="throughput versus number of engine workers")
+    scaling.add_argument("input_dir")
+    scaling.add_argument("engine_path")
+    scaling.add_argument("--depth", type=int, default=12)
+    scaling.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    scaling.add_argument("--threads", type=int, default=1, help="UCI Threads per engine")
+    scaling.add_argument("--hash", type=int, default=64, help="UCI Hash (MB) per engine")
+    adaptive = subparsers.add_parser("adaptive", help="adaptive search budgets versus fixed depth")
+    adaptive.add_argument("input_dir")
+    adaptive.add_argument("engine_path")
+    adaptive.add_argument("--depth", type=int, default=18)
+    adaptive.add_argument("--shallow-depth", type=int, default=8)
+    adaptive.add_argument("--tolerance", type=float, default=0.02)
+    adaptive.add_argument("--nodes-per-game", type=int, default=None)
+    async_parser = subparsers.add_parser("async", help="asyncio annotator versus the engine pool")
+    async_parser.add_argument("input_dir")
+    async_parser.add_argument("engine_path", nargs="?", default=None, help="default: the stub UCI engine")
+    async_parser.add_argument("--depth", type=int, default=10)
+    async_parser.add_argument("--engines", type=int, nargs="+", default=[1, 2, 4])
+    async_parser.add_argument("--latency", type=int, default=1, help="ms per depth of the stub engine")
+    setup = subparsers.add_parser("setup", help="per-ply position setup cost, node.board() versus incremental push")
+    setup.add_argument("--games", type=int, default=100)
+    setup.add_argument("--plies", type=int, default=200)
+    args = parser.parse_args()
+
+    if args.benchmark == "scaling":
+        bench_scaling(args.input_dir, args.engine_path, args.depth, args.workers, {"Threads": args.threads, "Hash": args.hash})
+    elif args.benchmark == "adaptive":
+        bench_adaptive(args.input_dir, args.engine_path, args.depth,
+                       AdaptiveSearch(args.shallow_depth, tolerance=args.tolerance, nodes_per_game=args.nodes_per_game))
+    elif args.benchmark == "async":
+        if args.engine_path is None:
+            stub_engine = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stub_uci_engine.py")
+            bench_async(args.input_dir, [sys.executable, stub_engine], args.depth, args.engines, {"Latency": args.latency})
+        else:
+            bench_async(args.input_dir, args.engine_path, args.depth, args.engines)
+    elif args.benchmark == "setup":
+        bench_setup(args.games, args.plies)
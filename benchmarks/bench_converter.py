@@ -0,0 +1,121 @@
+"""
+Benchmarks for the JSON to CSV converter.
+
+Writes a synthetic corpus of analyzer JSON files, converts it with the original game-by-game path and with the bulk
+loader, and compares time, peak memory and the resulting CSV files, e.g.:
+    python benchmarks/bench_converter.py --games 1000000 --files 20 --workers 4
+The game-by-game path takes a long time on a million games; --legacy-games runs it on a prefix of the corpus only.
+"""
+
+import argparse
+import filecmp
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from json_to_csv_converter import main_json_to_csv
+
+FIRST_NAMES = ["Magnus", "Hikaru", "Fabiano", "Ian", "Ding", "Alireza", "Wesley", "Anish", "Levon", "Maxime"]
+LAST_NAMES = ["Carlsen", "Nakamura", "Caruana", "Nepomniachtchi", "Liren", "Firouzja", "So", "Giri", "Aronian", "Vachier-Lagrave"]
+
+
+def random_game_data(rng):
+    # One game of pgn_evaluation_fast_analyzer's JSON output
+    def name():
+        first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES) + str(rng.randint(1, 500))
+        return f"{last}, {first}" if rng.random() < 0.5 else f"{first} {last}"
+    white_result = rng.choice([1, 0.5, 0, "..."])
+    return {
+        "white_gi": round(rng.gauss(150, 20), 4), "black_gi": round(rng.gauss(150, 20), 4),
+        "white_gpl": round(rng.gauss(0, 0.5), 4), "black_gpl": round(rng.gauss(0, 0.5), 4),
+        "white_acpl": round(rng.uniform(0, 80), 4), "black_acpl": round(rng.uniform(0, 80), 4),
+        "white_gi_raw": round(rng.gauss(0, 0.5), 4), "black_gi_raw": round(rng.gauss(0, 0.5), 4),
+        "white_move_number": rng.randint(20, 80), "black_move_number": rng.randint(20, 80),
+        "White": name(), "Black": name(), "Event": f"Event {rng.randint(1, 100)}", "Site": "?",
+        "Round": str(rng.randint(1, 11)), "WhiteElo": str(rng.randint(1800, 2850)) if rng.random() > 0.02 else "?",
+        "BlackElo": str(rng.randint(1800, 2850)), "WhiteResult": white_result,
+        "BlackResult": 1 - white_result if white_result != "..." else "...", "Date": "2024.01.01",
+    }
+
+
+def write_corpus(json_dir, games, files, seed=0):
+    rng = random.Random(seed)
+    os.makedirs(json_dir, exist_ok=True)
+    key = 0
+    for number in range(files):
+        file_games = games // files + (1 if number < games % files else 0)
+        all_data = {}
+        for _ in range(file_games):
+            key += 1
+            all_data[str(key)] = random_game_data(rng)
+        with open(os.path.join(json_dir, f"games_{number:04d}.json"), 'w') as f:
+            json.dump(all_data, f, indent=4)
+
+
+def _run(queue, json_dir, csv_dir, bulk, workers):
+    start = time.perf_counter()
+    main_json_to_csv(json_dir, csv_dir, bulk=bulk, workers=workers)
+    # ru_maxrss is in kilobytes on Linux (bytes on macOS); worker processes are not included
+    queue.put((time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+def run_converter(json_dir, csv_dir, bulk, workers=1):
+    # Each run in a fresh process, so that the peak memory of one run does not hide the other
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run, args=(queue, json_dir, csv_dir, bulk, workers))
+    process.start()
+    seconds, peak_mb = queue.get()
+    process.join()
+    return seconds, peak_mb
+
+
+def bench_converter(games, files, workers, legacy_games=None):
+    legacy_games = games if legacy_games is None else min(legacy_games, games)
+    with tempfile.TemporaryDirectory() as tmp:
+        json_dir = os.path.join(tmp, "json")
+        write_corpus(json_dir, games, files)
+        size_mb = sum(os.path.getsize(os.path.join(json_dir, file)) for file in os.listdir(json_dir)) / 1e6
+        print(f"{games} games in {files} JSON files, {size_mb:.0f} MB")
+
+        runs = [("bulk, 1 worker", games, True, 1)]
+        if workers > 1:
+            runs.append((f"bulk, {workers} workers", games, True, workers))
+        if legacy_games > 0:
+            if legacy_games < games:
+                # The same prefix of the corpus for both paths, so that their outputs can be compared
+                legacy_dir = os.path.join(tmp, "legacy_json")
+                write_corpus(legacy_dir, legacy_games, max(1, files * legacy_games // games))
+                runs.append(("bulk on the prefix", legacy_games, True, 1))
+            runs.append(("game by game", legacy_games, False, 1))
+
+        outputs = {}
+        for name, run_games, bulk, run_workers in runs:
+            input_dir = json_dir if run_games == games else os.path.join(tmp, "legacy_json")
+            csv_dir = os.path.join(tmp, name.replace(" ", "_").replace(",", ""))
+            seconds, peak_mb = run_converter(input_dir, csv_dir, bulk, run_workers)
+            outputs[name] = os.path.join(csv_dir, "aggregated_game_data.csv")
+            print(f"{name:>20}: {run_games:>8} games {seconds:8.2f} s {run_games / seconds:>10.0f} games/s  peak RSS {peak_mb:8.0f} MB")
+
+        if workers > 1:
+            print(f"same CSV with {workers} workers: {filecmp.cmp(outputs['bulk, 1 worker'], outputs[runs[1][0]], shallow=False)}")
+        if legacy_games > 0:
+            bulk_output = outputs["bulk on the prefix" if legacy_games < games else "bulk, 1 worker"]
+            print(f"same CSV as game by game: {filecmp.cmp(bulk_output, outputs['game by game'], shallow=False)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--games", type=int, default=1000000)
+    parser.add_argument("--files", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--legacy-games", type=int, default=None,
+                        help="run the game-by-game path on this many games only (0 to skip it)")
+    args = parser.parse_args()
+    bench_converter(args.games, args.files, args.workers, args.legacy_games)
@@ -0,0 +1,94 @@
+"""
+Benchmarks for the player stats.
+
+Compares the original step-by-step main_stats calculation (one groupby per metric and color, joined with outer merges)
+with the single-pass groupby over the long per-player table on a synthetic set of games, and checks that both give
+the same player_stats.csv, e.g.:
+    python benchmarks/bench_stats.py --games 5000000
+Each calculation runs in a fresh process. It is timed, then run again under tracemalloc to report its peak memory
+(NumPy and pandas buffers included) on top of the games DataFrame. By default there is one player per 400 games:
+the TPR calculation (optimize_w) overflows for players with more than about 1000 games.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from csv_to_player_stats import calculate_player_stats, calculate_player_stats_by_merges
+
+
+def random_games(games, players, seed=0):
+    # Games in the layout of the converter's CSV, between players of different strength
+    rng = np.random.default_rng(seed)
+    names = np.array([f"Player{number}" for number in range(players)], dtype=object)
+    ratings = rng.integers(1800, 2850, players)
+    white, black = rng.integers(0, players, games), rng.integers(0, players, games)
+    white_result = rng.choice([1.0, 0.5, 0.0], games)
+    df = pd.DataFrame({"White": names[white], "Black": names[black],
+                       "WhiteElo": ratings[white] + rng.integers(-30, 30, games),
+                       "BlackElo": ratings[black] + rng.integers(-30, 30, games),
+                       "WhiteResult": white_result, "BlackResult": 1 - white_result})
+    for color in ("white", "black"):
+        df[f"{color}_gi"] = rng.normal(150, 20, games).round(4)
+        df[f"{color}_gi_raw"] = rng.normal(0, 0.5, games).round(4)
+        df[f"{color}_gpl"] = rng.normal(0, 0.5, games).round(4)
+        df[f"{color}_acpl"] = rng.uniform(0, 80, games).round(4)
+        df[f"{color}_move_number"] = rng.integers(20, 80, games)
+    return df
+
+
+def _run(games, players, single_pass, output_path, measure_memory):
+    df = random_games(games, players)
+    calculate = calculate_player_stats if single_pass else calculate_player_stats_by_merges
+    start = time.perf_counter()
+    player_stats = calculate(df)
+    seconds = time.perf_counter() - start
+    player_stats.sort_values(by='avg_gi', ascending=False).to_csv(output_path, index=False)
+    peak_mb = None
+    if measure_memory:
+        # A second run under tracemalloc, which slows it down too much to time it
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        calculate(df)
+        peak_mb = (tracemalloc.get_traced_memory()[1] - baseline) / 1e6
+        tracemalloc.stop()
+    return seconds, peak_mb
+
+
+def run_stats(games, players, single_pass, output_path, measure_memory):
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        return executor.submit(_run, games, players, single_pass, output_path, measure_memory).result()
+
+
+def bench_stats(games, players, measure_memory=True):
+    print(f"{games} games, {players} players")
+    with tempfile.TemporaryDirectory() as tmp:
+        outputs, timings = [], {}
+        for name, single_pass in [("step by step", False), ("single pass", True)]:
+            output_path = os.path.join(tmp, f"{name.replace(' ', '_')}.csv")
+            seconds, peak_mb = run_stats(games, players, single_pass, output_path, measure_memory)
+            timings[name] = seconds
+            outputs.append(output_path)
+            memory = f"  peak memory {peak_mb:8.0f} MB" if peak_mb is not None else ""
+            print(f"{name:>13}: {seconds:8.2f} s {games / seconds:>10.0f} games/s{memory}")
+        with open(outputs[0]) as a, open(outputs[1]) as b:
+            same = a.read() == b.read()
+        print(f"speedup: {timings['step by step'] / timings['single pass']:.1f}x, same player_stats.csv: {same}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--games", type=int, default=5000000)
+    parser.add_argument("--players", type=int, default=None)
+    parser.add_argument("--no-memory", action="store_true", help="skip the (slow) peak memory measurement")
+    args = parser.parse_args()
+    bench_stats(args.games, args.players or max(1, args.games // 400), not args.no_memory)
@@ -0,0 +1,182 @@
+"""
+Benchmark suite of the whole calculation on deterministic synthetic corpora (see corpus.py).
+
+Runs each stage on a corpus of 1k, 100k or 1m annotated games and reports its time, throughput and peak memory, then
+checks its output against the frozen digests in golden.json and exits with status 1 if any of them differs, e.g.:
+    python benchmarks/bench_suite.py --size 1k
+    python benchmarks/bench_suite.py --size 100k --workers 4 --corpus-dir /data/bench_corpora
+The stages are:
+    annotate   main_stockfish on --annotate-games unannotated games, with the stub UCI engine (no Stockfish needed)
+    analyze    the analyzer's main with the lightweight scanner (and with python-chess, --python-chess)
+    convert    main_json_to_csv
+    stats      main_stats on the converter's CSV
+Each stage runs in a fresh process, so its peak RSS (and that of its worker/engine processes) is its own.
+Corpora are written to --corpus-dir (reused when present) or to a temporary directory. After an intended change of
+the results, --update-golden saves the new digests for the size.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+
+from corpus import SIZES, directory_digest, load_or_write_corpus
+from csv_to_player_stats import main_stats
+from json_to_csv_converter import main_json_to_csv
+from pgn_evaluation_fast_analyzer import main
+from stockfish_pgn_annotator import main_stockfish
+
+GOLDEN_PATH = os.path.join(BENCHMARKS_DIR, "golden.json")
+STUB_ENGINE = os.path.join(BENCHMARKS_DIR, "stub_uci_engine.py")
+ANNOTATE_DEPTH = 10
+WDL_VALUES = [1, 0.5, 0]
+WEIGHTED = True
+
+
+def _run_stage(stage, paths, workers):
+    # Runs in the stage's own process; the stages' progress messages are not shown
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        if stage == "annotate":
+            main_stockfish(paths["plain"], paths["annotated"], [sys.executable, STUB_ENGINE], ANNOTATE_DEPTH, pool_size=workers)
+        elif stage == "analyze":
+            main(paths["corpus"], paths["json"], WDL_VALUES, WEIGHTED, fast_scan=True, workers=workers)
+        elif stage == "analyze (python-chess)":
+            main(paths["corpus"], paths["json_python_chess"], WDL_VALUES, WEIGHTED, fast_scan=False, workers=workers)
+        elif stage == "convert":
+            main_json_to_csv(paths["json"], paths["csv"], workers=workers)
+        elif stage == "stats":
+            main_stats(os.path.join(paths["csv"], "aggregated_game_data.csv"), paths["stats"])
+        seconds = time.perf_counter() - start
+    # For the children, the largest ru_maxrss of them (in kilobytes on Linux, bytes on macOS); for forked workers,
+    # it includes what they shared with this process when they were started
+    return seconds, peak_rss_mb(), resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+
+
+def peak_rss_mb():
+    # The high-water mark of this process since it started (ru_maxrss would also count the RSS of the process it was
+    # forked from, before the exec)
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except FileNotFoundError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_stage(stage, paths, workers):
+    # A fresh (spawned, not forked) process per stage, so that peak memory is not inherited from this one
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(_run_stage, stage, paths, workers).result()
+
+
+def output_digest(stage, paths):
+    if stage == "annotate":
+        return directory_digest(paths["annotated"], ".pgn")
+    if stage == "analyze":
+        return directory_digest(paths["json"], ".json")
+    if stage == "analyze (python-chess)":
+        return directory_digest(paths["json_python_chess"], ".json")
+    if stage == "convert":
+        return directory_digest(paths["csv"], ".csv")
+    return directory_digest(paths["stats"], ".csv")
+
+
+def load_golden():
+    try:
+        with open(GOLDEN_PATH) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def bench_suite(size, workers, annotate_games, python_chess, corpus_dir, update_golden, report_path=None):
+    games = SIZES[size]
+    golden = load_golden().get(size, {})
+    with tempfile.TemporaryDirectory() as tmp:
+        corpus_root = corpus_dir or tmp
+        start = time.perf_counter()
+        corpus = load_or_write_corpus(os.path.join(corpus_root, f"annotated_{size}"), games)
+        plain = load_or_write_corpus(os.path.join(corpus_root, f"plain_{annotate_games}"), annotate_games, annotated=False)
+        print(f"{games} annotated games ({corpus['plies']} plies) in {corpus['files']} files, "
+              f"{annotate_games} games to annotate ({time.perf_counter() - start:.1f} s to prepare)")
+        paths = {"corpus": os.path.join(corpus_root, f"annotated_{size}"),
+                 "plain": os.path.join(corpus_root, f"plain_{annotate_games}")}
+        for name in ("annotated", "json", "json_python_chess", "csv", "stats"):
+            paths[name] = os.path.join(tmp, name)
+
+        stages = ["annotate", "analyze"] + (["analyze (python-chess)"] if python_chess else []) + ["convert", "stats"]
+        expected = {"corpus": golden.get("corpus"), "annotate": None, "analyze": golden.get("analyze"),
+                    "convert": golden.get("convert"), "stats": golden.get("stats")}
+        if golden.get("annotate_games") == annotate_games:
+            expected["annotate"] = golden.get("annotate")
+        digests = {"corpus": corpus["digest"], "annotate_games": annotate_games}
+        results = []
+        print(f"{'stage':>22} {'seconds':>9} {'games/s':>10} {'plies/s':>11} {'peak RSS':>10} {'workers RSS':>12}  golden")
+        for stage in stages:
+            seconds, peak_mb, children_peak_mb = run_stage(stage, paths, workers)
+            digest = output_digest(stage, paths)
+            if stage == "analyze (python-chess)":
+                # Checked against the scanner's output of this run, which is checked against the golden digest
+                expected[stage] = digests["analyze"]
+            else:
+                digests[stage] = digest
+            status = "-" if expected[stage] is None else ("ok" if digest == expected[stage] else "DIFFERENT")
+            stage_games, stage_plies = (annotate_games, plain["plies"]) if stage == "annotate" else (games, corpus["plies"])
+            plies = f"{stage_plies / seconds:>11.0f}" if stage != "stats" else f"{'':>11}"
+            print(f"{stage:>22} {seconds:9.2f} {stage_games / seconds:>10.0f} {plies} {peak_mb:>7.0f} MB "
+                  f"{children_peak_mb:>9.0f} MB  {status}")
+            results.append({"stage": stage, "seconds": round(seconds, 3), "games": stage_games, "plies": stage_plies,
+                            "peak_rss_mb": round(peak_mb, 1), "children_peak_rss_mb": round(children_peak_mb, 1),
+                            "golden": status})
+
+    failures = [result["stage"] for result in results if result["golden"] == "DIFFERENT"]
+    if update_golden and "analyze (python-chess)" in failures:
+        print("python-chess and the scanner give different analyzer outputs: golden digests not saved")
+        return False
+    if expected["corpus"] is not None and corpus["digest"] != expected["corpus"]:
+        failures.insert(0, "corpus")
+    if report_path:
+        with open(report_path, 'w') as f:
+            json.dump({"size": size, "workers": workers, "python_chess": python_chess, "stages": results}, f, indent=4)
+    if update_golden:
+        all_golden = load_golden()
+        all_golden[size] = digests
+        with open(GOLDEN_PATH, 'w') as f:
+            json.dump(all_golden, f, indent=4)
+            f.write("\n")
+        print(f"Golden digests of {size} saved to {GOLDEN_PATH}")
+        return True
+    if not golden:
+        print(f"No golden digests for {size}: run with --update-golden to save them")
+    elif failures:
+        print(f"Outputs differ from the golden digests: {', '.join(failures)}")
+        return False
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", choices=list(SIZES), default="1k")
+    parser.add_argument("--workers", type=int, default=1, help="analyzer/converter processes and engines")
+    parser.add_argument("--annotate-games", type=int, default=50)
+    parser.add_argument("--python-chess", action="store_true", help="also analyze with python-chess (slow on large corpora)")
+    parser.add_argument("--corpus-dir", default=None)
+    parser.add_argument("--update-golden", action="store_true")
+    parser.add_argument("--report", default=None, help="save the results to this JSON file")
+    args = parser.parse_args()
+    ok = bench_suite(args.size, args.workers, args.annotate_games, args.python_chess, args.corpus_dir,
+                     args.update_golden, args.report)
+    sys.exit(0 if ok else 1)
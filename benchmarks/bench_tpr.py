@@ -0,0 +1,59 @@
+"""
+Benchmarks for the TPR calculation of the player stats.
+
+Compares optimize_w per player (as DataFrame.apply used to call it) with optimize_w_batch on a synthetic pool of
+players, most of whom played few games, and checks the batched results against optimize_w, e.g.:
+    python benchmarks/bench_tpr.py --players 300000
+optimize_w is timed on a sample of --sample players and extrapolated; it only handles players with up to about
+1000 games, so the sample (and the comparison) is limited to those.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from epr_calculator import compare_with_optimize_w, optimize_w, optimize_w_batch
+
+THRESHOLD = 0.75
+
+
+def random_pool(players, seed=0):
+    # Heavy-tailed game counts, scores in half points
+    rng = np.random.default_rng(seed)
+    games = np.minimum(np.ceil(rng.pareto(1.2, players) * 5), 5000).astype(np.int64)
+    points = rng.binomial(2 * games, rng.beta(5, 5, players)) / 2
+    return points, games
+
+
+def bench_tpr(players, sample):
+    points, games = random_pool(players)
+    combinations = len(np.unique(np.stack([np.trunc(points), games], axis=1), axis=0))
+    print(f"{players} players, {combinations} distinct (points, games), up to {games.max()} games")
+
+    start = time.perf_counter()
+    optimize_w_batch(points, games, THRESHOLD)
+    batch_seconds = time.perf_counter() - start
+
+    small = np.flatnonzero(games <= 1000)[:sample]
+    start = time.perf_counter()
+    for i in small.tolist():
+        optimize_w(points[i], games[i], THRESHOLD)
+    scalar_seconds = (time.perf_counter() - start) * players / len(small)
+
+    print(f"  optimize_w per player: {scalar_seconds:8.2f} s (extrapolated from {len(small)} players)")
+    print(f"      optimize_w_batch: {batch_seconds:8.2f} s  speedup {scalar_seconds / batch_seconds:.0f}x")
+    w_difference, rating_difference = compare_with_optimize_w(points[small], games[small], THRESHOLD)
+    print(f"largest difference from optimize_w: w {w_difference:.2e}, rounded rating {rating_difference:.0f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--players", type=int, default=300000)
+    parser.add_argument("--sample", type=int, default=5000)
+    args = parser.parse_args()
+    bench_tpr(args.players, args.sample)
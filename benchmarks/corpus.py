@@ -0,0 +1,157 @@
+"""
+Deterministic synthetic PGN corpora for the benchmarks.
+
+The games are made of random legal move sequences (a few hundred, cut at random lengths), played between a pool of
+players with realistic names and ratings, with results that follow the rating difference. Annotated corpora carry an
+[%eval] comment after every move (a random walk in pawns, with occasional mate scores), as Stockfish-annotated games
+do. The same seed always gives the same files, byte for byte.
+"""
+
+import hashlib
+import json
+import os
+import random
+
+import chess
+
+SIZES = {"1k": 1_000, "100k": 100_000, "1m": 1_000_000}
+GAMES_PER_FILE = 10_000
+
+FIRST_NAMES = ["Magnus", "Hikaru", "Fabiano", "Ian", "Ding", "Alireza", "Wesley", "Anish", "Levon", "Maxime",
+               "Viswanathan", "Teimour", "Sergey", "Shakhriyar", "Richard", "Praggnanandhaa", "Gukesh", "Nodirbek"]
+LAST_NAMES = ["Carlsen", "Nakamura", "Caruana", "Nepomniachtchi", "Liren", "Firouzja", "So", "Giri", "Aronian",
+              "Vachier-Lagrave", "Anand", "Radjabov", "Karjakin", "Mamedyarov", "Rapport", "Rameshbabu", "Dommaraju",
+              "Abdusattorov"]
+EVENTS = ["Open", "Championship", "Invitational", "Rapid", "Blitz", "Memorial", "Masters", "Cup"]
+
+
+def move_lines(count, plies, seed):
+    # count random legal games of up to plies plies, as (White tokens, Black tokens after a comment, Black tokens)
+    rng = random.Random(seed)
+    lines = []
+    for _ in range(count):
+        board = chess.Board()
+        white, black_after_comment, black = [], [], []
+        while len(white) + len(black) < plies:
+            moves = list(board.legal_moves)
+            if not moves:
+                break
+            move = rng.choice(moves)
+            san = board.san(move)
+            if board.turn == chess.WHITE:
+                white.append(f"{board.fullmove_number}. {san}")
+            else:
+                black_after_comment.append(f"{board.fullmove_number}... {san}")
+                black.append(san)
+            board.push(move)
+        lines.append((white, black_after_comment, black))
+    return lines
+
+
+def player_pool(players, rng):
+    pool = []
+    for number in range(players):
+        name = f"{rng.choice(LAST_NAMES)}{number}, {rng.choice(FIRST_NAMES)}"
+        pool.append((name, min(2850, max(1400, int(rng.gauss(2250, 250))))))
+    return pool
+
+
+def game_result(rng, white_rating, black_rating):
+    expected = 1 / (1 + 10 ** ((black_rating - white_rating) / 400))
+    draw = 0.3
+    roll = rng.random()
+    if roll < draw:
+        return "1/2-1/2", 0.0
+    if roll < draw + (1 - draw) * expected:
+        return "1-0", 1.0
+    return "0-1", -1.0
+
+
+def movetext(rng, line, plies, annotated, winner):
+    # Moves of the game, six plies per line, with a random-walk evaluation drifting towards the winner
+    white, black_after_comment, black = line
+    parts = []
+    evaluation = round(rng.gauss(0.2, 0.2), 2)
+    drift = 0.02 * winner
+    for ply in range(plies):
+        if ply % 2 == 0:
+            parts.append(white[ply // 2])
+        else:
+            parts.append((black_after_comment if annotated else black)[ply // 2])
+        if annotated:
+            evaluation = round(evaluation + drift + rng.gauss(0, 0.35), 2)
+            if rng.random() < 0.002:
+                parts.append(f"{{ [%eval #{rng.choice([-4, -2, 1, 3])}] }}")
+            else:
+                parts.append(f"{{ [%eval {evaluation}] }}")
+        if ply % 6 == 5:
+            parts.append("\n")
+    return " ".join(parts).replace(" \n ", "\n").rstrip()
+
+
+def game_pgn(rng, lines, pool, event, round_number, annotated):
+    (white_name, white_rating), (black_name, black_rating) = rng.sample(pool, 2)
+    result, winner = game_result(rng, white_rating, black_rating)
+    line = rng.choice(lines)
+    length = len(line[0]) + len(line[1])
+    plies = rng.randint(min(20, length), length)
+    headers = [("Event", event), ("Site", "?"), ("Date", f"2024.{rng.randint(1, 12):02d}.{rng.randint(1, 28):02d}"),
+               ("Round", str(round_number)), ("White", white_name), ("Black", black_name), ("Result", result)]
+    # A few games have no rating for White
+    if rng.random() > 0.01:
+        headers.append(("WhiteElo", str(white_rating + rng.randint(-25, 25))))
+    headers.append(("BlackElo", str(black_rating + rng.randint(-25, 25))))
+    header_text = "\n".join(f'[{name} "{value}"]' for name, value in headers)
+    return f"{header_text}\n\n{movetext(rng, line, plies, annotated, winner)} {result}\n\n", plies
+
+
+def write_corpus(directory, games, annotated=True, seed=0, games_per_file=GAMES_PER_FILE):
+    # Write games PGN games to directory/games_0000.pgn, ... and return the corpus description (also saved as
+    # directory/corpus.json): number of games, files and plies, and the SHA-256 digest of the files
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(seed)
+    lines = move_lines(300, 160, seed)
+    pool = player_pool(max(20, games // 50), rng)
+    plies = 0
+    for number in range(0, (games + games_per_file - 1) // games_per_file):
+        file_games = min(games_per_file, games - number * games_per_file)
+        event = f"{rng.choice(EVENTS)} {number + 1}"
+        texts = []
+        for round_number in range(1, file_games + 1):
+            text, game_plies = game_pgn(rng, lines, pool, event, round_number, annotated)
+            texts.append(text)
+            plies += game_plies
+        with open(os.path.join(directory, f"games_{number:04d}.pgn"), 'w', encoding='utf-8') as f:
+            f.write("".join(texts))
+    description = {"games": games, "annotated": annotated, "seed": seed, "plies": plies,
+                   "files": (games + games_per_file - 1) // games_per_file, "digest": directory_digest(directory, ".pgn")}
+    with open(os.path.join(directory, "corpus.json"), 'w') as f:
+        json.dump(description, f, indent=4)
+    return description
+
+
+def load_or_write_corpus(directory, games, annotated=True, seed=0):
+    # Reuse the corpus in directory if it was written with the same parameters
+    try:
+        with open(os.path.join(directory, "corpus.json")) as f:
+            description = json.load(f)
+        if (description["games"], description["annotated"], description["seed"]) == (games, annotated, seed):
+            return description
+    except (FileNotFoundError, json.JSONDecodeError, KeyError):
+        pass
+    return write_corpus(directory, games, annotated, seed)
+
+
+def directory_digest(directory, extension=""):
+    # SHA-256 of the relative paths and contents of the files of directory ending with extension, in path order
+    digest = hashlib.sha256()
+    paths = sorted(os.path.relpath(os.path.join(dirpath, filename), directory)
+                   for dirpath, dirnames, filenames in os.walk(directory)
+                   for filename in filenames if filename.endswith(extension))
+    for path in paths:
+        digest.update(path.replace(os.sep, "/").encode() + b"\0")
+        with open(os.path.join(directory, path), 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        digest.update(b"\0")
+    return digest.hexdigest()
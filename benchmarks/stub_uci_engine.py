@@ -0,0 +1,74 @@
+"""
+A deterministic stand-in for a UCI engine, used to run the annotator without a Stockfish binary, e.g.:
+    main_stockfish(input_dir, output_dir, [sys.executable, "benchmarks/stub_uci_engine.py"], 10)
+It answers "go depth N" at once with a material count plus a small offset derived from the position (so the same
+position always gets the same score), reports 1000 * N nodes, and waits N * Latency milliseconds first if the
+Latency option is set, to imitate the search time of a real engine.
+"""
+
+import sys
+import time
+import zlib
+
+import chess
+
+PIECE_VALUES = {chess.PAWN: 100, chess.KNIGHT: 300, chess.BISHOP: 300, chess.ROOK: 500, chess.QUEEN: 900}
+
+
+def evaluate(board):
+    # Material balance from the side to move, plus a small position-dependent offset
+    score = 0
+    for piece_type, value in PIECE_VALUES.items():
+        score += value * (len(board.pieces(piece_type, board.turn)) - len(board.pieces(piece_type, not board.turn)))
+    return score + zlib.crc32(board.board_fen().encode()) % 61 - 30
+
+
+def main():
+    board = chess.Board()
+    latency = 0.0
+    for line in sys.stdin:
+        tokens = line.split()
+        if not tokens:
+            continue
+        command = tokens[0]
+        if command == "uci":
+            print("id name StubEngine")
+            print("option name Threads type spin default 1 min 1 max 512")
+            print("option name Hash type spin default 16 min 1 max 33554432")
+            print("option name Latency type spin default 0 min 0 max 10000")
+            print("uciok")
+        elif command == "isready":
+            print("readyok")
+        elif command == "setoption" and len(tokens) >= 5 and tokens[2] == "Latency":
+            latency = int(tokens[4]) / 1000.0
+        elif command == "position":
+            if tokens[1] == "startpos":
+                board = chess.Board()
+                rest = tokens[2:]
+            else:
+                board = chess.Board(" ".join(tokens[2:8]))
+                rest = tokens[8:]
+            if rest and rest[0] == "moves":
+                for uci in rest[1:]:
+                    board.push_uci(uci)
+        elif command == "go":
+            depth = int(tokens[tokens.index("depth") + 1]) if "depth" in tokens else 10
+            if latency:
+                time.sleep(latency * depth)
+            nodes = 1000 * depth
+            if board.is_checkmate():
+                print("info depth 0 score mate 0")
+                print("bestmove (none)")
+            elif board.is_game_over():
+                print("info depth 0 score cp 0")
+                print("bestmove (none)")
+            else:
+                print(f"info depth {depth} seldepth {depth} score cp {evaluate(board)} nodes {nodes} nps {nodes * 100} time 10")
+                print(f"bestmove {next(iter(board.legal_moves)).uci()}")
+        elif command == "quit":
+            break
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
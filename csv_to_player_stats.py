@@ -1,30 +1,107 @@
 """This script analyzes chess game data, calculates various statistics (including sums, medians, and averages), 
 and generates a final DataFrame with player statistics, sorted by the average gi score in descending order.
+
+combine_csv_files streams the CSV files of a directory into one in chunks (the same file, and the same column dtypes,
+as concatenating them all in memory), and main_stats also takes the directory itself (its CSV files read workers at
+a time, without writing a combined file) or a DataFrame of games.
 """
 
-from epr_calculator import adjust_mn, optimize_w, calculate_EPR
+from epr_calculator import adjust_mn, optimize_w, calculate_EPR, optimize_w_batch, calculate_EPR_batch
+from game_table import read_game_table
+from json_to_csv_converter import extract_last_name
+import metrics
+import numpy as np
 import pandas as pd
 import sys
 import os
 import glob
-
-def combine_csv_files(input_dir, output_filename='combined.csv'):
-    csv_files = glob.glob(os.path.join(input_dir, '*.csv'))
-    combined_df = pd.DataFrame()
-
-    for file in csv_files:
-        df = pd.read_csv(file)
-        combined_df = pd.concat([combined_df, df], ignore_index=True)
-
+import functools
+import io
+from concurrent.futures import ProcessPoolExecutor
+
+# Default name of combine_csv_files' output, which is not read back as one of the directory's CSV files
+COMBINED_CSV = 'combined.csv'
+
+def csv_files_in(input_dir, output_filename=COMBINED_CSV):
+    # The CSV files of input_dir, without the output of combine_csv_files (its games are in the other files)
+    return [file for file in glob.glob(os.path.join(input_dir, '*.csv'))
+            if os.path.basename(file) != output_filename]
+
+def combine_csv_files(input_dir, output_filename=COMBINED_CSV, workers=1, chunk_size=100000):
+    # Concatenate the CSV files of input_dir into input_dir/output_filename, one file at a time in chunks of chunk_size
+    # rows, instead of holding all of them (and copying them once per file) in memory. The output is the CSV that
+    # concatenating all files with pd.concat gives: the columns of all files in first-seen order, each with the dtype
+    # the concatenation would give it. Finding these dtypes takes a first pass over the files, workers at a time.
     output_path = os.path.join(input_dir, output_filename)
-    combined_df.to_csv(output_path, index=False)
+    csv_files = csv_files_in(input_dir, output_filename)
+    file_dtypes = _map(_csv_dtypes, csv_files, workers)
+    first_rows = [pd.read_csv(io.StringIO(sample), dtype=dtypes) for dtypes, sample in file_dtypes]
+    combined = pd.concat([pd.DataFrame()] + first_rows, ignore_index=True) if first_rows else pd.DataFrame()
+    columns, combined_dtypes = list(combined.columns), combined.dtypes
+    header = True
+    for file, (dtypes, sample) in zip(csv_files, file_dtypes):
+        # Each chunk is read with the dtypes of the whole file, then cast as the concatenation would cast it
+        for chunk in pd.read_csv(file, dtype=dtypes, chunksize=chunk_size):
+            chunk = chunk.reindex(columns=columns).astype(combined_dtypes)
+            chunk.to_csv(output_path, mode='w' if header else 'a', header=header, index=False)
+            header = False
+    if header:
+        pd.DataFrame(columns=columns).to_csv(output_path, index=False)
     print(f"Combined CSV created at {output_path}")
     return output_path
 
+def _csv_dtypes(file):
+    # The dtypes pandas infers for the whole file, and its header and first row as CSV text
+    df = pd.read_csv(file)
+    return df.dtypes.astype(str).to_dict(), df.iloc[:1].to_csv(index=False)
+
+def _map(function, items, workers):
+    if workers > 1 and len(items) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(function, items))
+    return [function(item) for item in items]
+
+def _read_csv_columns(file, columns=None):
+    return pd.read_csv(file, usecols=(lambda column: column in columns) if columns is not None else None)
+
+def read_csv_files(input_dir, columns=None, workers=1):
+    # The games of all CSV files of input_dir as one DataFrame, as combine_csv_files would write them, without
+    # writing the combined file (and without reading an earlier one); only the given columns are read
+    csv_files = csv_files_in(input_dir)
+    frames = _map(functools.partial(_read_csv_columns, columns=columns), csv_files, workers)
+    # One concatenation at the end, not one per file
+    return pd.concat([pd.DataFrame()] + frames, ignore_index=True)
+
+# Columns of the per-game data that the player stats use
+STATS_COLUMNS = ['White', 'Black', 'WhiteElo', 'BlackElo', 'WhiteResult', 'BlackResult',
+                 'white_gi', 'black_gi', 'white_gi_raw', 'black_gi_raw', 'white_gpl', 'black_gpl',
+                 'white_acpl', 'black_acpl', 'white_move_number', 'black_move_number']
+
+# Columns of player_stats.csv, in order
+PLAYER_STATS_COLUMNS = ['Player', 'avg_gi', 'avg_gpl', 'avg_acpl', 'total_game_count', 'Points', 'Elo', 'TPR', 'total_moves', 'White_games', 'Black_games', 'gi_median', 'gpl_median', 'acpl_median', 'gi_std', 'gpl_std', 'acpl_std', 'avg_gi_raw', 'white_gpl_sum', 'black_gpl_sum', 'white_acpl_sum', 'black_acpl_sum', 'white_result_sum', 'black_result_sum', 'total_gpl_sum', 'gi_var', 'gi_raw_median', 'gi_raw_var', 'gi_raw_std', 'gpl_var', 'acpl_var']
+
 # Functions
 def read_csv(file_path):
     return pd.read_csv(file_path)
 
+def read_games(games_path, workers=1):
+    # Read the per-game data from the converter's CSV (a file, or a directory of CSV files as combine_csv_files would
+    # combine them), or directly from the analyzer's .jsonl/.parquet output (a file or a directory), loading only the
+    # columns used for the player stats. A DataFrame of games is used as it is.
+    if isinstance(games_path, pd.DataFrame):
+        return games_path[[column for column in games_path.columns if column in STATS_COLUMNS]].copy()
+    if games_path.endswith('.csv'):
+        return pd.read_csv(games_path, usecols=lambda column: column in STATS_COLUMNS)
+    if os.path.isdir(games_path) and csv_files_in(games_path):
+        return read_csv_files(games_path, STATS_COLUMNS, workers)
+    return with_last_names(read_game_table(games_path, STATS_COLUMNS))
+
+def with_last_names(df):
+    # Player names as in the converter's CSV
+    df['White'] = df['White'].map(extract_last_name)
+    df['Black'] = df['Black'].map(extract_last_name)
+    return df
+
 def check_dataframe(df, df_name):
     print(f"Columns in {df_name}: {df.columns}")
 
@@ -88,8 +165,10 @@ def calculate_average_elo(df):
 
 def calculate_tpr(player_stats):
     threshold_prob = 0.75
-    player_stats['w_star'] = player_stats.apply(lambda row: optimize_w(row['Points'], row['total_game_count'], threshold_prob), axis=1)
-    player_stats['TPR'] = player_stats.apply(lambda row: round(calculate_EPR(row['w_star'], row['avg_opponent_elo']),0), axis=1)
+    # Batched optimize_w/calculate_EPR, solved once per distinct (Points, total_game_count)
+    with metrics.timer("stats.tpr", players=len(player_stats)):
+        player_stats['w_star'] = optimize_w_batch(player_stats['Points'], player_stats['total_game_count'], threshold_prob)
+        player_stats['TPR'] = np.round(calculate_EPR_batch(player_stats['w_star'], player_stats['avg_opponent_elo']), 0)
     return player_stats
 
 def merge_dataframes(dfs, merge_on='Player'):
@@ -108,14 +187,65 @@ def calculate_averages(player_stats):
 def save_to_csv(df, file_path):
     df.to_csv(file_path, index=False)
 
-# Main Functionality
-def main_stats(csv_all_games_path, player_stats_output_dir):
-    if not os.path.exists(csv_all_games_path):
-        print(f"File not found: {csv_all_games_path}")
-        return
-    df = read_csv(csv_all_games_path)
-    # check_dataframe(df, "Initial DataFrame")
+def games_by_player(df):
+    # Long table with one row per player per game: the White rows of all games, then the Black rows. Players are
+    # integer codes into the sorted array of player names.
+    n = len(df)
+    codes, players = pd.factorize(pd.concat([df['White'], df['Black']], ignore_index=True), sort=True)
+    def both(white_col, black_col):
+        return np.concatenate([df[white_col].to_numpy(), df[black_col].to_numpy()])
+    # Even keys are White rows, odd keys Black rows
+    long_df = pd.DataFrame({'player': codes, 'key': 2 * codes + np.repeat([0, 1], n)})
+    for metric in ['gi', 'gi_raw', 'gpl', 'acpl']:
+        long_df[metric] = both(f'white_{metric}', f'black_{metric}')
+    long_df['moves'] = both('white_move_number', 'black_move_number')
+    long_df['result'] = both('WhiteResult', 'BlackResult')
+    long_df['elo'] = both('WhiteElo', 'BlackElo')
+    long_df['opponent_elo'] = both('BlackElo', 'WhiteElo')
+    # Games without a player name are left out, as by groupby
+    return long_df[codes >= 0], players
+
+def calculate_player_stats(df):
+    # All columns of player_stats.csv from the long per-player table: sums, counts and average Elo from one groupby
+    # by player and color, medians and variances from one groupby by player
+    long_df, players = games_by_player(df)
+    by_color = long_df.groupby('key').agg(
+        games=('key', 'size'), gi_sum=('gi', 'sum'), gi_raw_sum=('gi_raw', 'sum'), gpl_sum=('gpl', 'sum'),
+        acpl_sum=('acpl', 'sum'), result_sum=('result', 'sum'), move_sum=('moves', 'sum'),
+        avg_elo=('elo', 'mean'), opponent_elo_sum=('opponent_elo', 'sum'))
+    by_player = long_df.groupby('player')[['gi', 'gi_raw', 'gpl', 'acpl']].agg(['median', 'var'])
+    by_player.columns = [f'{metric}_{statistic}' for metric, statistic in by_player.columns]
+    for metric in ['gi', 'gi_raw', 'gpl', 'acpl']:
+        # The groupby std is the square root of the var
+        by_player[f'{metric}_std'] = np.sqrt(by_player[f'{metric}_var'])
+
+    # Players who never had one color get 0 for it (and, as after the outer merges of the step-by-step version,
+    # the integer columns of that color become floats)
+    player_stats = by_player.fillna(0)
+    for color, parity in [('white', 0), ('black', 1)]:
+        color_stats = by_color[by_color.index % 2 == parity]
+        color_stats.index = color_stats.index // 2
+        color_stats = color_stats.reindex(player_stats.index).fillna(0)
+        player_stats = player_stats.join(color_stats.add_prefix(f'{color}_'))
+    player_stats.insert(0, 'Player', players[player_stats.index])
+    player_stats = player_stats.reset_index(drop=True)
+
+    player_stats['White_games'] = player_stats['white_games']
+    player_stats['Black_games'] = player_stats['black_games']
+    player_stats['total_game_count'] = player_stats['White_games'] + player_stats['Black_games']
+    player_stats['total_moves'] = player_stats['white_move_sum'] + player_stats['black_move_sum']
+    for metric in ['gi', 'gi_raw', 'gpl', 'acpl']:
+        player_stats[f'total_{metric}_sum'] = player_stats[f'white_{metric}_sum'] + player_stats[f'black_{metric}_sum']
+    player_stats['Points'] = player_stats['white_result_sum'] + player_stats['black_result_sum']
+    player_stats = calculate_averages(player_stats)
+    player_stats['avg_opponent_elo'] = (player_stats['white_opponent_elo_sum'] + player_stats['black_opponent_elo_sum']) / player_stats['total_game_count']
+    player_stats = calculate_tpr(player_stats)
+    white_elo, black_elo = player_stats['white_avg_elo'], player_stats['black_avg_elo']
+    player_stats['Elo'] = np.round(np.where((white_elo > 0) & (black_elo > 0), (white_elo + black_elo) / 2, np.maximum(white_elo, black_elo)), 0)
+    return player_stats[PLAYER_STATS_COLUMNS]
 
+def calculate_player_stats_by_merges(df):
+    # The original step-by-step version: one groupby per metric and color, joined with outer merges
     # Calculating Sums
     white_gi_sum = calculate_sum(df, 'White', 'white_gi', 'white_gi')
     black_gi_sum = calculate_sum(df, 'Black', 'black_gi', 'black_gi')
@@ -176,9 +306,31 @@ def main_stats(csv_all_games_path, player_stats_output_dir):
     player_stats = pd.merge(player_stats, average_elo, on='Player', how='left')
     
     # columns_to_include
-    columns_to_include = ['Player', 'avg_gi', 'avg_gpl', 'avg_acpl', 'total_game_count', 'Points', 'Elo', 'TPR', 'total_moves', 'White_games', 'Black_games', 'gi_median', 'gpl_median', 'acpl_median', 'gi_std', 'gpl_std', 'acpl_std', 'avg_gi_raw', 'white_gpl_sum', 'black_gpl_sum', 'white_acpl_sum', 'black_acpl_sum', 'white_result_sum', 'black_result_sum', 'total_gpl_sum', 'gi_var', 'gi_raw_median', 'gi_raw_var', 'gi_raw_std', 'gpl_var', 'acpl_var']
-    player_stats = player_stats[columns_to_include]
+    return player_stats[PLAYER_STATS_COLUMNS]
+
+# Main Functionality
+# csv_all_games_path can also be a directory of CSV files (read workers at a time, without combining them into one file
+# first), a DataFrame of games, or the analyzer's .jsonl/.parquet output (a file or a directory)
+# single_pass=False uses the original step-by-step calculation (same results, slower)
+@metrics.timed("stats")
+def main_stats(csv_all_games_path, player_stats_output_dir, single_pass=True, workers=1):
+    if not isinstance(csv_all_games_path, pd.DataFrame) and not os.path.exists(csv_all_games_path):
+        print(f"File not found: {csv_all_games_path}")
+        return
+    with metrics.timer("stats.read"):
+        df = read_games(csv_all_games_path, workers)
+    # check_dataframe(df, "Initial DataFrame")
+
+    with metrics.timer("stats.calculate", games=len(df)):
+        if single_pass:
+            player_stats = calculate_player_stats(df)
+        else:
+            player_stats = calculate_player_stats_by_merges(df)
+    with metrics.timer("stats.save", players=len(player_stats)):
+        save_player_stats(player_stats, player_stats_output_dir)
+    metrics.count("stats", games=len(df), players=len(player_stats))
 
+def save_player_stats(player_stats, player_stats_output_dir):
     # Ensure the output directory exists
     if not os.path.exists(player_stats_output_dir):
         os.makedirs(player_stats_output_dir)
@@ -0,0 +1,84 @@
+"""
+This script keeps a pool of long-lived UCI engine processes (e.g., Stockfish) so that games can be analyzed
+without paying the engine startup cost (process spawn, UCI handshake, NNUE load, hash allocation) for every game.
+The engine options (e.g., Threads and Hash) are set once per process, and an engine that crashes is restarted.
+"""
+
+import queue
+import threading
+from contextlib import contextmanager
+
+import chess.engine
+
+
+def _is_alive(engine):
+    try:
+        engine.ping()
+        return True
+    except Exception:
+        return False
+
+
+class EnginePool:
+    def __init__(self, engine_path, size=1, engine_options=None):
+        # engine_path can be the path to the executable or a command list, as accepted by popen_uci
+        self.engine_path = engine_path
+        self.size = size
+        # UCI options applied to every engine, e.g. {"Threads": 2, "Hash": 256}
+        self.engine_options = dict(engine_options or {})
+        self.restarts = 0
+        self._idle = queue.Queue()
+        self._engines = []
+        self._lock = threading.Lock()
+        for _ in range(size):
+            self._idle.put(self._start_engine())
+
+    def _start_engine(self):
+        engine = chess.engine.SimpleEngine.popen_uci(self.engine_path)
+        if self.engine_options:
+            engine.configure(self.engine_options)
+        with self._lock:
+            self._engines.append(engine)
+        return engine
+
+    def _restart_engine(self, engine):
+        # Replace a crashed engine with a fresh process
+        with self._lock:
+            if engine in self._engines:
+                self._engines.remove(engine)
+            self.restarts += 1
+        try:
+            engine.close()
+        except Exception:
+            pass
+        return self._start_engine()
+
+    @contextmanager
+    def engine(self):
+        # Borrow an idle engine for the duration of the block
+        engine = self._idle.get()
+        try:
+            yield engine
+        except Exception as exc:
+            # A dying engine can surface as EngineTerminatedError or as a cancelled analysis
+            if not _is_alive(engine):
+                engine = self._restart_engine(engine)
+                raise chess.engine.EngineTerminatedError(f"engine process died: {exc!r}") from exc
+            raise
+        finally:
+            self._idle.put(engine)
+
+    def close(self):
+        with self._lock:
+            engines, self._engines = self._engines, []
+        for engine in engines:
+            try:
+                engine.quit()
+            except Exception:
+                engine.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
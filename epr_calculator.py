@@ -1,6 +1,10 @@
 # Calculates Tournament Performance Rating (TPR) and Estimated Performance Rating (EPR) in cases of perfect or zero scores
+# optimize_w/optimize_w_plus take method='exact' to solve with log-space bisection and the inverse regularized incomplete
+# beta function instead of a numerical search; optimize_w_batch/optimize_w_plus_batch do the same for arrays
 import math
+import numpy as np
 from scipy.optimize import minimize_scalar
+from scipy.special import betainc, betaincinv, gammaln, xlog1py, xlogy
 
 def calculate_win_probability(A, B):
     return 1 / (1 + 10 ** ((B - A) / 400))
@@ -27,7 +31,12 @@ def calculate_score_plus_probability(w, m, n):
         total_probability += math.comb(n, k) * w ** k * (1 - w) ** (n - k)
     return total_probability
 
-def optimize_w(m, n, t):
+def optimize_w(m, n, t, method='minimize', tol=1e-12):
+    # method='exact' uses the structure of the binomial probability instead of a numerical search (see _optimize_w_unique):
+    # within tol of the optimum, O(log(1 / tol)) evaluations, and no overflow for large n
+    if method == 'exact':
+        return _optimize_w_exact(int(m), int(n), t, tol)
+
     def objective(w):
         score_prob = calculate_score_probability(w, m, n)
         if score_prob <= t:
@@ -38,7 +47,12 @@ def optimize_w(m, n, t):
     result = minimize_scalar(objective, bounds=(0, 1), method='bounded')
     return result.x
 
-def optimize_w_plus(m, n, t):
+def optimize_w_plus(m, n, t, method='minimize'):
+    # method='exact': the probability of scoring at least m is increasing in w, so the optimum is where it equals t,
+    # given in closed form by the inverse regularized incomplete beta function (see optimize_w_plus_batch)
+    if method == 'exact':
+        return float(optimize_w_plus_batch(m, n, t))
+
     def objective(w):
         score_plus_prob = calculate_score_plus_probability(w, m, n)
         if score_plus_prob <= t:
@@ -50,6 +64,95 @@ def optimize_w_plus(m, n, t):
     return result.x
 
 
+def log_score_probability(w, m, n):
+    # log of calculate_score_probability for arrays, in log space so that large n does not overflow
+    return gammaln(n + 1) - gammaln(m + 1) - gammaln(n - m + 1) + xlogy(m, w) + xlog1py(n - m, -w)
+
+def log_score_plus_probability(w, m, n):
+    # log of calculate_score_plus_probability: P(X >= m) for X ~ Binomial(n, w) is the regularized incomplete beta
+    # function I_w(m, n - m + 1), and 1 for m = 0
+    m, n, w = np.broadcast_arrays(np.asarray(m, dtype=float), np.asarray(n, dtype=float), np.asarray(w, dtype=float))
+    with np.errstate(divide='ignore'):
+        return np.where(m > 0, np.log(betainc(np.maximum(m, 1), n - m + 1, w)), 0.0)
+
+def _log_score_probability(w, m, n):
+    # Scalar log_score_probability
+    log_p = math.lgamma(n + 1) - math.lgamma(m + 1) - math.lgamma(n - m + 1)
+    if m:
+        log_p += m * math.log(w) if w > 0 else -math.inf
+    if n - m:
+        log_p += (n - m) * math.log1p(-w) if w < 1 else -math.inf
+    return log_p
+
+def _optimize_w_exact(m, n, t, tol=1e-12):
+    # Scalar version of _optimize_w_unique
+    if n == 0:
+        return math.nan
+    mode = m / n
+    log_t = math.log(t)
+    if _log_score_probability(mode, m, n) <= log_t:
+        return mode
+    inside, outside = mode, 1.0 if mode <= 0.5 else 0.0
+    while abs(outside - inside) > tol:
+        middle = (inside + outside) / 2
+        if _log_score_probability(middle, m, n) > log_t:
+            inside = middle
+        else:
+            outside = middle
+    return outside
+
+def _optimize_w_unique(m, n, t, tol=1e-12):
+    # The probability of scoring m out of n is largest at w = m / n. If it is at most t there, that is the answer;
+    # otherwise the answer is where it falls to t, found by bisection on the side of m / n towards 0.5 (the only side
+    # for zero and perfect scores, and the side minimize_scalar ends up on in optimize_w).
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mode = m / n
+        log_t = np.log(t)
+        w = mode.copy()
+        search = log_score_probability(mode, m, n) > log_t
+        inside = mode.copy()
+        outside = np.where(mode <= 0.5, 1.0, 0.0)
+        # The bracket starts at most 1 wide and halves every step
+        for _ in range(max(1, math.ceil(math.log2(1 / tol)))):
+            middle = (inside + outside) / 2
+            above = log_score_probability(middle, m, n) > log_t
+            inside = np.where(above, middle, inside)
+            outside = np.where(above, outside, middle)
+        w[search] = outside[search]
+    # No games: no w satisfies the constraint
+    w[n == 0] = np.nan
+    return w
+
+def optimize_w_batch(m, n, t):
+    # optimize_w for arrays of points m and games n (and thresholds t), computed once per distinct (m, n, t).
+    # Like optimize_w, half points are truncated (calculate_score_probability uses int(m)).
+    m, n, t = np.broadcast_arrays(np.trunc(np.asarray(m, dtype=float)), np.asarray(n, dtype=float), np.asarray(t, dtype=float))
+    combinations = np.stack([m.ravel(), n.ravel(), t.ravel()], axis=1)
+    unique, inverse = np.unique(combinations, axis=0, return_inverse=True)
+    w = _optimize_w_unique(unique[:, 0], unique[:, 1], unique[:, 2])
+    return w[inverse.ravel()].reshape(m.shape)
+
+def optimize_w_plus_batch(m, n, t):
+    # optimize_w_plus for arrays: the w at which scoring at least m out of n has probability t. Points are truncated
+    # to whole points as in optimize_w; with m = 0 that probability is always 1 and no w satisfies the constraint.
+    m, n, t = np.broadcast_arrays(np.trunc(np.asarray(m, dtype=float)), np.asarray(n, dtype=float), np.asarray(t, dtype=float))
+    w = betaincinv(np.maximum(m, 1), n - m + 1, t)
+    return np.where((m > 0) & (m <= n), w, np.nan)
+
+def calculate_EPR_batch(w_star, B):
+    return np.asarray(B, dtype=float) - 400 * np.log10((1 - np.asarray(w_star, dtype=float)) / w_star)
+
+def compare_with_optimize_w(m, n, t):
+    # Largest differences in w and in the rounded performance rating between optimize_w_batch and optimize_w
+    # (which is only defined while math.comb(n, m) fits in a float, i.e. up to about 1000 games)
+    m, n = np.asarray(m, dtype=float), np.asarray(n, dtype=float)
+    w_batch = optimize_w_batch(m, n, t)
+    w_scalar = np.array([optimize_w(points, games, t) for points, games in zip(m.tolist(), n.tolist())])
+    rating_batch = np.round(calculate_EPR_batch(w_batch, 2000), 0)
+    rating_scalar = np.array([round(calculate_EPR(w, 2000), 0) for w in w_scalar.tolist()])
+    return np.abs(w_batch - w_scalar).max(), np.abs(rating_batch - rating_scalar).max()
+
+
 # def calculate_EPR_old(w_star, B):
 #    return 400 * math.log10(-w_star * math.exp((B * math.log(10)) / 400) / (w_star - 1))
 
@@ -0,0 +1,123 @@
+"""
+This script provides a persistent cache of engine evaluations, keyed by the Zobrist hash of the position and the search depth.
+The cache is stored in an SQLite file so it is shared across games and across runs, and it is kept below a maximum
+number of entries by evicting the least recently used positions.
+Scores depend on the engine and its settings, so use one cache file per engine and engine settings.
+
+The engine is given the game's moves, so its score can depend on the history, not only on the position: a position
+that repeats an earlier one is scored as a draw, and so is one close to the fifty-move rule. Such positions are neither
+looked up nor stored. Other effects of the history (a repetition found inside the search, or an engine that scales its
+evaluation down as the halfmove clock grows) are not in the key, an approximation that the cache accepts.
+"""
+
+import sqlite3
+import threading
+
+import chess.polyglot
+
+
+def position_key(board):
+    # Zobrist hashes are unsigned 64-bit integers; SQLite integers are signed
+    key = chess.polyglot.zobrist_hash(board)
+    return key - (1 << 64) if key >= (1 << 63) else key
+
+
+def depends_on_history(board):
+    # True if the score of the position can depend on how it was reached (see above), so that it is not cached
+    return board.is_repetition(2) or board.can_claim_fifty_moves()
+
+
+class EvalCache:
+    def __init__(self, path, max_entries=1_000_000, commit_every=1000):
+        # Use one cache file per engine and engine settings: entries do not record which engine produced them
+        self.path = path
+        self.max_entries = max_entries
+        self.commit_every = commit_every
+        self.hits, self.misses, self.stores, self.evictions = 0, 0, 0, 0
+        self._lock = threading.Lock()
+        self._pending_writes = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS evals (
+                key INTEGER NOT NULL,
+                depth INTEGER NOT NULL,
+                cp INTEGER NOT NULL,
+                last_used INTEGER NOT NULL,
+                PRIMARY KEY (key, depth)
+            ) WITHOUT ROWID""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS evals_last_used ON evals (last_used)")
+        self._size, last_used = self._conn.execute("SELECT COUNT(*), COALESCE(MAX(last_used), 0) FROM evals").fetchone()
+        self._clock = last_used + 1
+
+    def get(self, board, depth):
+        # Return the cached score (centipawns, relative to the side to move) or None
+        if depends_on_history(board):
+            return None
+        key = position_key(board)
+        with self._lock:
+            row = self._conn.execute("SELECT cp FROM evals WHERE key = ? AND depth = ?", (key, depth)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute("UPDATE evals SET last_used = ? WHERE key = ? AND depth = ?", (self._tick(), key, depth))
+            self._wrote()
+            return row[0]
+
+    def put(self, board, depth, cp):
+        if depends_on_history(board):
+            return
+        key = position_key(board)
+        with self._lock:
+            cursor = self._conn.execute("INSERT OR IGNORE INTO evals (key, depth, cp, last_used) VALUES (?, ?, ?, ?)",
+                                        (key, depth, cp, self._tick()))
+            if cursor.rowcount:
+                self._size += 1
+            else:
+                self._conn.execute("UPDATE evals SET cp = ?, last_used = ? WHERE key = ? AND depth = ?", (cp, self._tick(), key, depth))
+            self.stores += 1
+            if self._size > self.max_entries:
+                self._evict()
+            self._wrote()
+
+    def _tick(self):
+        self._clock += 1
+        return self._clock
+
+    def _evict(self):
+        # Drop the least recently used entries, a batch at a time so eviction is not run on every insert
+        count = self._size - self.max_entries + max(1, self.max_entries // 100)
+        cursor = self._conn.execute("""
+            DELETE FROM evals WHERE (key, depth) IN (
+                SELECT key, depth FROM evals ORDER BY last_used LIMIT ?)""", (count,))
+        self._size -= cursor.rowcount
+        self.evictions += cursor.rowcount
+
+    def _wrote(self):
+        self._pending_writes += 1
+        if self._pending_writes >= self.commit_every:
+            self._conn.commit()
+            self._pending_writes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "entries": self._size,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
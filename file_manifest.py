@@ -0,0 +1,89 @@
+"""
+This script keeps a manifest of the input files a stage has processed: for each file, its size, modification time and
+SHA-256 content hash, the parameters that affect the results (e.g. wdl_values and weighted for the analyzer, the depth
+for the annotator) and the outputs written for it, with their sizes. On the next run, the stage skips the files whose
+outputs are still current and only processes new or changed ones.
+
+A file whose size and modification time are unchanged is taken as unchanged without reading it; otherwise its hash
+decides, so a file that was only touched or copied is not processed again.
+
+The analyzer and the annotator keep their manifests in their output directories (.analyzer_manifest and
+.annotator_manifest), and force=True processes every file again.
+"""
+
+import hashlib
+import json
+import os
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class FileManifest:
+    def __init__(self, path, params):
+        # path: JSON file of the manifest; params: JSON-serializable dict of the parameters that affect the outputs
+        self.path = path
+        self.params = json.loads(json.dumps(params))  # as it reads back from the file, e.g. tuples as lists
+        self._fingerprints = {}
+        try:
+            with open(path) as f:
+                self.entries = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.entries = {}
+
+    @staticmethod
+    def key(input_path):
+        return os.path.abspath(input_path)
+
+    def fingerprint(self, input_path):
+        # Size, modification time and hash of the input as it is now; kept for the rest of the run, so that an
+        # entry records the file as it was before it was processed
+        key = self.key(input_path)
+        if key not in self._fingerprints:
+            stat = os.stat(input_path)
+            entry = self.entries.get(key)
+            if entry is not None and (entry["size"], entry["mtime_ns"]) == (stat.st_size, stat.st_mtime_ns):
+                sha256 = entry["sha256"]
+            else:
+                sha256 = file_sha256(input_path)
+            self._fingerprints[key] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": sha256}
+        return self._fingerprints[key]
+
+    def entry(self, input_path):
+        return self.entries.get(self.key(input_path))
+
+    def is_current(self, input_path):
+        # True if the input and the parameters are those of the last run, and its outputs are still as written then
+        entry = self.entry(input_path)
+        if entry is None or entry["params"] != self.params:
+            return False
+        fingerprint = self.fingerprint(input_path)
+        if entry["sha256"] != fingerprint["sha256"]:
+            return False
+        for output_path, size in entry["outputs"].items():
+            if not os.path.exists(output_path) or os.path.getsize(output_path) != size:
+                return False
+        # The input may only have been touched since: keep its new modification time, so it is not hashed again
+        entry.update(fingerprint)
+        return True
+
+    def record(self, input_path, output_paths, **extra):
+        # Record that input_path was processed into output_paths, with stage-specific values such as a game count
+        entry = dict(self.fingerprint(input_path))
+        entry["params"] = self.params
+        entry["outputs"] = {os.path.abspath(output_path): os.path.getsize(output_path) for output_path in output_paths}
+        entry.update(extra)
+        self.entries[self.key(input_path)] = entry
+        self.save()
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        temp_path = self.path + ".tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(self.entries, f, indent=4)
+        os.replace(temp_path, self.path)
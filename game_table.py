@@ -0,0 +1,264 @@
+"""
+This script defines the fixed per-game schema of the analyzer's output and streams game rows in batches to
+JSON Lines (.jsonl) or Parquet (.parquet, requires pyarrow), and reads them back with column projection.
+
+Between the analysis of a game and its output, the analyzer keeps it as a compact GameRecord: the statistics in
+__slots__, the header strings interned (a player, event or site is stored once, however many games it has), Elo
+ratings as ints and the result as a small code. The JSON dict or the typed row of a game is only built when it is
+written (write_json_games, game_row).
+"""
+
+import json
+import os
+import sys
+
+import pandas as pd
+
+# Output columns, in order, with their pandas dtypes. Elo ratings and results are null when unknown.
+GAME_SCHEMA = [
+    ("key", "int64"),
+    ("white_gi", "float64"), ("black_gi", "float64"),
+    ("white_gpl", "float64"), ("black_gpl", "float64"),
+    ("white_acpl", "float64"), ("black_acpl", "float64"),
+    ("white_gi_raw", "float64"), ("black_gi_raw", "float64"),
+    ("white_move_number", "int32"), ("black_move_number", "int32"),
+    ("White", "string"), ("Black", "string"),
+    ("Event", "string"), ("Site", "string"), ("Round", "string"),
+    ("WhiteElo", "Int32"), ("BlackElo", "Int32"),
+    ("WhiteResult", "float64"), ("BlackResult", "float64"),
+    ("Date", "string"),
+]
+GAME_COLUMNS = [name for name, dtype in GAME_SCHEMA]
+GAME_DTYPES = dict(GAME_SCHEMA)
+GAME_TABLE_EXTENSIONS = (".jsonl", ".parquet")
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_float(value):
+    # Results of unfinished games are '...' in the JSON output
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+# Result codes of GameRecord.result, and the WhiteResult and BlackResult of each in the JSON output
+RESULT_CODES = {'1-0': 1, '0-1': 2, '1/2-1/2': 3}
+RESULT_POINTS = [('...', '...'), (1, 0), (0, 1), (0.5, 0.5)]
+
+_STATISTICS = ("white_gi", "black_gi", "white_gpl", "black_gpl", "white_acpl", "black_acpl",
+               "white_gi_raw", "black_gi_raw", "white_move_number", "black_move_number")
+
+
+def _intern(value):
+    return sys.intern(value) if type(value) is str else value
+
+
+def _compact_elo(value):
+    # An Elo header as an int if that gives back the same text (the JSON output keeps the header as it was), else
+    # the interned header
+    if type(value) is str and value.isascii() and value.isdigit() and str(int(value)) == value:
+        return int(value)
+    return _intern(value)
+
+
+class GameRecord:
+    # One analyzed game (see analyze_game in pgn_evaluation_fast_analyzer.py)
+    __slots__ = _STATISTICS + ("white", "black", "event", "site", "round", "white_elo", "black_elo", "date", "result")
+
+    def __init__(self, statistics, headers, result):
+        # statistics: the values of _STATISTICS; headers: White, Black, Event, Site, Round, WhiteElo, BlackElo and
+        # Date (None when missing; Elo ratings as header text or ints); result: a code of RESULT_CODES (0 for others)
+        for name, value in zip(_STATISTICS, statistics):
+            setattr(self, name, value)
+        white, black, event, site, round_, white_elo, black_elo, date = headers
+        self.white = _intern(white)
+        self.black = _intern(black)
+        self.event = _intern(event)
+        self.site = _intern(site)
+        self.round = _intern(round_)
+        self.white_elo = _compact_elo(white_elo)
+        self.black_elo = _compact_elo(black_elo)
+        self.date = _intern(date)
+        self.result = result
+
+    def __reduce__(self):
+        # Pickled as plain tuples (the analyzer's worker processes send records back), and interned again on arrival
+        return GameRecord, (self.statistics(), self.headers(), self.result)
+
+    def statistics(self):
+        return tuple(getattr(self, name) for name in _STATISTICS)
+
+    def headers(self):
+        return self.white, self.black, self.event, self.site, self.round, self.white_elo, self.black_elo, self.date
+
+    def as_dict(self):
+        # The game as in the analyzer's JSON output
+        game_data = dict(zip(_STATISTICS, self.statistics()))
+        white_result, black_result = RESULT_POINTS[self.result]
+        game_data.update({
+            "White": self.white, "Black": self.black, "Event": self.event, "Site": self.site, "Round": self.round,
+            "WhiteElo": _elo_text(self.white_elo), "BlackElo": _elo_text(self.black_elo),
+            "WhiteResult": white_result, "BlackResult": black_result, "Date": self.date,
+        })
+        return game_data
+
+
+def _elo_text(value):
+    return str(value) if type(value) is int else value
+
+
+def game_row(key, record):
+    # Convert one game of the analyzer (a GameRecord) to a typed row of GAME_COLUMNS
+    white_result, black_result = RESULT_POINTS[record.result]
+    row = {"key": key}
+    row.update(zip(_STATISTICS, record.statistics()))
+    row.update({
+        "White": record.white, "Black": record.black, "Event": record.event, "Site": record.site,
+        "Round": record.round, "WhiteElo": _to_int(record.white_elo), "BlackElo": _to_int(record.black_elo),
+        "WhiteResult": _to_float(white_result), "BlackResult": _to_float(black_result), "Date": record.date,
+    })
+    return row
+
+
+def write_json_games(path, records, first_key):
+    # Write games as the analyzer's JSON output, {key: game dict} numbered from first_key, the same text as
+    # json.dump(..., indent=4) of the whole dict, but building one game's dict at a time
+    with open(path, 'w') as f:
+        separator = "{\n    "
+        for key, record in enumerate(records, first_key):
+            game_json = json.dumps(record.as_dict(), indent=4).replace("\n", "\n    ")
+            f.write(separator + json.dumps(str(key)) + ": " + game_json)
+            separator = ",\n    "
+        f.write("{}" if separator == "{\n    " else "\n}")
+
+
+class JsonLinesGameWriter:
+    def __init__(self, path, batch_size=10000):
+        self.path = path
+        self.batch_size = batch_size
+        self.rows_written = 0
+        self._batch = []
+        self._handle = open(path, 'w', encoding='utf-8')
+
+    def write(self, row):
+        self._batch.append(json.dumps(row, ensure_ascii=False))
+        if len(self._batch) >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        if self._batch:
+            self._handle.write("\n".join(self._batch) + "\n")
+            self.rows_written += len(self._batch)
+            self._batch = []
+
+    def close(self):
+        self._flush()
+        self._handle.close()
+
+
+def _arrow_schema():
+    import pyarrow as pa
+    types = {"int64": pa.int64(), "int32": pa.int32(), "Int32": pa.int32(), "float64": pa.float64(), "string": pa.string()}
+    return pa.schema([(name, types[dtype]) for name, dtype in GAME_SCHEMA])
+
+
+class ParquetGameWriter:
+    def __init__(self, path, batch_size=10000):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError as error:
+            raise ImportError("Parquet output requires pyarrow (pip install pyarrow)") from error
+        self.path = path
+        self.batch_size = batch_size
+        self.rows_written = 0
+        self._batch = []
+        self._schema = _arrow_schema()
+        self._writer = pq.ParquetWriter(path, self._schema)
+
+    def write(self, row):
+        self._batch.append(row)
+        if len(self._batch) >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        import pyarrow as pa
+        if self._batch:
+            self._writer.write_batch(pa.RecordBatch.from_pylist(self._batch, schema=self._schema))
+            self.rows_written += len(self._batch)
+            self._batch = []
+
+    def close(self):
+        self._flush()
+        self._writer.close()
+
+
+def open_game_writer(path, batch_size=10000):
+    if path.endswith(".parquet"):
+        return ParquetGameWriter(path, batch_size)
+    return JsonLinesGameWriter(path, batch_size)
+
+
+def renumber_game_table(path, shift):
+    # Add shift to the key of every game of a .jsonl or .parquet file, e.g. when games were added to an earlier file
+    temp_path = path + ".tmp"
+    if path.endswith(".parquet"):
+        import pyarrow.compute as pc
+        import pyarrow.parquet as pq
+        table = pq.read_table(path)
+        keys = pc.add(table.column("key"), shift)
+        pq.write_table(table.set_column(table.schema.get_field_index("key"), "key", keys), temp_path)
+    else:
+        with open(path, encoding='utf-8') as f, open(temp_path, 'w', encoding='utf-8') as out:
+            for line in f:
+                if line.strip():
+                    row = json.loads(line)
+                    row["key"] += shift
+                    out.write(json.dumps(row, ensure_ascii=False) + "\n")
+    os.replace(temp_path, path)
+
+
+def _game_table_paths(directory):
+    # The game tables of a directory, one per PGN file: if a file has both a .jsonl and a .parquet table (outputs of
+    # runs with different output formats), only the newer one, so that its games are not counted twice
+    tables = {}
+    for dirpath, dirnames, filenames in os.walk(directory):
+        for filename in filenames:
+            stem, extension = os.path.splitext(filename)
+            if extension in GAME_TABLE_EXTENSIONS:
+                file_path = os.path.join(dirpath, filename)
+                tables.setdefault(os.path.join(dirpath, stem), []).append(file_path)
+    return [max(file_paths, key=lambda file_path: os.stat(file_path).st_mtime_ns) for file_paths in tables.values()]
+
+
+def read_game_table(path, columns=None):
+    # Read a .jsonl or .parquet file of the analyzer (or a directory of them), keeping only the given columns
+    if os.path.isdir(path):
+        paths = sorted(_game_table_paths(path))
+        frames = [read_game_table(file_path, columns) for file_path in paths]
+        if not frames:
+            return pd.DataFrame({name: pd.Series(dtype=GAME_DTYPES[name]) for name in (columns or GAME_COLUMNS)})
+        return pd.concat(frames, ignore_index=True)
+    if path.endswith(".parquet"):
+        df = pd.read_parquet(path, columns=columns)
+        return df.astype({name: GAME_DTYPES[name] for name in df.columns if name in GAME_DTYPES})
+    columns = columns or GAME_COLUMNS
+    data = {name: [] for name in columns}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                row = json.loads(line)
+                for name in columns:
+                    data[name].append(row.get(name, None))
+    return game_frame(data)
+
+
+def game_frame(data):
+    # DataFrame of game rows given column by column ({name: list of values}), with the dtypes of GAME_SCHEMA
+    return pd.DataFrame({name: pd.Series(values, dtype=GAME_DTYPES.get(name)) for name, values in data.items()})
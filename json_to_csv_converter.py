@@ -1,13 +1,26 @@
 """This script inputs the JSON files generated by pgn_evaluation_fast_analyzer.py and outputs a CSV file
 containing the following columns:
 - White, Black, WhiteElo, BlackElo, WhiteResult, BlackResult, gi, gpl, acpl, white_move_number, black_move_number
+
+By default each JSON file is loaded into a DataFrame at once (workers files in parallel), player names are shortened
+once per distinct name, and the rows are appended to the CSV file by file, so the CSV is the same as the original
+game-by-game conversion (bulk=False) without holding every game in memory.
 """
 
+import functools
 import json
 import os
+import pickle
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 import pandas as pd
 from pandas import json_normalize
 
+import metrics
+
 def extract_last_name(full_name):
     if not full_name:
         return ''
@@ -20,6 +33,12 @@ def extract_last_name(full_name):
 
     return last_name
 
+def extract_last_names(names):
+    # extract_last_name over a column of names, computed once per distinct name
+    codes, uniques = pd.factorize(names.fillna(''))
+    last_names = np.array([extract_last_name(name) for name in uniques] + [''], dtype=object)
+    return last_names[codes]
+
 def process_json_file(json_file_path, data_list):
     try:
         with open(json_file_path, 'r') as f:
@@ -42,7 +61,113 @@ def process_json_file(json_file_path, data_list):
     except Exception as e:
         print(f'Error processing {json_file_path}: {e}')
 
-def main_json_to_csv(directory_path, csv_output_dir):
+def read_json_records(json_file_path):
+    # The games of a JSON file as a list of dicts, or None for an empty or invalid file
+    try:
+        with open(json_file_path, 'r') as f:
+            all_data = json.load(f)
+    except Exception as e:
+        print(f'Error processing {json_file_path}: {e}')
+        return None
+    if not all_data:
+        print(f"No data found in {json_file_path}")
+        return None
+    records = list(all_data.values())
+    for data in records:
+        # Missing names become empty columns at the end of the record, as in process_json_file
+        data.setdefault('White', None)
+        data.setdefault('Black', None)
+    return records
+
+def records_frame(records):
+    # Bulk version of process_json_file: one DataFrame for all games of a file, built directly from the records
+    if any(isinstance(value, dict) for value in records[0].values()):
+        # Nested values are flattened into dotted columns, as json_normalize does per game
+        data_frame = json_normalize(records)
+    else:
+        data_frame = pd.DataFrame.from_records(records)
+    data_frame['White'] = extract_last_names(data_frame['White'])
+    data_frame['Black'] = extract_last_names(data_frame['Black'])
+    return data_frame
+
+def load_json_file(json_file_path):
+    records = read_json_records(json_file_path)
+    return None if records is None else records_frame(records)
+
+def iter_json_files(directory_path):
+    for root, dirs, files in os.walk(directory_path):
+        for file in files:
+            if file.endswith('.json'):
+                yield os.path.join(root, file)
+
+def _map_in_order(function, items, workers):
+    # map(function, items), in workers processes with more than one, with at most 2 * workers results held at a time
+    if workers <= 1 or len(items) <= 1:
+        yield from map(function, items)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(function, item))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def _json_file_dtypes(json_file_path):
+    # First pass of the bulk conversion: the first row of the file's DataFrame, which carries its column dtypes, and
+    # its number of games, or None for an empty or invalid file. The row goes through pickle, as it does from a worker
+    # process: a copy of the slice would keep the file's whole string buffers alive
+    data_frame = load_json_file(json_file_path)
+    if data_frame is None:
+        return None
+    return pickle.loads(pickle.dumps(data_frame.iloc[:1])), len(data_frame)
+
+def _json_file_csv(json_file_path, columns, dtypes, chunk_size):
+    # Second pass: the file's games as CSV rows (without the header) with the columns and dtypes of the concatenation
+    # of all files, i.e. as pd.concat would have written them. In a column that is object in the concatenation (e.g.
+    # results with unfinished games, '...'), every game keeps its own value, as with the game-by-game concatenation,
+    # rather than the file's common dtype (a file with a draw has float results, which would write 1.0 instead of 1)
+    records = read_json_records(json_file_path)
+    if records is None:
+        return ''
+    data_frame = records_frame(records).reindex(columns=columns)
+    for column in columns:
+        if dtypes[column] == object and data_frame[column].dtype != object and column in records[0]:
+            data_frame[column] = pd.Series([record.get(column) for record in records], dtype=object)
+    return data_frame.astype(dtypes).to_csv(None, header=False, index=False, chunksize=chunk_size)
+
+@metrics.timed("convert")
+def main_json_to_csv(directory_path, csv_output_dir, bulk=True, workers=1, chunk_size=100000):
+    # bulk: build one DataFrame per JSON file (loaded by workers processes) and write the CSV in chunks of chunk_size rows.
+    # The files are read twice, first for the column dtypes of the whole output and then for the rows, so only a few
+    # files' games are held in memory at a time. bulk=False is the original game-by-game conversion, kept for comparison
+    start_time = time.perf_counter()
+    if bulk:
+        json_file_paths = list(iter_json_files(directory_path))
+        file_dtypes = [result for result in _map_in_order(_json_file_dtypes, json_file_paths, workers) if result is not None]
+        games = sum(file_games for first_row, file_games in file_dtypes)
+        loaded_time = time.perf_counter()
+        metrics.add("convert.load", loaded_time - start_time, files=len(json_file_paths), games=games)
+        if not file_dtypes:
+            print("No JSON files found or all files are empty.")
+            return
+        first_rows = [first_row for first_row, file_games in file_dtypes]
+        columns = list(dict.fromkeys(column for first_row in first_rows for column in first_row.columns))
+        dtypes = pd.concat(first_rows, ignore_index=True)[columns].dtypes
+        if not os.path.exists(csv_output_dir):
+            os.makedirs(csv_output_dir)
+        csv_output_file = os.path.join(csv_output_dir, 'aggregated_game_data.csv')
+        write_rows = functools.partial(_json_file_csv, columns=columns, dtypes=dtypes, chunk_size=chunk_size)
+        with open(csv_output_file, 'w', newline='') as f:
+            f.write(pd.DataFrame(columns=columns).to_csv(index=False))
+            for rows in _map_in_order(write_rows, json_file_paths, workers):
+                f.write(rows)
+        metrics.add("convert.write", time.perf_counter() - loaded_time, games=games)
+        metrics.count("convert", files=len(json_file_paths), games=games)
+        print(f"Data saved to {csv_output_file}")
+        return
+
     data_list = []
 
     # Walk through the directory and its subdirectories
@@ -65,4 +190,5 @@ def main_json_to_csv(directory_path, csv_output_dir):
     # Define the output CSV file path within the output directory
     csv_output_file = os.path.join(csv_output_dir, 'aggregated_game_data.csv')
     data_frame.to_csv(csv_output_file, index=False)
+    metrics.count("convert", games=len(data_frame))
     print(f"Data saved to {csv_output_file}")
@@ -1,50 +1,117 @@
 # Main function for the Fast GI calculator
 from pgn_evaluation_fast_analyzer import main
 from stockfish_pgn_annotator import main_stockfish
+from async_annotator import main_stockfish_async
 from csv_to_player_stats import main_stats
 from json_to_csv_converter import main_json_to_csv
+from adaptive_search import AdaptiveSearch
+import metrics
+import os
 import time
 
-start_time = time.time()
-
-# If the games are annotated with Stockfish, set this to True
-games_annotated = True
-
-if not games_annotated:
-    # Set the dir paths for the PGN files and the output directory
-    input_dir_path = ''
-    output_directory = ''
-    # set the path to the Stockfish executable
-    # e.g.: 'C:\...\stockfish-windows-x86-64-avx2\stockfish\stockfish-windows-x86-64-avx2.exe'
-    stockfish_path = ''
-    # Set the depth for the Stockfish analysis
-    DEPTH = 20
-    # Call the main function to annotate the games
-    main_stockfish(input_dir_path, output_directory, stockfish_path, DEPTH)
-
-# Set the input and output directories for the Fast GI calculator
-input_pgn_dir = '...'
-# Change the output directory if needed
-output_json_dir = input_pgn_dir
-# Set whether the GI score should be weighted by opponent's Elo
-weighted = True
-# Input win, draw, and loss values. Standard FIDE: [1, 0.5, 0]. Norway Chess: [3, 1.25, 0] (will be normalized by 1/3; Armageddon score added manually).
-# In case of Norway Chess with Armageddon (weighted: False), correct raw_GI score by 157.57 +18.55*(raw_GI+armageddon_score/total_games)
-wdl_values = [1, 0.5, 0]
-main(input_pgn_dir, output_json_dir, wdl_values, weighted)
-
-# Set the input and output directories for the JSON to CSV converter
-json_input_dir = '...'
-csv_output_dir = '...'
-main_json_to_csv(json_input_dir, csv_output_dir)
-
-# Set the input and output directories for the player stats 
-#If multiple CSVs set input_dir, otherwise, set csv_all_games_path 
-# input_dir = "..."
-# csv_all_games_path = combine_csv_files(input_dir, output_filename='combined.csv')
-csv_all_games_path = '...'
-player_stats_output_dir = '...'
-main_stats(csv_all_games_path, player_stats_output_dir)
-
-end_time = time.time()
-print("Script finished in {:.2f} minutes".format((end_time - start_time) / 60.0))
+# Guarded so that worker processes started by the analyzer do not run the script again
+if __name__ == "__main__":
+    start_time = time.time()
+    # Optional JSON file the timers and counters of every stage are saved to at the end, e.g. 'metrics_report.json'
+    # (None: no report).
+    # PROFILE adds a cProfile profile of the main process (also saved to <report>.prof), TRACE_MEMORY the memory
+    # high-water mark of each stage and the largest allocations; both slow the run down.
+    METRICS_REPORT = None
+    PROFILE = False
+    TRACE_MEMORY = False
+    metrics.start(profile=PROFILE, trace_memory=TRACE_MEMORY)
+
+    # If the games are annotated with Stockfish, set this to True
+    games_annotated = True
+
+    if not games_annotated:
+        # Set the dir paths for the PGN files and the output directory
+        input_dir_path = ''
+        output_directory = ''
+        # set the path to the Stockfish executable
+        # e.g.: 'C:\...\stockfish-windows-x86-64-avx2\stockfish\stockfish-windows-x86-64-avx2.exe'
+        stockfish_path = ''
+        # Set the depth for the Stockfish analysis
+        DEPTH = 20
+        # Number of engine processes kept alive for the whole run, and the UCI options of each engine
+        POOL_SIZE = 1
+        ENGINE_OPTIONS = {"Threads": 1, "Hash": 256}
+        # Optional SQLite file caching evaluations across games and runs (None to disable), and its maximum number of positions
+        CACHE_PATH = None
+        CACHE_SIZE = 1_000_000
+        # Set to True to continue an interrupted run: finished files are skipped, unfinished ones resume from their checkpoint
+        RESUME = False
+        # Optional adaptive search budgets, e.g. AdaptiveSearch(shallow_depth=8, tolerance=0.02, nodes_per_game=50_000_000);
+        # None searches every position at DEPTH
+        ADAPTIVE = None
+        # Files annotated by an earlier run with the same settings are skipped unless they changed; True annotates all again
+        FORCE = False
+        # Optional query selecting the games to annotate through the PGN index (see pgn_index.py), e.g. {"has_evals": False}
+        # or {"player": "Carlsen, Magnus", "year": 2024}; None annotates every game
+        QUERY = None
+        # Call the main function to annotate the games
+        main_stockfish(input_dir_path, output_directory, stockfish_path, DEPTH, POOL_SIZE, ENGINE_OPTIONS, CACHE_PATH, CACHE_SIZE, RESUME, ADAPTIVE, FORCE,
+                       QUERY)
+        # Alternatively, the asyncio annotator (see async_annotator.py), with POOL_SIZE engines driven from one event loop
+        # (same output; no adaptive search); schedule='positions' spreads the positions of all games over the engines:
+        # main_stockfish_async(input_dir_path, output_directory, stockfish_path, DEPTH, POOL_SIZE, ENGINE_OPTIONS, CACHE_PATH,
+        #                      CACHE_SIZE, RESUME, FORCE, QUERY, schedule='games', position_timeout=None)
+
+    # Set the input and output directories for the Fast GI calculator
+    input_pgn_dir = '...'
+    # Change the output directory if needed
+    output_json_dir = input_pgn_dir
+    # Set whether the GI score should be weighted by opponent's Elo
+    weighted = True
+    # Input win, draw, and loss values. Standard FIDE: [1, 0.5, 0]. Norway Chess: [3, 1.25, 0] (will be normalized by 1/3; Armageddon score added manually).
+    # In case of Norway Chess with Armageddon (weighted: False), correct raw_GI score by 157.57 +18.55*(raw_GI+armageddon_score/total_games)
+    wdl_values = [1, 0.5, 0]
+    # True reads headers and evaluations with the lightweight scanner instead of building python-chess game trees:
+    # the same results (main(..., validate_scan=True) checks them), somewhat faster. 'unchecked' does not parse the
+    # moves either: several times faster, but only right for games without illegal moves, e.g. the annotator's output
+    fast_scan = False
+    # Number of worker processes for the analysis, e.g. os.cpu_count(); with more than one, large PGN files are split
+    # into chunks of about chunk_size bytes
+    workers = 1
+    chunk_size = 64 * 1024 * 1024
+    # 'json' (one JSON file per PGN file), or 'jsonl'/'parquet' to stream typed rows that main_stats can read directly
+    output_format = 'json'
+    # Files analyzed by an earlier run with the same settings are skipped unless they changed; True analyzes all again
+    force = False
+    # Directory for the per-move data (ply, mover, eval, expectations, point loss) of every game, or None;
+    # read it back with ply_table.PlyTable / read_player_moves
+    ply_output_dir = None
+    # Optional query selecting the games to analyze through the PGN index (see pgn_index.py), e.g. {"player": "...",
+    # "date_from": "2024.01.01", "date_to": "2024.12.31"}; None analyzes every game
+    query = None
+    main(input_pgn_dir, output_json_dir, wdl_values, weighted, fast_scan, workers=workers, chunk_size=chunk_size,
+         output_format=output_format, force=force, ply_output_dir=ply_output_dir, query=query)
+
+    # Set the input and output directories for the JSON to CSV converter
+    json_input_dir = '...'
+    csv_output_dir = '...'
+    main_json_to_csv(json_input_dir, csv_output_dir, workers=workers)
+
+    # Set the input and output directories for the player stats 
+    #If multiple CSVs set input_dir, otherwise, set csv_all_games_path 
+    # With output_format 'jsonl' or 'parquet', csv_all_games_path can be output_json_dir and the converter step skipped
+    # input_dir = "..."
+    # csv_all_games_path = input_dir  # main_stats reads all CSVs of the directory, no combined file needed
+    # csv_all_games_path = combine_csv_files(input_dir, output_filename='combined.csv', workers=workers)
+    csv_all_games_path = '...'
+    player_stats_output_dir = '...'
+    main_stats(csv_all_games_path, player_stats_output_dir, workers=workers)
+    # To add only the new games of each run to the stats kept in an SQLite store instead:
+    # from player_stats_store import main_stats_incremental
+    # main_stats_incremental(csv_new_games_path, 'player_stats.db', player_stats_output_dir)
+
+    # Alternatively, all of the above in one streaming pass, without the intermediate files (the annotated PGN and the
+    # per-game table are optional outputs); leave stockfish_path out if the games are already annotated:
+    # from pipeline import run_pipeline
+    # run_pipeline(input_dir_path, player_stats_output_dir, wdl_values, weighted, stockfish_path=stockfish_path, depth=DEPTH,
+    #              pool_size=POOL_SIZE, engine_options=ENGINE_OPTIONS, annotated_output_dir=None, games_output_dir=None)
+
+    end_time = time.time()
+    print("Script finished in {:.2f} minutes".format((end_time - start_time) / 60.0))
+    if METRICS_REPORT:
+        metrics.write_report(METRICS_REPORT)
@@ -0,0 +1,184 @@
+"""
+This script records where the time of a run goes: per-stage timers and counters (games, plies, engine nodes, ...)
+with their rates, values such as the evaluation cache statistics, and optionally a cProfile profile and tracemalloc
+memory high-water marks. The stages of the annotator, analyzer, converter and player stats report to it, and
+write_report saves everything as a JSON file so that runs can be compared.
+
+Stage names are dotted: "analyze" is the whole analyzer run, "analyze.parse" and "analyze.evaluate" are its parts.
+Recording is always on and cheap; profiling and memory tracing only when start() asks for them.
+"""
+
+import cProfile
+import functools
+import io
+import json
+import platform
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+
+class Stage:
+    def __init__(self):
+        self.seconds = 0.0
+        self.calls = 0
+        self.counts = {}
+        self.peak_memory = None  # bytes above the memory in use at the start, top-level stages only, when tracing memory
+
+    def as_dict(self):
+        stage = {"seconds": round(self.seconds, 6), "calls": self.calls, "counts": dict(self.counts)}
+        if self.seconds > 0:
+            stage["rates"] = {f"{name}_per_second": round(count / self.seconds, 3) for name, count in self.counts.items()}
+        if self.peak_memory is not None:
+            stage["peak_memory_mb"] = round(self.peak_memory / 1e6, 3)
+        return stage
+
+
+class Metrics:
+    def __init__(self, profile=False, trace_memory=False):
+        self.started = datetime.now(timezone.utc)
+        self._start = time.perf_counter()
+        self.stages = {}
+        self.values = {}
+        self._lock = threading.Lock()
+        # cProfile sees the thread that called start() only; stage threads and worker processes are not profiled
+        self._profiler = cProfile.Profile() if profile else None
+        self.trace_memory = trace_memory
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if self._profiler is not None:
+            self._profiler.enable()
+
+    def _stage(self, name):
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = Stage()
+        return stage
+
+    def add(self, name, seconds=0.0, calls=1, **counts):
+        # Add time and counts to a stage, e.g. add("annotate.engine", 0.25, positions=1, nodes=120000)
+        with self._lock:
+            stage = self._stage(name)
+            stage.seconds += seconds
+            stage.calls += calls
+            for key, count in counts.items():
+                stage.counts[key] = stage.counts.get(key, 0) + count
+
+    def count(self, name, **counts):
+        self.add(name, 0.0, 0, **counts)
+
+    def set_values(self, name, **values):
+        # Values that are not counted up, e.g. set_values("eval_cache", hits=..., hit_rate=...)
+        with self._lock:
+            self.values.setdefault(name, {}).update(values)
+
+    @contextmanager
+    def timer(self, name, **counts):
+        # Time a block as one call of the stage. Top-level stages also record their memory high-water mark.
+        top_level = self.trace_memory and "." not in name and tracemalloc.is_tracing()
+        if top_level:
+            tracemalloc.reset_peak()
+            memory_at_start = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start, **counts)
+            if top_level:
+                peak = tracemalloc.get_traced_memory()[1] - memory_at_start
+                with self._lock:
+                    stage = self._stage(name)
+                    stage.peak_memory = max(stage.peak_memory or 0, peak)
+
+    def stop(self):
+        if self._profiler is not None:
+            self._profiler.disable()
+
+    def report(self, top=30):
+        self.stop()
+        report = {
+            "started": self.started.isoformat(timespec="seconds"),
+            "seconds": round(time.perf_counter() - self._start, 6),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "stages": {name: stage.as_dict() for name, stage in sorted(self.stages.items())},
+            "values": self.values,
+        }
+        if self._profiler is not None:
+            report["profile"] = _profile_summary(self._profiler, top)
+        if self.trace_memory and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            report["memory"] = {
+                "current_mb": round(current / 1e6, 3),
+                "peak_mb": round(peak / 1e6, 3),
+                "top": [{"location": str(stat.traceback[0]), "size_mb": round(stat.size / 1e6, 3), "blocks": stat.count}
+                        for stat in tracemalloc.take_snapshot().statistics("lineno")[:top]],
+            }
+        return report
+
+
+def _profile_summary(profiler, top):
+    # The functions with the largest cumulative time
+    stats = pstats.Stats(profiler, stream=io.StringIO())
+    rows = []
+    for (filename, line, function), (primitive_calls, calls, total, cumulative, callers) in stats.stats.items():
+        rows.append({"function": f"{filename}:{line}({function})", "calls": calls,
+                     "total_seconds": round(total, 6), "cumulative_seconds": round(cumulative, 6)})
+    rows.sort(key=lambda row: row["cumulative_seconds"], reverse=True)
+    return rows[:top]
+
+
+# The metrics of the current run; start() begins a new one
+_metrics = Metrics()
+
+
+def start(profile=False, trace_memory=False):
+    global _metrics
+    _metrics.stop()
+    _metrics = Metrics(profile, trace_memory)
+    return _metrics
+
+
+def current():
+    return _metrics
+
+
+def add(name, seconds=0.0, calls=1, **counts):
+    _metrics.add(name, seconds, calls, **counts)
+
+
+def count(name, **counts):
+    _metrics.count(name, **counts)
+
+
+def set_values(name, **values):
+    _metrics.set_values(name, **values)
+
+
+def timer(name, **counts):
+    return _metrics.timer(name, **counts)
+
+
+def timed(name):
+    # Decorator timing every call of a function as one call of the stage
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with _metrics.timer(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def write_report(path, top=30):
+    # Save the report of the current run as JSON; with profiling, the raw profile is also saved to <path>.prof
+    report = _metrics.report(top)
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=4)
+    if _metrics._profiler is not None:
+        _metrics._profiler.dump_stats(str(path) + ".prof")
+    print(f"Metrics report saved to {path}")
+    return report
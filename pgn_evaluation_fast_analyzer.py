@@ -1,14 +1,37 @@
 """
 This script inputs the PGN files with games annotated with Stockfish and outputs a JSON file including calculations of stats such as GI, GPL, ACPL, etc. for each game. 
+
+With fast_scan=True, the headers and [%eval] annotations are read by pgn_scanner.py straight from the PGN text instead
+of building python-chess game trees, and validate_scan=True cross-checks the scanner against python-chess.
+fast_scan='unchecked' does not parse the SAN moves either, which is several times faster; it gives the same results
+only if every move is legal (an illegal move ends a game's mainline in python-chess), e.g. for the annotator's output,
+so run it with validate_scan=True on a new source of PGN files.
+
+With workers > 1, the files (and byte-range chunks of large files, aligned on [Event lines) are analyzed by a process
+pool, and the results are merged in the original order.
 """
 
 import chess
 import chess.pgn
 import chess.engine
+import io
+import itertools
 import json
 import os
+from concurrent.futures import ProcessPoolExecutor
 from chess.engine import Cp, Wdl
+import numpy as np
 import time
+import metrics
+from wdl_model import attach_expectation_table, expectation_table, share_expectation_table
+from file_manifest import FileManifest
+from pgn_index import PGN_INDEX, select_games
+from game_table import RESULT_CODES, GameRecord, game_row, open_game_writer, renumber_game_table, write_json_games
+from ply_table import PLY_TABLE_EXTENSION, PlyTableWriter, renumber_ply_table
+from pgn_scanner import pawns_list_from_evals, scan_games, validate_scanner
+
+# Manifest of the analyzed files, in the output directory (without a .json extension, so the converter ignores it)
+ANALYZER_MANIFEST = '.analyzer_manifest'
 
 
 # Function to extract the evaluation from a node
@@ -46,6 +69,17 @@ def calculate_acpl(pawns_list):
     black_acpl = sum(black_losses) / len(black_losses) if black_losses else 0
     return white_acpl, black_acpl
 
+# Vectorized calculate_acpl, with identical results
+def calculate_acpl_vectorized(pawns_list):
+    pawns = np.asarray(pawns_list, dtype=float)
+    centipawn_losses = 100 * (pawns[1:] - pawns[:-1])
+    white_losses = -centipawn_losses[0::2]  # White's moves are at odd indices of pawns_list
+    black_losses = centipawn_losses[1::2]
+    # The built-in sum adds in the same order (and with the same accuracy) as calculate_acpl
+    white_acpl = sum(white_losses.tolist()) / len(white_losses) if len(white_losses) else 0
+    black_acpl = sum(black_losses.tolist()) / len(black_losses) if len(black_losses) else 0
+    return white_acpl, black_acpl
+
 def calculate_gi_by_result(white_gpl, black_gpl, game_result, wdl_values, postmove_exp_white, postmove_exp_black):
     win_value, draw_value, loss_value = wdl_values[0], wdl_values[1], wdl_values[2]
     # Calculate GI based on game result
@@ -100,6 +134,51 @@ def gi_and_gpl(pawns_list, game_result, WhiteElo, BlackElo, wdl_values, weighted
             exp_black_point_loss = premove_exp_black - postmove_exp_black
             black_gpl += exp_black_point_loss
             black_move_number += 1
+    return _finish_gi_and_gpl(white_gpl, black_gpl, game_result, WhiteElo, BlackElo, wdl_values, weighted,
+                              postmove_exp_white, postmove_exp_black, white_move_number, black_move_number)
+
+# Vectorized gi_and_gpl for one game, with identical results
+def gi_and_gpl_vectorized(pawns_list, game_result, WhiteElo, BlackElo, wdl_values, weighted):
+    table = expectation_table(wdl_values)
+    indices = table.index(np.trunc(100 * np.asarray(pawns_list, dtype=float)))
+    return _gi_and_gpl_from_table(table, indices, game_result, WhiteElo, BlackElo, wdl_values, weighted)
+
+# Vectorized gi_and_gpl for many games at once (e.g. a whole file): all evaluations are converted to WDL in one shot
+def gi_and_gpl_batch(pawns_lists, game_results, white_elos, black_elos, wdl_values, weighted):
+    lengths = [len(pawns_list) for pawns_list in pawns_lists]
+    if not lengths:
+        return []
+    table = expectation_table(wdl_values)
+    pawns = np.concatenate([np.asarray(pawns_list, dtype=float) for pawns_list in pawns_lists])
+    indices = table.index(np.trunc(100 * pawns))
+    results = []
+    end = 0
+    for length, game_result, WhiteElo, BlackElo in zip(lengths, game_results, white_elos, black_elos):
+        start, end = end, end + length
+        results.append(_gi_and_gpl_from_table(table, indices[start:end], game_result, WhiteElo, BlackElo, wdl_values, weighted))
+    return results
+
+def _gi_and_gpl_from_table(table, indices, game_result, WhiteElo, BlackElo, wdl_values, weighted):
+    # indices are the expectation table indices of the postmove evaluations, pawns_list[i] for i = 0, 1, ...
+    # Both players' GPL only use the expected value computed from the losses and draws (see calculate_expected_value)
+    postmove_exp = table.expected[indices]
+    # The premove evaluation is the previous postmove evaluation, and pawns_list[1] for the initial case
+    premove_exp = np.concatenate((postmove_exp[1:2], postmove_exp[:-1]))
+    # Odd indices are White's moves ("Black" to move after them), even indices Black's
+    white_point_loss = postmove_exp[1::2] - premove_exp[1::2]
+    black_point_loss = premove_exp[0::2] - postmove_exp[0::2]
+    # Accumulate in order, as gi_and_gpl does
+    white_gpl = np.cumsum(white_point_loss)[-1].item() if len(white_point_loss) else 0
+    black_gpl = np.cumsum(black_point_loss)[-1].item() if len(black_point_loss) else 0
+    turn = "White" if (len(indices) - 1) % 2 == 0 else "Black"
+    last = indices[-1]
+    postmove_exp_white, postmove_exp_black = calculate_expected_value(
+        int(table.wins[last]) / 1000, int(table.draws[last]) / 1000, int(table.losses[last]) / 1000, turn, wdl_values)
+    return _finish_gi_and_gpl(white_gpl, black_gpl, game_result, WhiteElo, BlackElo, wdl_values, weighted,
+                              postmove_exp_white, postmove_exp_black, len(white_point_loss), len(black_point_loss))
+
+def _finish_gi_and_gpl(white_gpl, black_gpl, game_result, WhiteElo, BlackElo, wdl_values, weighted,
+                       postmove_exp_white, postmove_exp_black, white_move_number, black_move_number):
     # Calculate GI based on game result
     white_gi, black_gi = calculate_gi_by_result(white_gpl, black_gpl, game_result, wdl_values, postmove_exp_white, postmove_exp_black)
     # Normalize GPLs to the standard 1,0.5,0 scoring system.
@@ -116,6 +195,26 @@ def gi_and_gpl(pawns_list, game_result, WhiteElo, BlackElo, wdl_values, weighted
     black_gi = calculate_normalized_gi(black_gi)
     return white_gi, black_gi, white_gpl, black_gpl, white_gi_raw, black_gi_raw, white_move_number, black_move_number-1
 
+# The per-move data behind gi_and_gpl for one game, as arrays (see ply_table.PLY_SCHEMA): for every evaluated move
+# (pawns_list[1:]), its ply, the mover (0 White, 1 Black), the evaluation after it, the mover's expected points before
+# and after it, and its point loss. The point losses of each player add up to the GPL of gi_and_gpl.
+def ply_arrays(pawns_list, wdl_values):
+    table = expectation_table(wdl_values)
+    pawns = np.asarray(pawns_list, dtype=float)
+    indices = table.index(np.trunc(100 * pawns))
+    ply = np.arange(1, len(pawns))
+    mover = (ply + 1) % 2
+    wins, draws, losses = table.wins[indices] / 1000, table.draws[indices] / 1000, table.losses[indices] / 1000
+    # calculate_expected_value for each side; table.expected is Black's
+    white_exp = wins * wdl_values[0] + draws * wdl_values[1]
+    black_exp = table.expected[indices]
+    mover_exp = np.where(mover == 0, white_exp[1:], black_exp[1:])
+    mover_pre_exp = np.where(mover == 0, white_exp[:-1], black_exp[:-1])
+    # As in gi_and_gpl: White loses what Black's expectation gains, Black what it loses
+    point_loss = np.where(mover == 0, 1, -1) * (black_exp[1:] - black_exp[:-1]) / wdl_values[0]
+    return {"ply": ply, "mover": mover, "eval": pawns[1:], "pre_expectation": mover_pre_exp,
+            "post_expectation": mover_exp, "point_loss": point_loss}
+
 # Function to calculate the expected value of a position
 def calculate_expected_value(win_prob, draw_prob, loss_prob, turn, wdl_values):
     win_value, draw_value, loss_value = wdl_values[0], wdl_values[1], wdl_values[2]
@@ -141,77 +240,324 @@ def calculate_adjusted_gi(gi, opponent_elo, reference_elo):
 def expected_score(opponent_elo, reference_elo):
     return 1 / (1 + 10 ** ((reference_elo - opponent_elo) / 400))
     
-def main(input_pgn_dir, output_json_dir, wdl_values, weighted):
-    # Ensure the output directory exists
-    if not os.path.exists(output_json_dir):
-        os.makedirs(output_json_dir)
-    key_counter = 1
+# Function to calculate the stats of one game from its headers and evaluations, as a compact GameRecord (see
+# game_table.py; record.as_dict() is the game's entry in the JSON output); returns None if there are no evaluations
+def analyze_game(headers, pawns_list, wdl_values, weighted):
+    # Get the headers of the game
+    game_result = headers.get('Result', None)
+    # Get the ELO ratings of the players as integers
+    WhiteElo = int(headers.get("WhiteElo", None)) if headers.get("WhiteElo", None) else None
+    BlackElo = int(headers.get("BlackElo", None)) if headers.get("BlackElo", None) else None
+    if pawns_list is None or len(pawns_list) < 2:  # Skip this game if no evaluations are available
+        return None
+    white_acpl, black_acpl = calculate_acpl_vectorized(pawns_list)
+
+    #black_moves = (len(pawns_list) - 1) // 2
+    #white_moves = len(pawns_list) - 1 - black_moves
+
+    # Calculate GI and GPL for both players
+    white_gi, black_gi, white_gpl, black_gpl, white_gi_raw, black_gi_raw, white_move_number, black_move_number = gi_and_gpl_vectorized(pawns_list, game_result, WhiteElo, BlackElo, wdl_values, weighted)
+    # NumPy scalars are unwrapped to Python numbers, which take less memory and are written the same (Python ints,
+    # such as the acpl of a side without moves, stay ints)
+    statistics = [round(value, 4) for value in (white_gi, black_gi, white_gpl, black_gpl, white_acpl, black_acpl,
+                                                white_gi_raw, black_gi_raw)]
+    statistics = [value.item() if isinstance(value, np.generic) else value for value in statistics]
+    statistics += [white_move_number, black_move_number]
+    # Further game details
+    game_details = (headers.get("White", None), headers.get("Black", None), headers.get("Event", None),
+                    headers.get("Site", None), headers.get("Round", None), headers.get("WhiteElo", None),
+                    headers.get("BlackElo", None), headers.get("Date", None))
+    return GameRecord(statistics, game_details, RESULT_CODES.get(game_result, 0))
+
+# Yield (headers, pawns_list) for each game of a PGN file, or of the byte range [start, end) of the file.
+# fast_scan reads them straight from the PGN text with pgn_scanner instead of building python-chess game trees;
+# fast_scan='unchecked' does not play the moves either (see the module docstring).
+def iter_game_evals(pgn_file_path, fast_scan=False, start=0, end=None):
+    if fast_scan:
+        with open(pgn_file_path, 'rb') as pgn_file:
+            for scanned in scan_games(pgn_file, start, end, check_moves=fast_scan != 'unchecked'):
+                yield scanned.headers, pawns_list_from_evals(scanned.evals)
+        return
+    if start == 0 and end is None:
+        pgn = open(pgn_file_path)
+    else:
+        with open(pgn_file_path, 'rb') as pgn_file:
+            pgn_file.seek(start)
+            pgn = io.StringIO(pgn_file.read(end - start).decode('utf-8', errors='replace'))
+    with pgn:
+        while True:
+            game = chess.pgn.read_game(pgn)
+            if game is None:
+                break
+            yield game.headers, extract_pawn_evals_from_pgn(game)
+
+# Yield (headers, pawns_list) for the games of a PGN file at the given (offset, length) byte ranges, e.g. those a
+# query selects through the PGN index, seeking straight to each of them
+def iter_selected_game_evals(pgn_file_path, ranges, fast_scan=False):
+    with open(pgn_file_path, 'rb') as pgn_file:
+        for offset, length in ranges:
+            if fast_scan:
+                for scanned in scan_games(pgn_file, offset, offset + length, check_moves=fast_scan != 'unchecked'):
+                    yield scanned.headers, pawns_list_from_evals(scanned.evals)
+                continue
+            pgn_file.seek(offset)
+            game = chess.pgn.read_game(io.StringIO(pgn_file.read(length).decode('utf-8', errors='replace')))
+            if game is not None:
+                yield game.headers, extract_pawn_evals_from_pgn(game)
+
+# Split the selected games of a file into groups of about chunk_size bytes, as (start, end, ranges) like find_chunks
+def group_ranges(ranges, chunk_size):
+    groups = []
+    for offset, length in ranges:
+        if not groups or groups[-1][1] - groups[-1][0] >= chunk_size:
+            groups.append([offset, offset + length, []])
+        groups[-1][1] = offset + length
+        groups[-1][2].append((offset, length))
+    return [tuple(group) for group in groups]
+
+# Split a PGN file into byte ranges of about chunk_size bytes, each starting at an "[Event " line
+def find_chunks(pgn_file_path, chunk_size):
+    size = os.path.getsize(pgn_file_path)
+    boundaries = [0]
+    with open(pgn_file_path, 'rb') as pgn_file:
+        for target in range(chunk_size, size, chunk_size):
+            if target <= boundaries[-1]:
+                continue
+            pgn_file.seek(target)
+            pgn_file.readline()  # skip the rest of the current line
+            while True:
+                position = pgn_file.tell()
+                line = pgn_file.readline()
+                if not line:
+                    position = size
+                    break
+                if line.startswith(b'[Event '):
+                    break
+            if position >= size:
+                break
+            boundaries.append(position)
+    boundaries.append(size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+# Analyze the games of iter_game_evals, adding the time spent reading them ('parse') and analyzing them
+# ('evaluate'), and the number of games and plies analyzed, to timings. with_plies yields (game_data, ply_arrays)
+def _analyze_games(game_evals, wdl_values, weighted, timings, with_plies=False):
+    start = time.perf_counter()
+    for headers, pawns_list in game_evals:
+        parsed = time.perf_counter()
+        game_data = analyze_game(headers, pawns_list, wdl_values, weighted)
+        if game_data is not None and with_plies:
+            game_data = game_data, ply_arrays(pawns_list, wdl_values)
+        evaluated = time.perf_counter()
+        timings['parse'] += parsed - start
+        timings['evaluate'] += evaluated - parsed
+        if game_data is not None:
+            timings['games'] += 1
+            timings['plies'] += len(pawns_list) - 1
+            yield game_data
+        start = time.perf_counter()
+
+def _new_timings():
+    return {'parse': 0.0, 'evaluate': 0.0, 'games': 0, 'plies': 0}
+
+def _record_timings(timings):
+    metrics.add("analyze.parse", timings['parse'], games=timings['games'])
+    metrics.add("analyze.evaluate", timings['evaluate'], games=timings['games'], plies=timings['plies'])
+
+# Worker for the parallel mode: the stats of every game in one chunk, in order, and the chunk's timings
+def _analyze_chunk(task):
+    pgn_file_path, start, end, ranges, wdl_values, weighted, fast_scan, with_plies = task
+    timings = _new_timings()
+    if ranges is None:
+        game_evals = iter_game_evals(pgn_file_path, fast_scan, start, end)
+    else:
+        game_evals = iter_selected_game_evals(pgn_file_path, ranges, fast_scan)
+    results = list(_analyze_games(game_evals, wdl_values, weighted, timings, with_plies))
+    return results, timings
+
+def iter_pgn_files(input_pgn_dir):
     # walk through all pgn files in the dir
     for dirpath, dirnames, filenames in os.walk(input_pgn_dir):
         for filename in filenames:
             if filename.endswith('.pgn'):
-                aggregated_data = {}
-                pgn_file_path = os.path.join(dirpath, filename)
-                json_file_name = filename.replace('.pgn', '.json')
-                output_json_path = os.path.join(output_json_dir, json_file_name)
-                with open(pgn_file_path) as pgn:
-                    while True:
-                        game = chess.pgn.read_game(pgn)
-                        if game is None:
-                            break
-                        # Get the headers of the game
-                        game_result = game.headers.get('Result', None)
-                        if game_result == '1-0':
-                            whiteResult = 1
-                            blackResult = 0
-                        elif game_result == '0-1':
-                            whiteResult = 0
-                            blackResult = 1
-                        elif game_result == '1/2-1/2':
-                            whiteResult = 0.5
-                            blackResult = 0.5
-                        else:
-                            whiteResult = '...'
-                            blackResult = '...'
-                        # Further game details
-                        game_details = {
-                            "White": game.headers.get("White", None),
-                            "Black": game.headers.get("Black", None),
-                            "Event": game.headers.get("Event", None),
-                            "Site": game.headers.get("Site", None),
-                            "Round": game.headers.get("Round", None),
-                            "WhiteElo": game.headers.get("WhiteElo", None),
-                            "BlackElo": game.headers.get("BlackElo", None),
-                            "WhiteResult": whiteResult,
-                            "BlackResult": blackResult,
-                            "Date": game.headers.get("Date", None),
-                                }
-                        # Get the ELO ratings of the players as integers
-                        WhiteElo = int(game.headers.get("WhiteElo", None)) if game.headers.get("WhiteElo", None) else None
-                        BlackElo = int(game.headers.get("BlackElo", None)) if game.headers.get("BlackElo", None) else None
-                        pawns_list = extract_pawn_evals_from_pgn(game)
-                        if pawns_list is None or len(pawns_list) < 2:  # Skip this game if no evaluations are available
-                            continue
-                        white_acpl, black_acpl = calculate_acpl(pawns_list)
-
-                        #black_moves = (len(pawns_list) - 1) // 2
-                        #white_moves = len(pawns_list) - 1 - black_moves
-
-                        # Calculate GI and GPL for both players
-                        white_gi, black_gi, white_gpl, black_gpl, white_gi_raw, black_gi_raw, white_move_number, black_move_number = gi_and_gpl(pawns_list, game_result, WhiteElo, BlackElo, wdl_values, weighted)
-                        key = key_counter
-                        game_data = {
-                            "white_gi": round(white_gi, 4), "black_gi": round(black_gi, 4),
-                            "white_gpl": round(white_gpl, 4), "black_gpl": round(black_gpl, 4),
-                            "white_acpl": round(white_acpl, 4), "black_acpl": round(black_acpl, 4),
-                            "white_gi_raw": round(white_gi_raw, 4), "black_gi_raw": round(black_gi_raw, 4),
-                            "white_move_number": white_move_number, "black_move_number": black_move_number,
-                            **game_details,
-                        }
-                        aggregated_data[key] = game_data
-                        key_counter += 1                
-                if aggregated_data:
-                    with open(output_json_path, 'w') as f:
-                        json.dump(aggregated_data, f, indent=4)                        
-                    print(f"Aggregated data saved to {output_json_path}")
+                yield os.path.join(dirpath, filename)
+
+def _analyze_files_in_parallel(pgn_file_paths, wdl_values, weighted, fast_scan, workers, chunk_size, with_plies=False,
+                               selection=None):
+    # Yield (pgn_file_path, games) in file order; files are split into chunks that are analyzed by a process pool.
+    # With a selection ({absolute path: game ranges}, see pgn_index.py), only the selected games are analyzed.
+    if selection is None:
+        chunks = {pgn_file_path: [(start, end, None) for start, end in find_chunks(pgn_file_path, chunk_size)]
+                  for pgn_file_path in pgn_file_paths}
+    else:
+        chunks = {pgn_file_path: group_ranges(selection[os.path.abspath(pgn_file_path)], chunk_size)
+                  for pgn_file_path in pgn_file_paths}
+    tasks = [(pgn_file_path, start, end, ranges, wdl_values, weighted, fast_scan, with_plies)
+             for pgn_file_path in pgn_file_paths
+             for start, end, ranges in chunks[pgn_file_path]]
+    # The workers share one read-only expectation table instead of each building its own
+    table_block = share_expectation_table(wdl_values)
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=attach_expectation_table,
+                                 initargs=(table_block.name, wdl_values)) as executor:
+            # map returns the chunks in their original order, whatever order they finish in
+            results = zip(tasks, executor.map(_analyze_chunk, tasks))
+            for pgn_file_path, file_results in itertools.groupby(results, key=lambda result: result[0][0]):
+                yield pgn_file_path, _chunk_games(file_results)
+    finally:
+        table_block.close()
+        table_block.unlink()
+
+def _chunk_games(file_results):
+    # The timings of the workers are summed over the processes
+    for task, (chunk, timings) in file_results:
+        _record_timings(timings)
+        yield from chunk
+
+def _analyze_files(pgn_file_paths, wdl_values, weighted, fast_scan, with_plies=False, selection=None):
+    for pgn_file_path in pgn_file_paths:
+        ranges = selection[os.path.abspath(pgn_file_path)] if selection is not None else None
+        yield pgn_file_path, _analyze_file(pgn_file_path, wdl_values, weighted, fast_scan, with_plies, ranges)
+
+def _analyze_file(pgn_file_path, wdl_values, weighted, fast_scan, with_plies=False, ranges=None):
+    timings = _new_timings()
+    if ranges is None:
+        game_evals = iter_game_evals(pgn_file_path, fast_scan)
+    else:
+        game_evals = iter_selected_game_evals(pgn_file_path, ranges, fast_scan)
+    try:
+        yield from _analyze_games(game_evals, wdl_values, weighted, timings, with_plies)
+    finally:
+        _record_timings(timings)
+
+# Stream the games of one PGN file to a .jsonl or .parquet file; returns the next key and the path of the file, if any
+def _write_game_table(pgn_file_path, games, output_dir, output_format, batch_size, key_counter):
+    output_path = os.path.join(output_dir, os.path.basename(pgn_file_path).replace('.pgn', '.' + output_format))
+    writer = None
+    for game_data in games:
+        if writer is None:
+            writer = open_game_writer(output_path, batch_size)
+        writer.write(game_row(key_counter, game_data))
+        key_counter += 1
+    if writer is None:
+        return key_counter, None
+    writer.close()
+    print(f"{writer.rows_written} games saved to {output_path}")
+    return key_counter, output_path
+
+# Write the per-move data of the games to a ply table as they pass, numbering them from first_key as the output does
+def _write_ply_table(games, ply_writer, first_key):
+    for key, (game_data, plies) in enumerate(games, first_key):
+        ply_writer.write(key, game_data.white, game_data.black, plies)
+        yield game_data
+
+def _ply_table_path(ply_output_dir, pgn_file_path):
+    return os.path.join(ply_output_dir, os.path.basename(pgn_file_path).replace('.pgn', PLY_TABLE_EXTENSION))
+
+# Keep the output of a file analyzed by an earlier run, renumbering its games to start at key_counter; returns the next key
+def _reuse_output(manifest, pgn_file_path, key_counter):
+    entry = manifest.entry(pgn_file_path)
+    shift = key_counter - entry["first_key"]
+    if shift:
+        for output_path in entry["outputs"]:
+            if output_path.endswith('.json'):
+                with open(output_path) as f:
+                    aggregated_data = json.load(f)
+                aggregated_data = {int(key) + shift: game_data for key, game_data in aggregated_data.items()}
+                with open(output_path, 'w') as f:
+                    json.dump(aggregated_data, f, indent=4)
+            elif output_path.endswith(('.jsonl', '.parquet')):
+                renumber_game_table(output_path, shift)
+            elif os.path.basename(output_path) == "games.npy":
+                # The other files of the ply table are renumbered with it
+                renumber_ply_table(os.path.dirname(output_path), shift)
+        manifest.record(pgn_file_path, list(entry["outputs"]), first_key=key_counter, games=entry["games"])
+        print(f"Skipping {pgn_file_path}: unchanged, games renumbered from {key_counter}")
+    else:
+        print(f"Skipping {pgn_file_path}: unchanged")
+    return key_counter + entry["games"]
+
+@metrics.timed("analyze")
+def main(input_pgn_dir, output_json_dir, wdl_values, weighted, fast_scan=False, validate_scan=False, workers=1,
+         chunk_size=64 * 1024 * 1024, output_format='json', batch_size=10000, force=False, ply_output_dir=None,
+         query=None, index_path=None):
+    # fast_scan: read headers and evaluations with the lightweight scanner (no game trees, so faster on large files);
+    # 'unchecked' also skips parsing the moves, which is only right if they are all legal
+    # validate_scan: check the scanner against python-chess on every file first and report any differences
+    # workers: number of processes; with more than one, files are split into chunks of about chunk_size bytes
+    # that are analyzed in parallel, and game keys are numbered in the original order
+    # output_format: 'json' writes one indented JSON dict per file; 'jsonl' and 'parquet' stream typed rows
+    # (see game_table.GAME_SCHEMA) in batches of batch_size, without keeping the file's games in memory
+    # Files analyzed by an earlier run into output_json_dir with the same wdl_values, weighted and output_format are
+    # skipped if they have not changed since (see file_manifest.py); their game keys are renumbered if the games of
+    # earlier files changed. force=True analyzes every file again.
+    # ply_output_dir: also write the per-move data of every file's games to a ply table there (see ply_table.py)
+    # query: only analyze the games it selects through the PGN index at index_path (by default PGN_INDEX in
+    # input_pgn_dir; see pgn_index.py), e.g. {"player": "Carlsen, Magnus", "year": 2024}. Only the files with selected
+    # games get an output, holding only those games.
+    # Ensure the output directory exists
+    if not os.path.exists(output_json_dir):
+        os.makedirs(output_json_dir)
+    key_counter = 1
+    pgn_file_paths = list(iter_pgn_files(input_pgn_dir))
+    selection = None
+    if query is not None:
+        selection = select_games(pgn_file_paths, query, index_path or os.path.join(input_pgn_dir, PGN_INDEX))
+        pgn_file_paths = [pgn_file_path for pgn_file_path in pgn_file_paths if os.path.abspath(pgn_file_path) in selection]
+    if validate_scan:
+        for pgn_file_path in pgn_file_paths:
+            mismatches = validate_scanner(pgn_file_path, check_moves=fast_scan != 'unchecked')
+            for number, description in mismatches[:10]:
+                print(f"Scanner mismatch in {pgn_file_path}, game {number}: {description}")
+            print(f"Scanner validation of {pgn_file_path}: {len(mismatches)} mismatches")
+    params = {"wdl_values": list(wdl_values), "weighted": weighted, "output_format": output_format}
+    if fast_scan == 'unchecked':
+        # Can give other results than the other readers on games with illegal moves
+        params["fast_scan"] = fast_scan
+    if ply_output_dir is not None:
+        os.makedirs(ply_output_dir, exist_ok=True)
+        params["ply_output_dir"] = os.path.abspath(ply_output_dir)
+    if query is not None:
+        params["query"] = query
+    manifest = FileManifest(os.path.join(output_json_dir, ANALYZER_MANIFEST), params)
+    stale_paths = [pgn_file_path for pgn_file_path in pgn_file_paths if force or not manifest.is_current(pgn_file_path)]
+    if workers > 1:
+        analyzed_files = _analyze_files_in_parallel(stale_paths, wdl_values, weighted, fast_scan, workers, chunk_size,
+                                                    ply_output_dir is not None, selection)
+    else:
+        analyzed_files = _analyze_files(stale_paths, wdl_values, weighted, fast_scan, ply_output_dir is not None, selection)
+    stale_paths = set(stale_paths)
+    for pgn_file_path in pgn_file_paths:
+        if pgn_file_path not in stale_paths:
+            key_counter = _reuse_output(manifest, pgn_file_path, key_counter)
+            continue
+        pgn_file_path, games = next(analyzed_files)
+        first_key = key_counter
+        ply_writer = None
+        if ply_output_dir is not None:
+            ply_writer = PlyTableWriter(_ply_table_path(ply_output_dir, pgn_file_path), batch_size)
+            games = _write_ply_table(games, ply_writer, first_key)
+        if output_format != 'json':
+            key_counter, output_path = _write_game_table(pgn_file_path, games, output_json_dir, output_format, batch_size, key_counter)
+            output_paths = [output_path] if output_path else []
+            if ply_writer is not None:
+                ply_writer.close()
+                output_paths += ply_writer.output_paths()
+            manifest.record(pgn_file_path, output_paths, first_key=first_key, games=key_counter - first_key)
+            continue
+        # The games are kept as GameRecords until the file ends, and only written as JSON then
+        aggregated_data = list(games)
+        json_file_name = os.path.basename(pgn_file_path).replace('.pgn', '.json')
+        output_json_path = os.path.join(output_json_dir, json_file_name)
+        key_counter += len(aggregated_data)
+        if aggregated_data:
+            write_json_games(output_json_path, aggregated_data, first_key)
+            print(f"Aggregated data saved to {output_json_path}")
+        output_paths = [output_json_path] if aggregated_data else []
+        if ply_writer is not None:
+            ply_writer.close()
+            output_paths += ply_writer.output_paths()
+        manifest.record(pgn_file_path, output_paths, first_key=first_key, games=key_counter - first_key)
+    manifest.save()
     print(f"#Games = {key_counter - 1}")
+    metrics.count("analyze", files=len(pgn_file_paths), games=key_counter - 1)
@@ -0,0 +1,157 @@
+"""
+This script keeps an SQLite index of the games in a directory of PGN files: for each game, its file, byte offset and
+length, its White, Black, Event, Date, Elo and Result headers and whether it has [%eval] annotations. Questions such as
+"all games of a player in 2024" are then answered from the index, and the analyzer and the annotator read only the
+selected games, seeking straight to them, instead of scanning the whole corpus.
+
+The index is brought up to date on every use: files whose size or modification time changed are scanned again (with
+pgn_scanner, which reports the offset and length of each game), and files that no longer exist are dropped.
+"""
+
+import os
+import sqlite3
+
+import pandas as pd
+
+from pgn_scanner import scan_pgn_file
+
+# Default index file, in the PGN directory (without a .pgn extension, so the stages do not mistake it for a PGN file)
+PGN_INDEX = '.pgn_index.sqlite'
+
+# Query filters and the conditions they add; date_from/date_to are PGN dates (YYYY.MM.DD) and leave out unknown dates
+_FILTERS = {
+    "player": "(games.white = :player OR games.black = :player)",
+    "white": "games.white = :white",
+    "black": "games.black = :black",
+    "event": "games.event = :event",
+    "year": "games.year = :year",
+    "date_from": "games.year IS NOT NULL AND games.date >= :date_from",
+    "date_to": "games.year IS NOT NULL AND games.date <= :date_to",
+    "result": "games.result = :result",
+    "min_elo": "games.white_elo >= :min_elo AND games.black_elo >= :min_elo",
+    "has_evals": "games.has_evals = :has_evals",
+}
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _year(date):
+    return _to_int(date.split(".")[0]) if date else None
+
+
+class PGNIndex:
+    def __init__(self, path):
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                id INTEGER PRIMARY KEY,
+                path TEXT NOT NULL UNIQUE,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL
+            )""")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS games (
+                file_id INTEGER NOT NULL,
+                number INTEGER NOT NULL,
+                offset INTEGER NOT NULL,
+                length INTEGER NOT NULL,
+                white TEXT, black TEXT, event TEXT, date TEXT, year INTEGER,
+                white_elo INTEGER, black_elo INTEGER, result TEXT,
+                has_evals INTEGER NOT NULL,
+                PRIMARY KEY (file_id, number)
+            ) WITHOUT ROWID""")
+        for column in ("white", "black", "event", "date"):
+            self._conn.execute(f"CREATE INDEX IF NOT EXISTS games_{column} ON games ({column})")
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def update(self, pgn_file_paths):
+        # Index the files that are new or changed since they were indexed, and drop the files that are not in
+        # pgn_file_paths any more; returns the number of files scanned
+        indexed = {path: (file_id, size, mtime_ns)
+                   for file_id, path, size, mtime_ns in self._conn.execute("SELECT id, path, size, mtime_ns FROM files")}
+        scanned = 0
+        current = set()
+        for pgn_file_path in pgn_file_paths:
+            path = os.path.abspath(pgn_file_path)
+            current.add(path)
+            stat = os.stat(path)
+            entry = indexed.get(path)
+            if entry is not None and entry[1:] == (stat.st_size, stat.st_mtime_ns):
+                continue
+            with self._conn:
+                if entry is not None:
+                    self._remove(entry[0])
+                self._index_file(path, stat)
+            scanned += 1
+        with self._conn:
+            for path in set(indexed) - current:
+                self._remove(indexed[path][0])
+        return scanned
+
+    def _remove(self, file_id):
+        self._conn.execute("DELETE FROM games WHERE file_id = ?", (file_id,))
+        self._conn.execute("DELETE FROM files WHERE id = ?", (file_id,))
+
+    def _index_file(self, path, stat):
+        file_id = self._conn.execute("INSERT INTO files (path, size, mtime_ns) VALUES (?, ?, ?)",
+                                     (path, stat.st_size, stat.st_mtime_ns)).lastrowid
+        rows = []
+        for number, game in enumerate(scan_pgn_file(path, check_moves=False)):
+            headers = game.headers
+            date = headers.get("Date")
+            rows.append((file_id, number, game.offset, game.length, headers.get("White"), headers.get("Black"),
+                         headers.get("Event"), date, _year(date), _to_int(headers.get("WhiteElo")),
+                         _to_int(headers.get("BlackElo")), headers.get("Result"), int(bool(game.evals))))
+        self._conn.executemany("INSERT INTO games VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def _select(self, columns, query):
+        # query: {filter: value} with the filters of _FILTERS, all of which must hold
+        unknown = set(query) - set(_FILTERS)
+        if unknown:
+            raise ValueError(f"Unknown query filters: {', '.join(sorted(unknown))} (known: {', '.join(_FILTERS)})")
+        parameters = {name: int(value) if name == "has_evals" else value for name, value in query.items()}
+        where = " AND ".join(_FILTERS[name] for name in query) or "1"
+        return self._conn.execute(f"""
+            SELECT {columns} FROM games JOIN files ON files.id = games.file_id
+            WHERE {where} ORDER BY files.path, games.number""", parameters)
+
+    def find_games(self, **query):
+        # The selected games and their indexed headers as a DataFrame, e.g. find_games(player="Carlsen, Magnus", year=2024)
+        cursor = self._select("files.path, games.number, games.offset, games.length, games.white, games.black, "
+                              "games.event, games.date, games.white_elo, games.black_elo, games.result, games.has_evals",
+                              query)
+        df = pd.DataFrame(cursor.fetchall(), columns=[description[0] for description in cursor.description])
+        return df.astype({"white_elo": "Int32", "black_elo": "Int32", "has_evals": bool})
+
+    def game_ranges(self, **query):
+        # {absolute file path: [(offset, length), ...]} of the selected games, in file order
+        ranges = {}
+        for path, offset, length in self._select("files.path, games.offset, games.length", query):
+            ranges.setdefault(path, []).append((offset, length))
+        return ranges
+
+
+def select_games(pgn_file_paths, query, index_path):
+    # Bring the index of the PGN files up to date and return the game ranges the query selects
+    with PGNIndex(index_path) as index:
+        scanned = index.update(pgn_file_paths)
+        if scanned:
+            print(f"Indexed {scanned} PGN files in {index_path}")
+        ranges = index.game_ranges(**query)
+    print(f"Query {query}: {sum(len(file_ranges) for file_ranges in ranges.values())} games in {len(ranges)} files")
+    return ranges
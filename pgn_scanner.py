@@ -0,0 +1,265 @@
+"""
+This script is a lightweight PGN scanner for the analyzer. It reads the headers and the [%eval ...] annotations of the
+mainline directly from the PGN text, without building game trees, and reports the byte offset and length of each game.
+It follows the game boundaries and comment rules of chess.pgn.read_game, and validate_scanner cross-checks it against
+the python-chess based extract_pawn_evals_from_pgn.
+
+The moves are played on a board as read_game does, since an illegal move ends the mainline there (the evaluations after
+it are not part of the game) and a game with an invalid FEN has no moves. With check_moves=False, the SAN moves are not
+parsed at all, which is several times faster but only right for games known to be legal, e.g. the annotator's output.
+"""
+
+import io
+from collections import namedtuple
+
+import chess
+import chess.engine
+import chess.pgn
+from chess.pgn import EVAL_REGEX, MOVETEXT_REGEX, TAG_REGEX
+
+ScannedGame = namedtuple("ScannedGame", ["offset", "length", "headers", "evals"])
+
+# Headers that python-chess fills in when a game does not have them
+DEFAULT_HEADERS = {"Event": "?", "Site": "?", "Date": "????.??.??", "Round": "?", "White": "?", "Black": "?", "Result": "*"}
+
+
+def scan_games(pgn_file, start=0, end=None, check_moves=True):
+    # Yield a ScannedGame for each game of a PGN file opened in binary mode, between byte offsets start and end
+    pgn_file.seek(start)
+    reader = _LineReader(pgn_file, start, end)
+    while True:
+        game = _scan_game(reader, check_moves)
+        if game is None:
+            return
+        yield game
+
+
+def scan_pgn_file(pgn_file_path, check_moves=True):
+    with open(pgn_file_path, 'rb') as pgn_file:
+        yield from scan_games(pgn_file, check_moves=check_moves)
+
+
+class _LineReader:
+    def __init__(self, pgn_file, offset, end):
+        self.pgn_file = pgn_file
+        self.offset = offset
+        self.end = end
+        self.first = offset == 0
+
+    def readline(self):
+        if self.end is not None and self.offset >= self.end:
+            return ""
+        line = self.pgn_file.readline()
+        self.offset += len(line)
+        if self.first:
+            line = line.lstrip(b"\xef\xbb\xbf")
+            self.first = False
+        return line.decode("utf-8", errors="replace")
+
+
+def _start_board(headers):
+    # The initial position as read_game sets it up, or None if the FEN is invalid (read_game then skips the moves)
+    pgn_headers = chess.pgn.Headers(headers)
+    try:
+        VariantBoard = pgn_headers.variant()
+    except ValueError:
+        VariantBoard = chess.Board
+    try:
+        board = VariantBoard(pgn_headers.get("FEN", VariantBoard.starting_fen), chess960=pgn_headers.is_chess960())
+    except ValueError:
+        return None
+    board.chess960 = board.chess960 or board.has_chess960_castling_rights()
+    return board
+
+
+def _scan_game(reader, check_moves=True):
+    # Ignore leading empty lines and comments
+    line_start = reader.offset
+    line = reader.readline()
+    while line.isspace() or line.startswith("%") or line.startswith(";"):
+        line_start = reader.offset
+        line = reader.readline()
+    if not line:
+        return None
+    offset = line_start
+
+    # Game headers, allowing up to one consecutive empty line between them
+    headers = dict(DEFAULT_HEADERS)
+    consecutive_empty_lines = 0
+    while line:
+        if line.startswith("%") or line.startswith(";"):
+            line = reader.readline()
+            continue
+        if consecutive_empty_lines < 1 and line.isspace():
+            consecutive_empty_lines += 1
+            line = reader.readline()
+            continue
+        if not line.startswith("["):
+            break
+        consecutive_empty_lines = 0
+        tag_match = TAG_REGEX.match(line)
+        if tag_match:
+            headers[tag_match.group(1)] = tag_match.group(2)
+        line = reader.readline()
+
+    # The side to move after each mainline move decides how "#0" is scored
+    white_to_move = True
+    if "FEN" in headers:
+        fields = headers["FEN"].split()
+        white_to_move = len(fields) < 2 or fields[1] != "b"
+
+    # With check_moves, a board per variation level as in read_game; skip_depth counts the variations being skipped
+    # after an illegal move, and skip_game is set when the game has no valid starting position
+    board_stack, skip_depth, skip_game = None, 0, False
+    if check_moves:
+        board = _start_board(headers)
+        if board is None:
+            skip_game = True
+        else:
+            board_stack = [board]
+            white_to_move = board.turn == chess.WHITE
+
+    # Movetext: track variation nesting the way read_game does, and keep the first eval of each mainline move
+    evals = []
+    moves_per_level = [0]
+    node_has_eval = True  # no mainline move yet: comments belong to the game itself
+    # As in chess.pgn.GameBuilder: after a move, a comment is that move's; after the opening parenthesis of a variation,
+    # until its first (legal) move, a comment is the starting comment of the next move
+    after_move = False
+    fresh_line = True
+    while line:
+        if fresh_line:
+            if line.startswith("%") or line.startswith(";"):
+                line = reader.readline()
+                continue
+            if line.isspace():
+                break
+        fresh_line = True
+
+        for match in MOVETEXT_REGEX.finditer(line):
+            token = match.group(0)
+            if token.startswith("{"):
+                # Consume until the end of the comment
+                line = token[1:]
+                comment_lines = []
+                while line and "}" not in line:
+                    comment_lines.append(line)
+                    line = reader.readline()
+                if line:
+                    close_index = line.find("}")
+                    comment_lines.append(line[:close_index])
+                    line = line[close_index + 1:]
+                if len(moves_per_level) == 1 and after_move and not node_has_eval and not skip_depth and not skip_game:
+                    evaluation = _parse_eval("".join(comment_lines), white_to_move)
+                    if evaluation is not None:
+                        evals.append(evaluation)
+                        node_has_eval = True
+                # Continue with the current line
+                fresh_line = False
+                break
+            elif skip_game:
+                continue
+            elif token == "(":
+                if skip_depth:
+                    skip_depth += 1
+                elif board_stack is None:
+                    if moves_per_level[-1]:
+                        moves_per_level.append(0)
+                        after_move = False
+                elif board_stack[-1].move_stack:
+                    moves_per_level.append(0)
+                    after_move = False
+                    board = board_stack[-1].copy()
+                    board.pop()
+                    board_stack.append(board)
+            elif token == ")":
+                if skip_depth == 1:
+                    # The end of the skipped variation; like read_game, keep playing on its board
+                    skip_depth = 0
+                    if len(moves_per_level) > 1:
+                        moves_per_level.pop()
+                elif skip_depth:
+                    skip_depth -= 1
+                elif board_stack is None:
+                    if len(moves_per_level) > 1:
+                        moves_per_level.pop()
+                elif len(board_stack) > 1:
+                    board_stack.pop()
+                    if len(moves_per_level) > 1:
+                        moves_per_level.pop()
+            elif skip_depth:
+                continue
+            elif token.startswith(";"):
+                break
+            elif match.group(7) and len(moves_per_level if board_stack is None else board_stack) == 1:
+                # A result in the movetext fills in a missing Result header, as in python-chess
+                if headers.get("Result", "*") == "*":
+                    headers["Result"] = token
+            elif match.group(1) or (match.group(7) and board_stack is not None):
+                if board_stack is not None:
+                    # A result inside a variation is taken as a move too, and is illegal, as in read_game
+                    try:
+                        move = board_stack[-1].parse_san(token)
+                    except ValueError:
+                        skip_depth = 1
+                        continue
+                    board_stack[-1].push(move)
+                moves_per_level[-1] += 1
+                after_move = True
+                if len(moves_per_level) == 1:
+                    white_to_move = not white_to_move
+                    node_has_eval = False
+
+        if fresh_line:
+            line = reader.readline()
+
+    return ScannedGame(offset, reader.offset - offset, headers, evals)
+
+
+def _parse_eval(comment, white_to_move):
+    # Same value as extract_eval_from_node: the first [%eval] of the comment, in pawns from White's point of view
+    match = EVAL_REGEX.search(comment)
+    if not match:
+        return None
+    if match.group("mate"):
+        mate = int(match.group("mate"))
+        if mate == 0:
+            # The side to move has been mated
+            return (-10000 if white_to_move else 10000) / 100.0
+        return chess.engine.Mate(mate).score(mate_score=10000) / 100.0
+    return chess.engine.Cp(round(float(match.group("cp")) * 100)).score() / 100.0
+
+
+def pawns_list_from_evals(evals):
+    # The list extract_pawn_evals_from_pgn returns for a game with these evaluations
+    pawns_list = [0] + list(evals)
+    if len(pawns_list) > 1:
+        pawns_list[0] = pawns_list[1]
+    return pawns_list
+
+
+def validate_scanner(pgn_file_path, headers=("White", "Black", "Event", "Site", "Round", "WhiteElo", "BlackElo", "Result", "Date"),
+                     check_moves=True):
+    # Compare the scanner with python-chess game by game; returns a list of (game number, description) mismatches
+    from pgn_evaluation_fast_analyzer import extract_pawn_evals_from_pgn
+
+    mismatches = []
+    with open(pgn_file_path, 'rb') as pgn_file:
+        scanned_games = list(scan_games(pgn_file, check_moves=check_moves))
+        pgn_file.seek(0)
+        text = io.TextIOWrapper(pgn_file, encoding="utf-8", errors="replace")
+        for number, scanned in enumerate(scanned_games, start=1):
+            game = chess.pgn.read_game(text)
+            if game is None:
+                mismatches.append((number, "python-chess found no more games"))
+                break
+            for name in headers:
+                if game.headers.get(name, None) != scanned.headers.get(name, None):
+                    mismatches.append((number, f"header {name}: {game.headers.get(name, None)!r} != {scanned.headers.get(name, None)!r}"))
+            expected = extract_pawn_evals_from_pgn(game)
+            if expected != pawns_list_from_evals(scanned.evals):
+                mismatches.append((number, f"evals differ ({len(expected) - 1} versus {len(scanned.evals)} values)"))
+        else:
+            if chess.pgn.read_game(text) is not None:
+                mismatches.append((len(scanned_games) + 1, "scanner found no more games"))
+    return mismatches
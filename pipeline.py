@@ -0,0 +1,339 @@
+"""
+This script runs the whole calculation as one streaming pass: games are read from the PGN files, annotated with
+Stockfish (unless they already are), evaluated (GI, GPL, ACPL) and aggregated into the player stats, with bounded
+queues between the stages instead of writing every stage's output to disk and parsing it again in the next one.
+The annotated PGN files and the per-game table are optional outputs, and per-stage counters show where the time goes.
+"""
+
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from csv_to_player_stats import STATS_COLUMNS, calculate_player_stats, save_player_stats, with_last_names
+from engine_pool import EnginePool
+from eval_cache import EvalCache
+from game_table import game_frame, game_row, open_game_writer
+from pgn_evaluation_fast_analyzer import (_analyze_files_in_parallel, analyze_game, extract_pawn_evals_from_pgn,
+                                          iter_game_evals)
+from stockfish_pgn_annotator import (AnnotatedPGNWriter, add_scores_to_game, analyze_game_scores, iter_file_games,
+                                     iter_pgn_files)
+
+# Marks the end of a stage's output
+_DONE = object()
+
+
+class _Stopped(Exception):
+    # Raised in a stage when another stage failed
+    pass
+
+
+class StageCounter:
+    # Items (games) and plies handled by one stage, the time spent working on them, and the time spent waiting
+    # for the previous stage (input) or for the next one to make room in the queue (output)
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.plies = 0
+        self.busy = 0.0
+        self.waiting_for_input = 0.0
+        self.waiting_for_output = 0.0
+
+    def rate(self):
+        return self.items / self.busy if self.busy else 0.0
+
+    def report(self):
+        plies = f", {self.plies / self.busy:>9.0f} plies/s" if self.plies and self.busy else ""
+        return (f"{self.name:>9}: {self.items:>8} games in {self.busy:8.2f} s busy ({self.rate():>8.1f} games/s{plies}), "
+                f"waited {self.waiting_for_input:7.2f} s for input, {self.waiting_for_output:7.2f} s for output")
+
+
+class _Stages:
+    # Runs the stages in threads connected by bounded queues. A stage that fails stops the others,
+    # and its exception is raised again by join().
+    def __init__(self, queue_size):
+        self.queue_size = queue_size
+        self.stop = threading.Event()
+        self.errors = []
+        self.threads = []
+
+    def queue(self):
+        return queue.Queue(maxsize=self.queue_size)
+
+    def start(self, target, counter, inbox, outbox, *args):
+        thread = threading.Thread(target=self._run, args=(target, counter, inbox, outbox) + args, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+    def _run(self, target, counter, inbox, outbox, *args):
+        try:
+            target(self, counter, inbox, outbox, *args)
+            self.put(outbox, _DONE, counter)
+        except _Stopped:
+            pass
+        except BaseException as error:
+            self.errors.append(error)
+            self.stop.set()
+
+    def put(self, outbox, item, counter):
+        start = time.perf_counter()
+        while True:
+            if self.stop.is_set():
+                raise _Stopped()
+            try:
+                outbox.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        counter.waiting_for_output += time.perf_counter() - start
+
+    def items(self, inbox, counter):
+        # Yield the items of the previous stage until it is done
+        while True:
+            start = time.perf_counter()
+            while True:
+                if self.stop.is_set():
+                    raise _Stopped()
+                try:
+                    item = inbox.get(timeout=0.1)
+                    break
+                except queue.Empty:
+                    pass
+            counter.waiting_for_input += time.perf_counter() - start
+            if item is _DONE:
+                return
+            yield item
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+        if self.errors:
+            raise self.errors[0]
+
+
+def _read_games(stages, counter, inbox, outbox, pgn_file_paths, annotate, fast_scan):
+    # Read stage: (file_path, offset, game) for the annotator, or (file_path, headers, pawns_list) from the
+    # annotations already in the files. (file_path, None, None) marks the end of each file.
+    for pgn_file_path in pgn_file_paths:
+        games = iter_file_games(pgn_file_path) if annotate else iter_game_evals(pgn_file_path, fast_scan)
+        start = time.perf_counter()
+        for first, second in games:
+            counter.items += 1
+            counter.busy += time.perf_counter() - start
+            item = (pgn_file_path, second, first) if annotate else (pgn_file_path, first, second)
+            stages.put(outbox, item, counter)
+            start = time.perf_counter()
+        counter.busy += time.perf_counter() - start
+        stages.put(outbox, (pgn_file_path, None, None), counter)
+
+
+def _annotate_games(stages, counter, inbox, outbox, engine_pool, depth, eval_cache, adaptive,
+                    annotated_output_dir, input_dir_path):
+    # Annotate stage: games are analyzed concurrently, one per engine, and passed on in their original order
+    # as (file_path, headers, pawns_list), optionally also written to <annotated_output_dir>/..._annotated.pgn
+    max_in_flight = 4 * engine_pool.size
+    in_flight = deque()
+    writer = None
+    with ThreadPoolExecutor(max_workers=engine_pool.size) as executor:
+        try:
+            for pgn_file_path, offset, game in stages.items(inbox, counter):
+                start = time.perf_counter()
+                future = None
+                if game is not None:
+                    future = executor.submit(analyze_game_scores, game, engine_pool, depth, eval_cache, adaptive)
+                in_flight.append((pgn_file_path, offset, game, future))
+                counter.busy += time.perf_counter() - start
+                while in_flight and (len(in_flight) >= max_in_flight or in_flight[0][3] is None or in_flight[0][3].done()):
+                    writer = _pass_on_annotated(stages, counter, outbox, in_flight.popleft(), writer,
+                                                annotated_output_dir, input_dir_path)
+            while in_flight:
+                writer = _pass_on_annotated(stages, counter, outbox, in_flight.popleft(), writer,
+                                            annotated_output_dir, input_dir_path)
+        except BaseException:
+            # Inside the with block, so that the queued games are cancelled before the executor waits for its threads
+            executor.shutdown(wait=False, cancel_futures=True)
+            if writer is not None:
+                writer.abort()
+            raise
+
+
+def _pass_on_annotated(stages, counter, outbox, item, writer, annotated_output_dir, input_dir_path):
+    # Returns the open annotated PGN writer of the current file, if any
+    pgn_file_path, offset, game, future = item
+    start = time.perf_counter()
+    if game is None:
+        if writer is not None:
+            writer.close()
+        counter.busy += time.perf_counter() - start
+        stages.put(outbox, item[:3], counter)
+        return None
+    add_scores_to_game(game, future.result())
+    if annotated_output_dir is not None:
+        if writer is None:
+            writer = AnnotatedPGNWriter(pgn_file_path, annotated_output_dir, input_dir_path)
+        writer.write(game, offset)
+    # The evaluations are read back from the annotated game in memory, exactly as the analyzer reads them from the file
+    pawns_list = extract_pawn_evals_from_pgn(game)
+    counter.items += 1
+    counter.plies += len(pawns_list) - 1
+    counter.busy += time.perf_counter() - start
+    stages.put(outbox, (pgn_file_path, game.headers, pawns_list), counter)
+    return writer
+
+
+def _evaluate_games(stages, counter, inbox, outbox, wdl_values, weighted, games_output_dir, output_format, batch_size):
+    # Evaluate stage: typed rows of the analyzer's output (see game_table.GAME_SCHEMA), numbered across all files,
+    # optionally also written to one .jsonl/.parquet file per PGN file in games_output_dir
+    key = 1
+    writer = None
+    try:
+        for pgn_file_path, headers, pawns_list in stages.items(inbox, counter):
+            start = time.perf_counter()
+            if headers is None:
+                if writer is not None:
+                    writer.close()
+                    print(f"{writer.rows_written} games saved to {writer.path}")
+                    writer = None
+                counter.busy += time.perf_counter() - start
+                continue
+            game_data = analyze_game(headers, pawns_list, wdl_values, weighted)
+            if game_data is None:
+                counter.busy += time.perf_counter() - start
+                continue
+            row = game_row(key, game_data)
+            key += 1
+            if games_output_dir is not None:
+                if writer is None:
+                    writer = open_game_writer(_game_table_path(pgn_file_path, games_output_dir, output_format), batch_size)
+                writer.write(row)
+            counter.items += 1
+            counter.plies += len(pawns_list) - 1
+            counter.busy += time.perf_counter() - start
+            stages.put(outbox, row, counter)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def _evaluate_games_in_parallel(stages, counter, inbox, outbox, pgn_file_paths, wdl_values, weighted, fast_scan,
+                                workers, chunk_size, games_output_dir, output_format, batch_size):
+    # Read and evaluate stages in one, for games that are already annotated: the analyzer's process pool
+    # reads and evaluates chunks of the files, and the rows are passed on in the original order
+    key = 1
+    start = time.perf_counter()
+    analyzed_files = _analyze_files_in_parallel(pgn_file_paths, wdl_values, weighted, fast_scan, workers, chunk_size)
+    try:
+        for pgn_file_path, games in analyzed_files:
+            writer = None
+            try:
+                for game_data in games:
+                    row = game_row(key, game_data)
+                    key += 1
+                    if games_output_dir is not None:
+                        if writer is None:
+                            writer = open_game_writer(_game_table_path(pgn_file_path, games_output_dir, output_format), batch_size)
+                        writer.write(row)
+                    counter.items += 1
+                    counter.busy += time.perf_counter() - start
+                    stages.put(outbox, row, counter)
+                    start = time.perf_counter()
+            finally:
+                if writer is not None:
+                    writer.close()
+                    print(f"{writer.rows_written} games saved to {writer.path}")
+    finally:
+        # Shuts the process pool down and releases the shared expectation table, also when another stage failed
+        analyzed_files.close()
+    counter.busy += time.perf_counter() - start
+
+
+def _game_table_path(pgn_file_path, games_output_dir, output_format):
+    os.makedirs(games_output_dir, exist_ok=True)
+    return os.path.join(games_output_dir, os.path.basename(pgn_file_path).replace('.pgn', '.' + output_format))
+
+
+def _aggregate_games(stages, counter, inbox):
+    # Aggregate stage: keep the columns of the rows that the player stats use, then calculate the stats at the end
+    columns = {name: [] for name in STATS_COLUMNS}
+    for row in stages.items(inbox, counter):
+        start = time.perf_counter()
+        for name, values in columns.items():
+            values.append(row[name])
+        counter.items += 1
+        counter.busy += time.perf_counter() - start
+    start = time.perf_counter()
+    df = with_last_names(game_frame(columns))
+    del columns
+    player_stats = calculate_player_stats(df)
+    counter.busy += time.perf_counter() - start
+    return player_stats
+
+
+@metrics.timed("pipeline")
+def run_pipeline(input_pgn_dir, player_stats_output_dir, wdl_values, weighted, stockfish_path=None, depth=20,
+                 pool_size=1, engine_options=None, cache_path=None, cache_size=1_000_000, adaptive=None,
+                 fast_scan=False, workers=1, chunk_size=64 * 1024 * 1024, annotated_output_dir=None,
+                 games_output_dir=None, output_format='jsonl', batch_size=10000, queue_size=1000):
+    # stockfish_path: annotate the games with this engine first (with depth, pool_size, engine_options, cache_path,
+    # cache_size and adaptive as in main_stockfish); None if the games are already annotated, in which case
+    # fast_scan, workers and chunk_size are used as in the analyzer's main
+    # annotated_output_dir: also write the annotated PGN files there (as main_stockfish does)
+    # games_output_dir: also write the per-game table there, as the analyzer's main with output_format 'jsonl' or 'parquet'
+    # queue_size: maximum number of games waiting between two stages, which bounds the memory in use
+    # Writes player_stats.csv to player_stats_output_dir (the same as main_stats would) and returns the stage counters
+    pgn_file_paths = list(iter_pgn_files(input_pgn_dir))
+    stages = _Stages(queue_size)
+    counters = []
+    engine_pool, eval_cache = None, None
+    try:
+        if stockfish_path is not None:
+            eval_cache = EvalCache(cache_path, cache_size) if cache_path else None
+            engine_pool = EnginePool(stockfish_path, pool_size, engine_options)
+            counters = [StageCounter("read"), StageCounter("annotate"), StageCounter("evaluate")]
+            read_queue, annotate_queue, evaluate_queue = stages.queue(), stages.queue(), stages.queue()
+            stages.start(_read_games, counters[0], None, read_queue, pgn_file_paths, True, fast_scan)
+            stages.start(_annotate_games, counters[1], read_queue, annotate_queue, engine_pool, depth, eval_cache,
+                         adaptive, annotated_output_dir, input_pgn_dir)
+            stages.start(_evaluate_games, counters[2], annotate_queue, evaluate_queue, wdl_values, weighted,
+                         games_output_dir, output_format, batch_size)
+        elif workers > 1:
+            counters = [StageCounter("evaluate")]
+            evaluate_queue = stages.queue()
+            stages.start(_evaluate_games_in_parallel, counters[0], None, evaluate_queue, pgn_file_paths, wdl_values,
+                         weighted, fast_scan, workers, chunk_size, games_output_dir, output_format, batch_size)
+        else:
+            counters = [StageCounter("read"), StageCounter("evaluate")]
+            read_queue, evaluate_queue = stages.queue(), stages.queue()
+            stages.start(_read_games, counters[0], None, read_queue, pgn_file_paths, False, fast_scan)
+            stages.start(_evaluate_games, counters[1], read_queue, evaluate_queue, wdl_values, weighted,
+                         games_output_dir, output_format, batch_size)
+        counters.append(StageCounter("aggregate"))
+        try:
+            player_stats = _aggregate_games(stages, counters[-1], evaluate_queue)
+        except _Stopped:
+            player_stats = None
+        except BaseException:
+            stages.stop.set()
+            raise
+        finally:
+            stages.join()
+    finally:
+        if engine_pool is not None:
+            engine_pool.close()
+        if eval_cache is not None:
+            eval_cache.close()
+    start = time.perf_counter()
+    save_player_stats(player_stats, player_stats_output_dir)
+    counters[-1].busy += time.perf_counter() - start
+    print(f"#Games = {counters[-1].items}")
+    for counter in counters:
+        print(counter.report())
+        counts = {"games": counter.items, "plies": counter.plies} if counter.plies else {"games": counter.items}
+        metrics.add("pipeline." + counter.name, counter.busy, **counts)
+        metrics.set_values("pipeline." + counter.name, waiting_for_input=round(counter.waiting_for_input, 6),
+                           waiting_for_output=round(counter.waiting_for_output, 6))
+    metrics.count("pipeline", files=len(pgn_file_paths), games=counters[-1].items)
+    return counters
@@ -0,0 +1,322 @@
+"""
+This script keeps the player statistics of csv_to_player_stats.py up to date incrementally. Per-player aggregates
+(game counts, sums of gi/gi_raw/gpl/acpl, results, moves and Elo ratings by color, and the count, mean and sum of
+squared deviations (M2) of gi/gi_raw/gpl/acpl for the variances, merged with Chan et al.'s formula, which does not
+lose precision the way sums of squares do) are stored in an SQLite file. Each new batch of games (each new file of a
+directory) is folded into them once, and player_stats.csv is regenerated from the aggregates without reading the
+games again. Medians come from a mergeable t-digest per player and metric, or, with exact_medians=True, from every
+stored value.
+"""
+
+import hashlib
+import math
+import os
+import sqlite3
+import time
+
+import numpy as np
+import pandas as pd
+
+from csv_to_player_stats import PLAYER_STATS_COLUMNS, calculate_tpr, csv_files_in, read_games, save_to_csv
+from game_table import GAME_TABLE_EXTENSIONS
+
+METRICS = ['gi', 'gi_raw', 'gpl', 'acpl']
+# Per-color aggregates, e.g. white_gi_sum, black_games
+SIDE_AGGREGATES = ['games'] + [f'{metric}_sum' for metric in METRICS] + ['result_sum', 'move_sum', 'elo_sum', 'elo_count', 'opponent_elo_sum']
+AGGREGATE_COLUMNS = ([f'{color}_{name}' for color in ('white', 'black') for name in SIDE_AGGREGATES] +
+                     [f'{metric}_{name}' for metric in METRICS for name in ('count', 'mean', 'm2')])
+# The count, mean and M2 columns, merged with _merge_moments instead of being added up
+MOMENT_COLUMNS = [f'{metric}_{name}' for metric in METRICS for name in ('count', 'mean', 'm2')]
+
+
+class TDigest:
+    # Merging t-digest (Dunning) with the k1 scale function: centroids are small near the tails and at most
+    # compression / 2 of them are kept, so digests of different batches can be merged without the raw values.
+    # While a digest holds fewer values than about compression / 2, every value is its own centroid and
+    # the quantiles are exact.
+    def __init__(self, compression=100, means=None, weights=None):
+        self.compression = compression
+        self.means = np.empty(0) if means is None else np.asarray(means, dtype=np.float64)
+        self.weights = np.empty(0) if weights is None else np.asarray(weights, dtype=np.float64)
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        self._compress(np.concatenate([self.means, values]), np.concatenate([self.weights, np.ones(len(values))]))
+
+    def merge(self, other):
+        self._compress(np.concatenate([self.means, other.means]), np.concatenate([self.weights, other.weights]))
+
+    def _k(self, q):
+        return self.compression / (2 * math.pi) * math.asin(2 * q - 1)
+
+    def _q(self, k):
+        return (math.sin(min(k, self.compression / 4) * 2 * math.pi / self.compression) + 1) / 2
+
+    def _compress(self, means, weights):
+        if len(means) == 0:
+            return
+        order = np.argsort(means, kind='stable')
+        means, weights = means[order].tolist(), weights[order].tolist()
+        total = sum(weights)
+        new_means, new_weights = [], []
+        mean, weight = means[0], weights[0]
+        cumulative = 0.0
+        q_limit = self._q(self._k(0.0) + 1)
+        for next_mean, next_weight in zip(means[1:], weights[1:]):
+            if (cumulative + weight + next_weight) / total <= q_limit:
+                weight += next_weight
+                mean += (next_mean - mean) * next_weight / weight
+            else:
+                new_means.append(mean)
+                new_weights.append(weight)
+                cumulative += weight
+                q_limit = self._q(self._k(cumulative / total) + 1)
+                mean, weight = next_mean, next_weight
+        new_means.append(mean)
+        new_weights.append(weight)
+        self.means, self.weights = np.array(new_means), np.array(new_weights)
+
+    def quantile(self, q):
+        if len(self.means) == 0:
+            return float('nan')
+        # Each centroid sits at the middle of its weight; with weight-1 centroids this is the usual
+        # interpolated quantile (the mean of the two middle values for the median of an even count)
+        positions = np.cumsum(self.weights) - self.weights / 2
+        return float(np.interp(q * self.weights.sum(), positions, self.means))
+
+    def to_bytes(self):
+        return np.stack([self.means, self.weights]).tobytes()
+
+    @classmethod
+    def from_bytes(cls, data, compression=100):
+        means, weights = np.frombuffer(data, dtype=np.float64).reshape(2, -1)
+        return cls(compression, means.copy(), weights.copy())
+
+
+def _numeric(column):
+    # Unknown Elo ratings ('?') and results of unfinished games ('...') are left out of the sums
+    return pd.to_numeric(column, errors='coerce')
+
+
+def batch_aggregates(df):
+    # Per-player aggregates of a batch of games (columns of csv_to_player_stats.STATS_COLUMNS), and the
+    # long table of (Player, metric values) from both colors for the medians
+    sides, side_values = [], []
+    for color, player, opponent in (('white', 'White', 'Black'), ('black', 'Black', 'White')):
+        side = pd.DataFrame({'Player': df[player]})
+        for metric in METRICS:
+            side[metric] = _numeric(df[f'{color}_{metric}'])
+        side['result'] = _numeric(df[f'{player}Result'])
+        side['move'] = _numeric(df[f'{color}_move_number'])
+        side['elo'] = _numeric(df[f'{player}Elo'])
+        side['opponent_elo'] = _numeric(df[f'{opponent}Elo'])
+        grouped = side.groupby('Player')
+        aggregates = grouped[METRICS + ['result', 'move', 'elo', 'opponent_elo']].sum()
+        aggregates.columns = [f'{color}_{name}_sum' for name in aggregates.columns]
+        aggregates[f'{color}_games'] = grouped.size()
+        aggregates[f'{color}_elo_count'] = grouped['elo'].count()
+        sides.append(aggregates)
+        side_values.append(side[['Player'] + METRICS])
+
+    values = pd.concat(side_values, ignore_index=True)
+    grouped = values.groupby('Player')
+    deviations = (values[METRICS] - grouped[METRICS].transform('mean')) ** 2
+    deviations['Player'] = values['Player']
+    combined = pd.concat([grouped[METRICS].count().add_suffix('_count'), grouped[METRICS].mean().add_suffix('_mean'),
+                          deviations.groupby('Player')[METRICS].sum().add_suffix('_m2')], axis=1)
+    aggregates = pd.concat(sides + [combined], axis=1).fillna(0)
+    return aggregates[AGGREGATE_COLUMNS], values.dropna(subset=['Player'])
+
+
+def _merge_moments(metric):
+    # SQL assignments merging the stored count, mean and M2 of metric with those of the batch (excluded), by Chan et
+    # al.'s pairwise formula; the right-hand sides all see the stored values from before the update
+    count, mean, m2 = f'{metric}_count', f'{metric}_mean', f'{metric}_m2'
+    total = f"({count} + excluded.{count})"
+    delta = f"(excluded.{mean} - {mean})"
+    return [f"{count} = {total}",
+            f"{mean} = CASE WHEN {total} = 0 THEN 0 ELSE {mean} + {delta} * excluded.{count} / {total} END",
+            f"{m2} = CASE WHEN {total} = 0 THEN 0 "
+            f"ELSE {m2} + excluded.{m2} + {delta} * {delta} * {count} * excluded.{count} / {total} END"]
+
+
+def file_batch_id(path):
+    # Content hash of a games file, so the same file is never folded in twice
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class PlayerStatsStore:
+    def __init__(self, path, exact_medians=False, compression=100):
+        # exact_medians keeps every gi/gi_raw/gpl/acpl value in the store (larger file, slower updates);
+        # otherwise medians are t-digest estimates, exact for players with fewer than about compression / 2 games
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        settings = dict(self._conn.execute("SELECT name, value FROM meta").fetchall())
+        if not settings:
+            settings = {"exact_medians": str(int(exact_medians)), "compression": str(compression)}
+            self._conn.executemany("INSERT INTO meta (name, value) VALUES (?, ?)", settings.items())
+        elif settings["exact_medians"] != str(int(exact_medians)):
+            raise ValueError(f"{path} was created with exact_medians={bool(int(settings['exact_medians']))}")
+        self.exact_medians = exact_medians
+        self.compression = int(settings["compression"])
+        columns = ", ".join(f"{name} REAL NOT NULL DEFAULT 0" for name in AGGREGATE_COLUMNS)
+        self._conn.execute(f"CREATE TABLE IF NOT EXISTS players (player TEXT PRIMARY KEY, {columns}) WITHOUT ROWID")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS medians (
+                player TEXT NOT NULL,
+                metric TEXT NOT NULL,
+                median REAL,
+                digest BLOB,
+                PRIMARY KEY (player, metric)
+            ) WITHOUT ROWID""")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS metric_values (player TEXT NOT NULL, metric TEXT NOT NULL, value REAL NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS metric_values_player ON metric_values (player, metric)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS batches (batch_id TEXT PRIMARY KEY, games INTEGER NOT NULL, added_at REAL NOT NULL)")
+        self._conn.commit()
+
+    def has_batch(self, batch_id):
+        return self._conn.execute("SELECT 1 FROM batches WHERE batch_id = ?", (batch_id,)).fetchone() is not None
+
+    def add_games(self, df, batch_id):
+        # Fold a batch of games into the aggregates in one transaction; returns False if batch_id was already added
+        if self.has_batch(batch_id):
+            return False
+        aggregates, values = batch_aggregates(df)
+        with self._conn:
+            self._conn.execute("INSERT INTO batches (batch_id, games, added_at) VALUES (?, ?, ?)", (batch_id, len(df), time.time()))
+            columns = ", ".join(AGGREGATE_COLUMNS)
+            placeholders = ", ".join("?" * (len(AGGREGATE_COLUMNS) + 1))
+            updates = ", ".join([f"{name} = {name} + excluded.{name}" for name in AGGREGATE_COLUMNS if name not in MOMENT_COLUMNS] +
+                                [assignment for metric in METRICS for assignment in _merge_moments(metric)])
+            self._conn.executemany(
+                f"INSERT INTO players (player, {columns}) VALUES ({placeholders}) ON CONFLICT (player) DO UPDATE SET {updates}",
+                ((player,) + tuple(row) for player, row in zip(aggregates.index, aggregates.itertuples(index=False))))
+            for metric in METRICS:
+                metric_values = values[['Player', metric]].dropna()
+                if self.exact_medians:
+                    self._update_exact_medians(metric, metric_values)
+                else:
+                    self._update_digests(metric, metric_values)
+        return True
+
+    def _update_digests(self, metric, metric_values):
+        rows = []
+        for player, group in metric_values.groupby('Player')[metric]:
+            row = self._conn.execute("SELECT digest FROM medians WHERE player = ? AND metric = ?", (player, metric)).fetchone()
+            digest = TDigest(self.compression) if row is None else TDigest.from_bytes(row[0], self.compression)
+            digest.update(group.to_numpy())
+            rows.append((player, metric, digest.quantile(0.5), digest.to_bytes()))
+        self._conn.executemany("INSERT OR REPLACE INTO medians (player, metric, median, digest) VALUES (?, ?, ?, ?)", rows)
+
+    def _update_exact_medians(self, metric, metric_values):
+        self._conn.executemany("INSERT INTO metric_values (player, metric, value) VALUES (?, ?, ?)",
+                               ((player, metric, value) for player, value in metric_values.itertuples(index=False)))
+        rows = []
+        for player in metric_values['Player'].unique():
+            stored = np.array([value for value, in self._conn.execute(
+                "SELECT value FROM metric_values WHERE player = ? AND metric = ?", (player, metric))])
+            rows.append((player, metric, float(np.median(stored)), None))
+        self._conn.executemany("INSERT OR REPLACE INTO medians (player, metric, median, digest) VALUES (?, ?, ?, ?)", rows)
+
+    def aggregates(self):
+        return pd.read_sql_query(f"SELECT player, {', '.join(AGGREGATE_COLUMNS)} FROM players ORDER BY player",
+                                 self._conn).rename(columns={'player': 'Player'})
+
+    def medians(self):
+        medians = pd.read_sql_query("SELECT player, metric, median FROM medians", self._conn)
+        medians = medians.pivot(index='player', columns='metric', values='median')
+        return medians.reindex(columns=METRICS).add_suffix('_median')
+
+    def player_stats(self):
+        # The player_stats DataFrame of csv_to_player_stats.main_stats, computed from the stored aggregates
+        aggregates = self.aggregates()
+        if aggregates.empty:
+            return pd.DataFrame(columns=PLAYER_STATS_COLUMNS)
+        player_stats = player_stats_from_aggregates(aggregates.set_index('Player'), self.medians())
+        return player_stats.sort_values(by='avg_gi', ascending=False)
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def player_stats_from_aggregates(aggregates, medians):
+    # Same definitions as main_stats: averages are per game, variances are sample variances, and missing values
+    # (e.g. the variance of a single game) are 0
+    stats = pd.DataFrame(index=aggregates.index)
+    stats['White_games'] = aggregates['white_games'].astype('int64')
+    stats['Black_games'] = aggregates['black_games'].astype('int64')
+    stats['total_game_count'] = stats['White_games'] + stats['Black_games']
+    games = stats['total_game_count']
+    for metric in METRICS:
+        total = aggregates[f'white_{metric}_sum'] + aggregates[f'black_{metric}_sum']
+        count = aggregates[f'{metric}_count']
+        stats[f'avg_{metric}'] = total / games
+        variance = aggregates[f'{metric}_m2'] / (count - 1)
+        stats[f'{metric}_var'] = variance.where(count > 1, 0).clip(lower=0)
+        stats[f'{metric}_std'] = np.sqrt(stats[f'{metric}_var'])
+        stats[f'{metric}_median'] = medians[f'{metric}_median'].reindex(aggregates.index).fillna(0)
+    for color in ('white', 'black'):
+        stats[f'{color}_gpl_sum'] = aggregates[f'{color}_gpl_sum']
+        stats[f'{color}_acpl_sum'] = aggregates[f'{color}_acpl_sum']
+        stats[f'{color}_result_sum'] = aggregates[f'{color}_result_sum']
+    stats['total_gpl_sum'] = stats['white_gpl_sum'] + stats['black_gpl_sum']
+    stats['Points'] = stats['white_result_sum'] + stats['black_result_sum']
+    stats['total_moves'] = aggregates['white_move_sum'] + aggregates['black_move_sum']
+    stats['avg_opponent_elo'] = (aggregates['white_opponent_elo_sum'] + aggregates['black_opponent_elo_sum']) / games
+
+    white_elo = (aggregates['white_elo_sum'] / aggregates['white_elo_count']).fillna(0)
+    black_elo = (aggregates['black_elo_sum'] / aggregates['black_elo_count']).fillna(0)
+    stats['Elo'] = np.round(np.where((white_elo > 0) & (black_elo > 0), (white_elo + black_elo) / 2, np.maximum(white_elo, black_elo)), 0)
+
+    stats = calculate_tpr(stats.reset_index())
+    return stats[PLAYER_STATS_COLUMNS]
+
+
+def _batch_files(games_path):
+    # The files of a directory of games that are folded in one by one: its CSV files (without combine_csv_files'
+    # output), or else its .jsonl/.parquet game tables
+    files = csv_files_in(games_path)
+    if not files:
+        files = [os.path.join(dirpath, filename) for dirpath, dirnames, filenames in os.walk(games_path)
+                 for filename in filenames if filename.endswith(GAME_TABLE_EXTENSIONS)]
+    return sorted(files)
+
+
+def main_stats_incremental(games_path, store_path, player_stats_output_dir, batch_id=None, exact_medians=False):
+    # Fold the games of games_path (anything csv_to_player_stats.read_games accepts) into the store at store_path,
+    # unless this batch was added before, and write player_stats.csv from the store. batch_id defaults to
+    # a content hash of the file; for a directory, each of its files is a batch of its own, so that the files added
+    # to it since the last call are folded in (a batch_id given for a directory makes the whole directory one batch).
+    with PlayerStatsStore(store_path, exact_medians) as store:
+        if games_path is not None:
+            if batch_id is None and os.path.isdir(games_path):
+                batches = [(file_batch_id(path), path) for path in _batch_files(games_path)]
+            else:
+                batches = [(batch_id if batch_id is not None else file_batch_id(games_path), games_path)]
+            for batch_id, path in batches:
+                if store.has_batch(batch_id):
+                    print(f"Batch {batch_id} ({path}) was already added to {store_path}")
+                    continue
+                games = read_games(path)
+                store.add_games(games, batch_id)
+                print(f"Added {len(games)} games of {path} to {store_path}")
+        player_stats = store.player_stats()
+
+    if not os.path.exists(player_stats_output_dir):
+        os.makedirs(player_stats_output_dir)
+    output_file_path = os.path.join(player_stats_output_dir, 'player_stats.csv')
+    save_to_csv(player_stats, output_file_path)
+    return player_stats
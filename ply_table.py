@@ -0,0 +1,199 @@
+"""
+This script stores the per-move data of the analyzer (see ply_arrays in pgn_evaluation_fast_analyzer.py) as a compact
+columnar table, and reads it back by game or by player without loading the whole corpus.
+
+A ply table is a directory with one .npy file per column of PLY_SCHEMA (one row per evaluated move, the games one
+after the other) and a game index, games.npy, with one row per game: its key (as in the analyzer's per-game output),
+the row of its first move, its number of moves and the ids of its players in players.txt (one JSON string per
+line, so that the analyzer's and converter's readers never mistake it for their own files). The .npy files are opened
+memory-mapped, so a query only reads the rows it needs.
+"""
+
+import io
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+# Columns of a ply table, in order, with their dtypes. mover is 0 for White and 1 for Black; eval is in pawns from
+# White's point of view (mates as +-100); the expectations are the mover's expected points before and after the move,
+# and point_loss is the move's part of the mover's GPL (normalized as the GPL is).
+PLY_SCHEMA = [
+    ("game", "int32"),
+    ("ply", "int16"),
+    ("mover", "int8"),
+    ("eval", "float32"),
+    ("pre_expectation", "float32"),
+    ("post_expectation", "float32"),
+    ("point_loss", "float32"),
+]
+PLY_COLUMNS = [name for name, dtype in PLY_SCHEMA]
+INDEX_DTYPE = np.dtype([("key", "<i4"), ("start", "<i8"), ("plies", "<i4"), ("white", "<i4"), ("black", "<i4")])
+PLY_TABLE_EXTENSION = ".plies"
+
+
+def _npy_header(dtype, rows, size=None):
+    # The .npy (version 1.0) header of a 1-D array, padded with spaces to size bytes if given
+    header = io.BytesIO()
+    np.lib.format.write_array_header_1_0(header, {"descr": np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                                                  "fortran_order": False, "shape": (rows,)})
+    header = header.getvalue()
+    if size is not None:
+        padding = size - len(header)
+        header = header[:8] + (len(header) - 10 + padding).to_bytes(2, 'little') + header[10:-1] + b" " * padding + b"\n"
+    return header
+
+
+class _NpyAppender:
+    # A 1-D .npy file written in appended blocks; the header, with room for any number of rows, is written on close
+    def __init__(self, path, dtype):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.rows = 0
+        self._header_size = len(_npy_header(self.dtype, 10 ** 18))
+        self._handle = open(path, 'wb')
+        self._handle.write(b"\0" * self._header_size)
+
+    def append(self, values):
+        values = np.ascontiguousarray(values, dtype=self.dtype)
+        self._handle.write(values.tobytes())
+        self.rows += len(values)
+
+    def close(self):
+        self._handle.seek(0)
+        self._handle.write(_npy_header(self.dtype, self.rows, self._header_size))
+        self._handle.close()
+
+
+class PlyTableWriter:
+    def __init__(self, path, batch_size=10000):
+        # path: the ply table directory, written as path + ".tmp" and renamed into place on close
+        self.path = path
+        self.batch_size = batch_size
+        self.games_written = 0
+        self._temp_path = path + ".tmp"
+        shutil.rmtree(self._temp_path, ignore_errors=True)
+        os.makedirs(self._temp_path)
+        self._columns = {name: _NpyAppender(os.path.join(self._temp_path, name + ".npy"), dtype)
+                         for name, dtype in PLY_SCHEMA}
+        self._index = _NpyAppender(os.path.join(self._temp_path, "games.npy"), INDEX_DTYPE)
+        self._players = {}
+        self._batch = []
+        self._index_rows = []
+        self._rows = 0
+
+    def _player_id(self, name):
+        if name not in self._players:
+            self._players[name] = len(self._players)
+        return self._players[name]
+
+    def write(self, key, white, black, plies):
+        # plies: {column: array} of one game's moves, without the game column (see ply_arrays)
+        moves = len(plies["ply"])
+        self._batch.append((key, plies))
+        self._index_rows.append((key, self._rows, moves, self._player_id(white), self._player_id(black)))
+        self._rows += moves
+        if len(self._batch) >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        if not self._batch:
+            return
+        self._columns["game"].append(np.concatenate([np.full(len(plies["ply"]), key) for key, plies in self._batch]))
+        for name in PLY_COLUMNS[1:]:
+            self._columns[name].append(np.concatenate([plies[name] for key, plies in self._batch]))
+        self._index.append(np.array(self._index_rows, dtype=INDEX_DTYPE))
+        self.games_written += len(self._batch)
+        self._batch = []
+        self._index_rows = []
+
+    def close(self):
+        self._flush()
+        for appender in list(self._columns.values()) + [self._index]:
+            appender.close()
+        with open(os.path.join(self._temp_path, "players.txt"), 'w', encoding='utf-8') as f:
+            f.writelines(json.dumps(name, ensure_ascii=False) + "\n" for name in self._players)
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.replace(self._temp_path, self.path)
+
+    def output_paths(self):
+        # The files of the table, once closed
+        return [os.path.join(self.path, name) for name in sorted(os.listdir(self.path))]
+
+
+def renumber_ply_table(path, shift):
+    # Add shift to the game keys of a ply table, in place
+    for name, field in (("game.npy", None), ("games.npy", "key")):
+        array = np.load(os.path.join(path, name), mmap_mode="r+")
+        if field is None:
+            array += shift
+        else:
+            array[field] += shift
+        array.flush()
+        del array
+
+
+class PlyTable:
+    def __init__(self, path):
+        self.path = path
+        self.games = np.load(os.path.join(path, "games.npy"), mmap_mode="r")
+        with open(os.path.join(path, "players.txt"), encoding='utf-8') as f:
+            self.players = [json.loads(line) for line in f]
+        self._columns = {}
+
+    def __len__(self):
+        return int(self.games["plies"].sum()) if len(self.games) else 0
+
+    def column(self, name):
+        if name not in self._columns:
+            self._columns[name] = np.load(os.path.join(self.path, name + ".npy"), mmap_mode="r")
+        return self._columns[name]
+
+    def _frame(self, rows, columns):
+        # DataFrame of the given rows (a slice or an index array) of the columns
+        return pd.DataFrame({name: np.asarray(self.column(name)[rows]) for name in (columns or PLY_COLUMNS)})
+
+    def game(self, key, columns=None):
+        # The moves of the game with this key (keys are increasing), or None
+        position = np.searchsorted(self.games["key"], key)
+        if position == len(self.games) or self.games["key"][position] != key:
+            return None
+        start, plies = int(self.games["start"][position]), int(self.games["plies"][position])
+        return self._frame(slice(start, start + plies), columns)
+
+    def player_moves(self, player, columns=None):
+        # The moves made by player (a White/Black header value) in all of their games
+        if player not in self.players:
+            return self._frame(slice(0, 0), columns)
+        player_id = self.players.index(player)
+        rows = []
+        for mover, side in ((0, "white"), (1, "black")):
+            games = self.games[self.games[side] == player_id]
+            for start, plies in zip(games["start"].tolist(), games["plies"].tolist()):
+                game_rows = np.arange(start, start + plies)
+                rows.append(game_rows[self.column("mover")[start:start + plies] == mover])
+        rows = np.sort(np.concatenate(rows)) if rows else np.empty(0, dtype=np.int64)
+        return self._frame(rows, columns)
+
+    def to_frame(self, columns=None):
+        return self._frame(slice(None), columns)
+
+
+def iter_ply_tables(path):
+    # The ply tables of a directory (or the table itself), in path order
+    if os.path.exists(os.path.join(path, "games.npy")):
+        yield PlyTable(path)
+        return
+    for name in sorted(os.listdir(path)):
+        if name.endswith(PLY_TABLE_EXTENSION):
+            yield PlyTable(os.path.join(path, name))
+
+
+def read_player_moves(path, player, columns=None):
+    # The moves of player in all ply tables of path (e.g. the analyzer's ply_output_dir), as one DataFrame
+    frames = [table.player_moves(player, columns) for table in iter_ply_tables(path)]
+    if not frames:
+        return pd.DataFrame({name: pd.Series(dtype=dict(PLY_SCHEMA)[name]) for name in (columns or PLY_COLUMNS)})
+    return pd.concat(frames, ignore_index=True)
@@ -1,42 +1,313 @@
 """
 This script annotates each game with Stockfish evaluations in each PGN file in a directory.
+
+Each output is written to a temporary file that is renamed into place when complete, with a checkpoint after every
+game, so main_stockfish(..., resume=True) continues an interrupted run without redoing finished games. With
+pool_size > 1, the games of all files are analyzed in parallel by an engine pool and written back in their order.
 """
 
 import chess
 import chess.engine
 import chess.pgn
+import io
+import json
 import os
 import time
+import metrics
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from engine_pool import EnginePool
+from eval_cache import EvalCache
+from file_manifest import FileManifest
+from pgn_index import PGN_INDEX, select_games
+
+# Manifest of the annotated files, in the output directory
+ANNOTATOR_MANIFEST = '.annotator_manifest'
+
+def analyze_game_with_stockfish(file_path, engine_pool, depth, output_directory, input_dir_path, eval_cache=None):
+    # engine_pool is an EnginePool; a path to the engine executable is also accepted for a one-off pool
+    if not isinstance(engine_pool, EnginePool):
+        with EnginePool(engine_pool) as pool:
+            return analyze_game_with_stockfish(file_path, pool, depth, output_directory, input_dir_path, eval_cache)
+    annotate_games([file_path], engine_pool, depth, output_directory, input_dir_path, eval_cache)
+
+def iter_pgn_files(input_dir_path):
+    for subdir, dirs, files in os.walk(input_dir_path):
+        for file in files:
+            if file.endswith(".pgn"):
+                yield os.path.join(subdir, file)
+
+def iter_games(file_paths):
+    # Yield (file_path, game) for each game in each PGN file, in file order
+    for file_path in file_paths:
+        for game, offset in iter_file_games(file_path):
+            yield file_path, game
 
-def analyze_game_with_stockfish(file_path, stockfish_path, depth, output_directory, input_dir_path):
-    # Open and read the PGN file
+def iter_file_games(file_path, start_offset=0):
+    # Yield (game, offset just after the game) for each game in the PGN file, starting at start_offset
     with open(file_path) as pgn_file:
+        pgn_file.seek(start_offset)
         while True:  # Loop to process each game in the PGN file
             game = chess.pgn.read_game(pgn_file)
             if game is None:
                 break  # No more games in the file
+            yield game, pgn_file.tell()
 
-            scores = []
-            with chess.engine.SimpleEngine.popen_uci(stockfish_path) as engine:
-                node = game
-                while node.variations:
-                    next_node = node.variations[0]
-                    board = next_node.board()
-                    info = engine.analyse(board, chess.engine.Limit(depth=depth))
-                    score = info.get("score", None)
-                    if score is not None:
-                        cp = score.relative.score(mate_score=10000)
-                        evaluation = cp / 100.0
-                        if not board.turn:
-                            evaluation *= -1
-                        scores.append(evaluation)
-                    node = next_node
-
-            # Call the function to annotate the game with the scores
-            annotate_game_with_scores(game, scores, file_path, output_directory, input_dir_path)
+def iter_selected_games(file_path, ranges, start_offset=0):
+    # Yield (game, offset just after the game) for the games at the (offset, length) byte ranges of the PGN file,
+    # e.g. those a query selects through the PGN index, from start_offset on
+    with open(file_path, 'rb') as pgn_file:
+        for offset, length in ranges:
+            if offset < start_offset:
+                continue
+            pgn_file.seek(offset)
+            game = chess.pgn.read_game(io.StringIO(pgn_file.read(length).decode('utf-8', errors='replace')))
+            if game is not None:
+                yield game, offset + length
 
-def annotate_game_with_scores(game, scores, file_path, output_directory, input_dir_path):
+def annotate_games(file_paths, engine_pool, depth, output_directory, input_dir_path, eval_cache=None, resume=False, adaptive=None,
+                   manifest=None, force=False, selection=None):
+    # Analyze games concurrently, one game per engine in the pool, and write them back in their original order.
+    # At most a few games per engine are in flight, so memory stays bounded however large the corpus is.
+    # With a FileManifest, files annotated by an earlier run with the same settings are skipped if they have not
+    # changed since (unless force=True), and every finished file is recorded in it.
+    # With a selection ({absolute path: game ranges}, see pgn_index.py), only the selected games are annotated.
+    max_in_flight = 4 * engine_pool.size
+    in_flight = deque()
+    writers = []
+    with ThreadPoolExecutor(max_workers=engine_pool.size) as executor:
+        try:
+            for writer, games in iter_files_to_annotate(file_paths, output_directory, input_dir_path, resume, manifest,
+                                                        force, selection):
+                writers.append(writer)
+                for game, offset in games:
+                    future = executor.submit(analyze_game_scores, game, engine_pool, depth, eval_cache, adaptive)
+                    in_flight.append((writer, game, offset, future))
+                    # Write finished games from the head of the queue only, which keeps the output order deterministic
+                    while in_flight and (len(in_flight) >= max_in_flight or _is_ready(in_flight[0])):
+                        _write_next(in_flight, manifest)
+                # Marks the end of the file: the writer is finalized once all of its games are written
+                in_flight.append((writer, None, None, None))
+            while in_flight:
+                _write_next(in_flight, manifest)
+        except BaseException:
+            # Handled inside the with block, so that the queued games are cancelled before the executor waits for
+            # its threads (only the games already being analyzed are finished). The temporary outputs and
+            # checkpoints are left in place so the run can be resumed.
+            executor.shutdown(wait=False, cancel_futures=True)
+            for writer in writers:
+                writer.abort()
+            raise
+
+def iter_files_to_annotate(file_paths, output_directory, input_dir_path, resume=False, manifest=None, force=False,
+                           selection=None):
+    # Yield (writer, games) for each file that needs annotating, where games yields (game, offset just after the game)
+    # from the writer's resume point on; files that are current in the manifest or already annotated are skipped.
+    # With a manifest, an output that is not current is annotated again from scratch, and only a checkpoint made
+    # from the same input with the same settings is resumed.
+    for file_path in file_paths:
+        source = None
+        if manifest is not None:
+            if not force and manifest.is_current(file_path):
+                print(f"Skipping {file_path}: unchanged since it was annotated")
+                continue
+            # Fingerprint the input before it is read
+            source = {"sha256": manifest.fingerprint(file_path)["sha256"], "params": manifest.params}
+        writer = AnnotatedPGNWriter(file_path, output_directory, input_dir_path, resume, source)
+        if writer.complete:
+            print(f"Skipping {file_path}: already annotated")
+            continue
+        if writer.games_written:
+            print(f"Resuming {file_path} after {writer.games_written} games")
+        if selection is not None:
+            games = iter_selected_games(file_path, selection[os.path.abspath(file_path)], writer.input_offset)
+        else:
+            games = iter_file_games(file_path, writer.input_offset)
+        yield writer, games
+
+def _is_ready(item):
+    future = item[3]
+    return future is None or future.done()
+
+def _write_next(in_flight, manifest=None):
+    writer, game, offset, future = in_flight.popleft()
+    if game is None:
+        writer.close()
+        if manifest is not None:
+            manifest.record(writer.file_path, [writer.output_path])
+        return
+    scores = future.result()
+    add_scores_to_game(game, scores)
+    start = time.perf_counter()
+    writer.write(game, offset)
+    metrics.add("annotate.write", time.perf_counter() - start, games=1)
+    metrics.count("annotate", games=1, plies=len(scores))
+
+def annotated_output_path(file_path, output_directory, input_dir_path):
+    # The annotated file mirrors the input's location under the output directory
+    relative_path = Path(file_path).relative_to(input_dir_path)
+    dest_folder = Path(output_directory) / relative_path.parent
+    base_name = os.path.splitext(os.path.basename(file_path))[0]
+    return dest_folder / f"{base_name}_annotated.pgn"
+
+class AnnotatedPGNWriter:
+    # Streams the annotated games of one input file through a single buffered handle to a temporary file,
+    # which is atomically renamed to <name>_annotated.pgn once every game is written.
+    # After each game, a checkpoint manifest records the number of games written, the input offset just after
+    # the last written game and the size of the temporary output, so an interrupted run can resume exactly there.
+    # source (e.g. the input's hash and the settings) is saved in the checkpoint, and a checkpoint with another source
+    # is not resumed. Without a source, resume also takes an existing output as complete.
+    def __init__(self, file_path, output_directory, input_dir_path, resume=False, source=None):
+        self.file_path = file_path
+        self.output_path = annotated_output_path(file_path, output_directory, input_dir_path)
+        self.temp_path = self.output_path.with_name(self.output_path.name + ".tmp")
+        self.checkpoint_path = self.output_path.with_name(self.output_path.name + ".checkpoint.json")
+        self.games_written, self.input_offset = 0, 0
+        self.complete = False
+        self.source = source
+        self._handle = None
+        checkpoint = self._read_checkpoint() if resume else None
+        if checkpoint is not None and source is not None and checkpoint.get("source") != source:
+            print(f"Not resuming {file_path}: its checkpoint was made from another input or with other settings")
+            checkpoint = None
+        if resume and checkpoint is None and source is None and self.output_path.exists():
+            self.complete = True
+            return
+        self.output_path.parent.mkdir(parents=True, exist_ok=True)
+        if checkpoint is not None and self.temp_path.exists():
+            # Drop anything written after the last checkpoint, e.g. a partially written game
+            os.truncate(self.temp_path, checkpoint["output_size"])
+            self.games_written, self.input_offset = checkpoint["games_written"], checkpoint["input_offset"]
+            self._handle = open(self.temp_path, 'a', encoding='utf-8')
+        else:
+            self._handle = open(self.temp_path, 'w', encoding='utf-8')
+
+    def _read_checkpoint(self):
+        try:
+            with open(self.checkpoint_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def write(self, game, input_offset):
+        exporter = chess.pgn.FileExporter(self._handle)
+        game.accept(exporter)
+        self._handle.flush()
+        os.fsync(self._handle.fileno())
+        self.games_written += 1
+        self.input_offset = input_offset
+        checkpoint = {"games_written": self.games_written, "input_offset": input_offset, "output_size": self._handle.tell()}
+        if self.source is not None:
+            checkpoint["source"] = self.source
+        temp_checkpoint_path = self.checkpoint_path.with_name(self.checkpoint_path.name + ".tmp")
+        with open(temp_checkpoint_path, 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(temp_checkpoint_path, self.checkpoint_path)
+
+    def close(self):
+        self._handle.close()
+        os.replace(self.temp_path, self.output_path)
+        if self.checkpoint_path.exists():
+            os.remove(self.checkpoint_path)
+
+    def abort(self):
+        if self._handle is not None and not self._handle.closed:
+            self._handle.close()
+
+def analyze_game_scores(game, engine_pool, depth, eval_cache=None, adaptive=None, max_restarts=2):
+    # Analyze every position of the game with an engine borrowed from the pool.
+    # If the engine crashes, the pool restarts it and the game is analyzed again from scratch.
+    for attempt in range(max_restarts + 1):
+        try:
+            with engine_pool.engine() as engine:
+                if adaptive is not None:
+                    return _analyze_positions_adaptive(game, engine, depth, eval_cache, adaptive)
+                return _analyze_positions(game, engine, depth, eval_cache)
+        except chess.engine.EngineTerminatedError:
+            if attempt == max_restarts:
+                raise
+            print(f"Engine terminated while analyzing {game.headers.get('White')} - {game.headers.get('Black')}, restarting")
+
+def _analyze_positions(game, engine, depth, eval_cache=None):
+    scores = []
+    # Step one board through the mainline instead of rebuilding it from the root at every ply
+    board = game.board()
+    for move in game.mainline_moves():
+        board.push(move)
+        cp, nodes = _analyse_cp(engine, board, depth, game, eval_cache)
+        if cp is not None:
+            scores.append(_white_evaluation(cp, board))
+    return scores
+
+def _analyze_positions_adaptive(game, engine, depth, eval_cache, adaptive):
+    # Same output as _analyze_positions, but a position only gets the full depth when adaptive asks for it
+    evaluations = []
+    forced = []  # indices of positions that take the value of the next searched position
+    board = game.board()
+    nodes, start = 0, time.perf_counter()
+    for move in game.mainline_moves():
+        board.push(move)
+        if adaptive.skip_forced and board.legal_moves.count() == 1:
+            # The reply is forced, so the position is worth as much as the next one, which is searched at the next ply
+            forced.append(len(evaluations))
+            evaluations.append(None)
+            adaptive.record(forced=1)
+            continue
+        cp, used = _analyse_cp(engine, board, adaptive.shallow_depth, game, eval_cache)
+        nodes += used
+        if cp is not None and adaptive.needs_deep_search(cp):
+            if adaptive.budget_exhausted(nodes, time.perf_counter() - start):
+                adaptive.record(budget_limited=1, shallow=1)
+            else:
+                deep_cp, used = _analyse_cp(engine, board, depth, game, eval_cache)
+                nodes += used
+                cp = deep_cp if deep_cp is not None else cp
+                adaptive.record(deep=1)
+        else:
+            adaptive.record(shallow=1)
+        evaluation = _white_evaluation(cp, board) if cp is not None else None
+        for index in forced:
+            evaluations[index] = evaluation
+        forced = []
+        evaluations.append(evaluation)
+    if forced:
+        # The game ended in a chain of forced positions: they are all worth the final position
+        cp, used = _analyse_cp(engine, board, adaptive.shallow_depth, game, eval_cache)
+        nodes += used
+        for index in forced:
+            evaluations[index] = _white_evaluation(cp, board) if cp is not None else None
+    adaptive.record(positions=len(evaluations), nodes=nodes)
+    return [evaluation for evaluation in evaluations if evaluation is not None]
+
+def _white_evaluation(cp, board):
+    # Convert a score relative to the side to move into pawns from White's point of view
+    evaluation = cp / 100.0
+    if not board.turn:
+        evaluation *= -1
+    return evaluation
+
+def _analyse_cp(engine, board, depth, game, eval_cache=None):
+    # Score of the position in centipawns relative to the side to move, from the cache when available,
+    # and the number of engine nodes searched to get it
+    if eval_cache is not None:
+        cp = eval_cache.get(board, depth)
+        if cp is not None:
+            return cp, 0
+    # Passing the game makes python-chess send ucinewgame when the engine switches to a new game
+    start = time.perf_counter()
+    info = engine.analyse(board, chess.engine.Limit(depth=depth), game=game)
+    # Summed over the engines of the pool, so nodes_per_second is the speed of one engine
+    metrics.add("annotate.engine", time.perf_counter() - start, positions=1, nodes=info.get("nodes", 0))
+    score = info.get("score", None)
+    if score is None:
+        return None, info.get("nodes", 0)
+    cp = score.relative.score(mate_score=10000)
+    if eval_cache is not None:
+        eval_cache.put(board, depth, cp)
+    return cp, info.get("nodes", 0)
+
+def add_scores_to_game(game, scores):
     # Iterate over the nodes and add the scores as comments
     node = game
     score_index = 0
@@ -49,20 +320,58 @@ def annotate_game_with_scores(game, scores, file_path, output_directory, input_d
         node = next_node
         score_index += 1
 
-    # Construct the output file path and save the game
-    relative_path = Path(file_path).relative_to(input_dir_path)
-    dest_folder = Path(output_directory) / relative_path.parent
-    dest_folder.mkdir(parents=True, exist_ok=True)
-    base_name = os.path.splitext(os.path.basename(file_path))[0]
-    output_file_path = dest_folder / f"{base_name}_annotated.pgn"
-
+def annotate_game_with_scores(game, scores, file_path, output_directory, input_dir_path):
+    # Append a single annotated game to its output file; annotate_games streams whole files through AnnotatedPGNWriter instead
+    add_scores_to_game(game, scores)
+    output_file_path = annotated_output_path(file_path, output_directory, input_dir_path)
+    output_file_path.parent.mkdir(parents=True, exist_ok=True)
     with open(output_file_path, 'a') as annotated_pgn:  # 'a' to append each game
         exporter = chess.pgn.FileExporter(annotated_pgn)
         game.accept(exporter)
-        
-def main_stockfish(input_dir_path, output_directory, stockfish_path, DEPTH):
-    for subdir, dirs, files in os.walk(input_dir_path):
-        for file in files:
-            if file.endswith(".pgn"):
-                file_path = os.path.join(subdir, file)
-                analyze_game_with_stockfish(file_path, stockfish_path, DEPTH, output_directory, input_dir_path)
+
+
+def annotation_inputs(input_dir_path, output_directory, query=None, index_path=None, **params):
+    # The PGN files to annotate, the games a query selects in them (None without a query), and the manifest of
+    # output_directory for the settings in params
+    file_paths = list(iter_pgn_files(input_dir_path))
+    selection = None
+    if query is not None:
+        selection = select_games(file_paths, query, index_path or os.path.join(input_dir_path, PGN_INDEX))
+        file_paths = [file_path for file_path in file_paths if os.path.abspath(file_path) in selection]
+        params["query"] = query
+    return file_paths, selection, FileManifest(os.path.join(output_directory, ANNOTATOR_MANIFEST), params)
+
+
+@metrics.timed("annotate")
+def main_stockfish(input_dir_path, output_directory, stockfish_path, DEPTH, pool_size=1, engine_options=None,
+                   cache_path=None, cache_size=1_000_000, resume=False, adaptive=None, force=False, query=None, index_path=None):
+    # With resume=True, finished files are skipped and interrupted files continue from their last checkpoint;
+    # otherwise every output is rewritten from scratch.
+    # Files annotated by an earlier run into output_directory with the same engine, engine options, depth and adaptive
+    # settings are skipped if they have not changed since (see file_manifest.py); force=True annotates every file again.
+    # adaptive is an optional AdaptiveSearch: DEPTH is then only used where the expected score is sensitive.
+    # query: only annotate the games it selects through the PGN index at index_path (by default PGN_INDEX in
+    # input_dir_path; see pgn_index.py), e.g. {"has_evals": False}; the annotated files hold only those games.
+    # Optionally reuse evaluations of positions seen in earlier games or runs
+    eval_cache = EvalCache(cache_path, cache_size) if cache_path else None
+    file_paths, selection, manifest = annotation_inputs(
+        input_dir_path, output_directory, query, index_path, engine=stockfish_path, engine_options=engine_options or {},
+        depth=DEPTH, adaptive=adaptive.settings() if adaptive is not None else None)
+    try:
+        # Start the engines once; games from all files are spread across them
+        with EnginePool(stockfish_path, pool_size, engine_options) as engine_pool:
+            annotate_games(file_paths, engine_pool, DEPTH, output_directory, input_dir_path, eval_cache, resume, adaptive,
+                           manifest, force, selection)
+            if engine_pool.restarts:
+                print(f"Engines restarted after crashes: {engine_pool.restarts}")
+            metrics.set_values("engine_pool", size=engine_pool.size, restarts=engine_pool.restarts)
+            if adaptive is not None:
+                print(adaptive.report())
+                metrics.set_values("adaptive_search", **adaptive.counts)
+    finally:
+        if eval_cache is not None:
+            stats = eval_cache.stats()
+            eval_cache.close()
+            metrics.set_values("eval_cache", **stats)
+            print(f"Evaluation cache: {stats['hits']} hits, {stats['misses']} misses "
+                  f"({100 * stats['hit_rate']:.1f}% hit rate), {stats['entries']} entries, {stats['evictions']} evicted")
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The scripts are flat modules in the repository root, imported as in main.py and the benchmarks
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, "benchmarks"))
@@ -0,0 +1,95 @@
+import os
+import sys
+
+import pytest
+
+import corpus
+import stockfish_pgn_annotator
+from stockfish_pgn_annotator import AnnotatedPGNWriter, main_stockfish
+
+STUB_ENGINE = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(corpus.__file__)), "stub_uci_engine.py")]
+DEPTH = 4
+
+
+@pytest.fixture
+def input_dir(tmp_path):
+    directory = tmp_path / "pgn"
+    corpus.write_corpus(str(directory), 6, annotated=False, games_per_file=3)
+    return directory
+
+
+def annotate(input_dir, output_dir, **kwargs):
+    main_stockfish(str(input_dir), str(output_dir), STUB_ENGINE, DEPTH, **kwargs)
+
+
+def read_outputs(output_dir):
+    return {path.name: path.read_bytes() for path in sorted(output_dir.rglob("*_annotated.pgn"))}
+
+
+def interrupt_during_write(monkeypatch, input_dir, output_dir, game_number):
+    # Run main_stockfish and stop it while it writes the given game, after part of it reached the temporary output;
+    # returns the name of the interrupted input file
+    original_write = AnnotatedPGNWriter.write
+    games = []
+
+    def write(writer, game, input_offset):
+        games.append(game)
+        if len(games) == game_number:
+            writer._handle.write(str(game)[:100])
+            writer._handle.flush()
+            raise KeyboardInterrupt
+        original_write(writer, game, input_offset)
+
+    with monkeypatch.context() as patch:
+        patch.setattr(AnnotatedPGNWriter, "write", write)
+        with pytest.raises(KeyboardInterrupt):
+            annotate(input_dir, output_dir)
+    (temp_path,) = output_dir.glob("*_annotated.pgn.tmp")
+    return temp_path.name.replace("_annotated.pgn.tmp", ".pgn")
+
+
+def count_analyzed_games(monkeypatch):
+    analyzed = []
+    original = stockfish_pgn_annotator.analyze_game_scores
+
+    def analyze_game_scores(game, *args):
+        analyzed.append(game.headers["Round"])
+        return original(game, *args)
+
+    monkeypatch.setattr(stockfish_pgn_annotator, "analyze_game_scores", analyze_game_scores)
+    return analyzed
+
+
+def test_resume_after_a_partial_write(tmp_path, input_dir, monkeypatch):
+    annotate(input_dir, tmp_path / "reference")
+    expected = read_outputs(tmp_path / "reference")
+    assert len(expected) == 2
+
+    output_dir = tmp_path / "output"
+    interrupted = interrupt_during_write(monkeypatch, input_dir, output_dir, 5)
+    # The first file is complete; the second has a checkpoint after its first game and a partly written second game
+    (finished,) = read_outputs(output_dir).items()
+    assert finished[0] != interrupted.replace(".pgn", "_annotated.pgn")
+    assert finished[1] == expected[finished[0]]
+    assert (output_dir / interrupted.replace(".pgn", "_annotated.pgn.checkpoint.json")).exists()
+
+    analyzed = count_analyzed_games(monkeypatch)
+    annotate(input_dir, output_dir, resume=True)
+    assert read_outputs(output_dir) == expected
+    assert analyzed == ["2", "3"]
+    assert sorted(path.name for path in output_dir.iterdir() if not path.name.startswith(".")) == sorted(expected)
+
+
+def test_resume_after_the_input_changed(tmp_path, input_dir, monkeypatch):
+    output_dir = tmp_path / "output"
+    interrupted = interrupt_during_write(monkeypatch, input_dir, output_dir, 5)
+
+    # Change the game of the interrupted file that was already written: its checkpoint no longer applies, so the file
+    # is annotated from scratch
+    pgn_path = input_dir / interrupted
+    text = pgn_path.read_text(encoding="utf-8")
+    pgn_path.write_text(text.replace('[Round "1"]', '[Round "1.1"]', 1), encoding="utf-8")
+    annotate(input_dir, output_dir, resume=True)
+
+    annotate(input_dir, tmp_path / "reference")
+    assert read_outputs(output_dir) == read_outputs(tmp_path / "reference")
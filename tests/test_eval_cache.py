@@ -0,0 +1,30 @@
+import chess
+
+from eval_cache import EvalCache
+
+
+def play(moves):
+    board = chess.Board()
+    for move in moves:
+        board.push_san(move)
+    return board
+
+
+def test_scores_are_shared_between_games_reaching_the_same_position(tmp_path):
+    with EvalCache(str(tmp_path / "cache.sqlite")) as cache:
+        cache.put(play(["e4", "e5", "Nf3"]), 10, 35)
+        assert cache.get(play(["Nf3", "e5", "e4"]), 10) == 35
+        assert cache.get(play(["Nf3", "e5", "e4"]), 12) is None
+
+
+def test_repeated_positions_are_not_cached(tmp_path):
+    shuffle = ["Nf3", "Nf6", "Ng1", "Ng8"]
+    with EvalCache(str(tmp_path / "cache.sqlite")) as cache:
+        # The engine may score the repetition as a draw: that score is not stored ...
+        cache.put(play(shuffle + ["Nf3"]), 10, 0)
+        assert cache.get(play(["Nf3"]), 10) is None
+        # ... and the score of the position reached without a repetition is not served for it
+        cache.put(play(["Nf3"]), 10, 20)
+        assert cache.get(play(["Nf3"]), 10) == 20
+        assert cache.get(play(shuffle + ["Nf3"]), 10) is None
+        assert cache.stats()["entries"] == 1
@@ -0,0 +1,86 @@
+import os
+
+import pytest
+
+import file_manifest
+from file_manifest import FileManifest
+
+PARAMS = {"wdl_values": (1, 0.5, 0), "weighted": True}
+
+
+@pytest.fixture
+def files(tmp_path):
+    input_path, output_path = tmp_path / "games.pgn", tmp_path / "out" / "games.json"
+    input_path.write_text("1. e4 e5 *\n")
+    output_path.parent.mkdir()
+    output_path.write_text("{}")
+    manifest = FileManifest(str(tmp_path / "out" / ".manifest"), PARAMS)
+    manifest.record(str(input_path), [str(output_path)], games=1)
+    return input_path, output_path, str(tmp_path / "out" / ".manifest")
+
+
+def reopen(manifest_path, params=PARAMS):
+    # A new manifest object, as on the next run
+    return FileManifest(manifest_path, params)
+
+
+def test_unknown_file_is_not_current(tmp_path, files):
+    other_path = tmp_path / "other.pgn"
+    other_path.write_text("1. d4 *\n")
+    assert not reopen(files[2]).is_current(str(other_path))
+
+
+def test_unchanged_file_is_current(files):
+    input_path, output_path, manifest_path = files
+    manifest = reopen(manifest_path)
+    assert manifest.is_current(str(input_path))
+    assert manifest.entry(str(input_path))["games"] == 1
+
+
+def test_changed_content_is_not_current(files):
+    input_path, output_path, manifest_path = files
+    stat = os.stat(input_path)
+    # Same size, so the hash decides; a later modification time, which coarse file system timestamps may not show
+    input_path.write_text("1. d4 d5 *\n")
+    os.utime(input_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert os.path.getsize(input_path) == stat.st_size
+    assert not reopen(manifest_path).is_current(str(input_path))
+
+
+def test_touched_file_is_current_and_not_hashed_again(files, monkeypatch):
+    input_path, output_path, manifest_path = files
+    os.utime(input_path, ns=(0, os.stat(input_path).st_mtime_ns + 10**9))
+    manifest = reopen(manifest_path)
+    assert manifest.is_current(str(input_path))
+    manifest.save()
+
+    def fail(path):
+        raise AssertionError(f"{path} hashed again")
+
+    monkeypatch.setattr(file_manifest, "file_sha256", fail)
+    assert reopen(manifest_path).is_current(str(input_path))
+
+
+def test_changed_params_are_not_current(files):
+    input_path, output_path, manifest_path = files
+    assert not reopen(manifest_path, {"wdl_values": (3, 1.25, 0), "weighted": True}).is_current(str(input_path))
+
+
+def test_changed_or_missing_output_is_not_current(files):
+    input_path, output_path, manifest_path = files
+    output_path.write_text("{ }")
+    assert not reopen(manifest_path).is_current(str(input_path))
+    output_path.unlink()
+    assert not reopen(manifest_path).is_current(str(input_path))
+
+
+def test_processed_again_is_recorded(files):
+    input_path, output_path, manifest_path = files
+    input_path.write_text("1. c4 *\n")
+    manifest = reopen(manifest_path)
+    assert not manifest.is_current(str(input_path))
+    output_path.write_text('{"1": {}}')
+    manifest.record(str(input_path), [str(output_path)], games=2)
+    manifest = reopen(manifest_path)
+    assert manifest.is_current(str(input_path))
+    assert manifest.entry(str(input_path))["games"] == 2
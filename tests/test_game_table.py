@@ -0,0 +1,111 @@
+import contextlib
+import io
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import corpus
+from game_table import GAME_COLUMNS, JsonLinesGameWriter, ParquetGameWriter, read_game_table
+from pgn_evaluation_fast_analyzer import main
+
+WDL_VALUES = [1, 0.5, 0]
+
+
+def analyze(input_dir, output_dir, output_format, batch_size=10000):
+    with contextlib.redirect_stdout(io.StringIO()):
+        main(str(input_dir), str(output_dir), WDL_VALUES, True, output_format=output_format, batch_size=batch_size)
+
+
+@pytest.fixture(scope="module")
+def outputs(tmp_path_factory):
+    # The analyzer's output for 25 annotated games in 3 files, in every format
+    tmp_path = tmp_path_factory.mktemp("game_table")
+    input_dir = tmp_path / "pgn"
+    corpus.write_corpus(str(input_dir), 25, annotated=True, games_per_file=10)
+    for output_format in ("json", "jsonl", "parquet"):
+        analyze(input_dir, tmp_path / output_format, output_format, batch_size=4)
+    analyze(input_dir, tmp_path / "jsonl_one_batch", "jsonl")
+    return tmp_path
+
+
+def json_rows(json_dir):
+    # The games of the JSON output as rows of the game table
+    rows = []
+    for file_name in sorted(os.listdir(json_dir)):
+        if file_name.endswith(".json"):
+            with open(json_dir / file_name) as f:
+                for key, game in json.load(f).items():
+                    row = {"key": int(key)}
+                    row.update(game)
+                    for name in ("WhiteElo", "BlackElo"):
+                        row[name] = int(game[name]) if str(game[name]).isdigit() else None
+                    for name in ("WhiteResult", "BlackResult"):
+                        row[name] = None if game[name] == "..." else float(game[name])
+                    rows.append(row)
+    return pd.DataFrame(rows, columns=GAME_COLUMNS)
+
+
+def assert_same_games(table, expected):
+    table = table.sort_values("key").reset_index(drop=True)
+    expected = expected.sort_values("key").reset_index(drop=True)
+    assert list(table.columns) == list(expected.columns)
+    assert len(table) == len(expected)
+    for name in table.columns:
+        values, expected_values = table[name].astype(object).tolist(), expected[name].astype(object).tolist()
+        assert [None if pd.isna(value) else value for value in values] == \
+               [None if pd.isna(value) else value for value in expected_values], name
+
+
+@pytest.mark.parametrize("output_format", ["jsonl", "parquet"])
+def test_round_trip_matches_json_output(outputs, output_format):
+    table = read_game_table(str(outputs / output_format))
+    assert len(table) == 25
+    assert_same_games(table, json_rows(outputs / "json"))
+
+
+@pytest.mark.parametrize("output_format", ["jsonl", "parquet"])
+def test_column_projection(outputs, output_format):
+    columns = ["key", "White", "white_gi", "BlackResult"]
+    table = read_game_table(str(outputs / output_format), columns=columns)
+    assert list(table.columns) == columns
+    assert_same_games(table, read_game_table(str(outputs / output_format))[columns])
+
+
+def test_batch_boundaries_do_not_change_the_output(outputs):
+    for file_name in sorted(os.listdir(outputs / "jsonl")):
+        if file_name.endswith(".jsonl"):
+            assert (outputs / "jsonl" / file_name).read_bytes() == (outputs / "jsonl_one_batch" / file_name).read_bytes()
+
+
+@pytest.mark.parametrize("writer_class, extension", [(JsonLinesGameWriter, ".jsonl"), (ParquetGameWriter, ".parquet")])
+def test_writer_flushes_partial_batches(tmp_path, outputs, writer_class, extension):
+    rows = read_game_table(str(outputs / "parquet")).head(7)
+    rows = [{name: (None if pd.isna(value) else value.item() if isinstance(value, np.generic) else value)
+             for name, value in row.items()} for row in rows.to_dict("records")]
+    path = str(tmp_path / f"games{extension}")
+    writer = writer_class(path, batch_size=3)
+    for row in rows[:4]:
+        writer.write(row)
+    assert writer.rows_written == 3
+    for row in rows[4:]:
+        writer.write(row)
+    writer.close()
+    assert writer.rows_written == 7
+    assert_same_games(read_game_table(path), pd.DataFrame(rows, columns=GAME_COLUMNS))
+
+
+def test_directory_with_both_formats_counts_each_game_once(tmp_path, outputs):
+    for output_format in ("jsonl", "parquet"):
+        for file_name in os.listdir(outputs / output_format):
+            if file_name.endswith("." + output_format):
+                (tmp_path / file_name).write_bytes((outputs / output_format / file_name).read_bytes())
+    # The Parquet tables are the newer ones
+    for file_name in os.listdir(tmp_path):
+        stat = os.stat(tmp_path / file_name)
+        os.utime(tmp_path / file_name, ns=(stat.st_atime_ns, stat.st_mtime_ns + (10**9 if file_name.endswith(".parquet") else 0)))
+    table = read_game_table(str(tmp_path))
+    assert len(table) == 25
+    assert_same_games(table, read_game_table(str(outputs / "parquet")))
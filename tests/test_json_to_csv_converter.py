@@ -0,0 +1,55 @@
+import contextlib
+import io
+import json
+
+import pytest
+
+from json_to_csv_converter import main_json_to_csv
+
+GAME = {"white_gi": 1.5, "black_gi": 2.0, "white_gpl": 0.1, "black_gpl": 0.2, "white_acpl": 0, "black_acpl": 3.5,
+        "white_move_number": 30, "black_move_number": 30, "White": "Carlsen, Magnus", "Black": "Hikaru Nakamura",
+        "Event": "E", "Site": "?", "Round": "1", "WhiteElo": "2830", "BlackElo": "2790", "Date": "2024.01.01"}
+
+DECISIVE = dict(GAME, WhiteResult=1, BlackResult=0)
+DRAW = dict(GAME, WhiteResult=0.5, BlackResult=0.5)
+UNFINISHED = dict(GAME, WhiteElo="?", WhiteResult="...", BlackResult="...")
+
+FILES = {
+    "decisive": [[DECISIVE, DECISIVE]],
+    "draw": [[DECISIVE, DRAW]],
+    "unfinished": [[DECISIVE, UNFINISHED]],
+    "unfinished in a later file": [[DECISIVE, DRAW], [UNFINISHED]],
+    "missing column": [[DECISIVE], [{key: value for key, value in DRAW.items() if key != "white_move_number"}]],
+}
+
+
+def write_json_files(directory, files):
+    directory.mkdir()
+    for number, games in enumerate(files):
+        with open(directory / f"games_{number}.json", "w") as f:
+            json.dump({str(key): game for key, game in enumerate(games)}, f)
+
+
+def convert(json_dir, csv_dir, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        main_json_to_csv(str(json_dir), str(csv_dir), **kwargs)
+    return (csv_dir / "aggregated_game_data.csv").read_text()
+
+
+@pytest.mark.parametrize("name", FILES)
+@pytest.mark.parametrize("workers", [1, 2])
+def test_bulk_conversion_matches_the_original(tmp_path, name, workers):
+    write_json_files(tmp_path / "json", FILES[name])
+    expected = convert(tmp_path / "json", tmp_path / "original", bulk=False)
+    assert convert(tmp_path / "json", tmp_path / "bulk", workers=workers, chunk_size=1) == expected
+
+
+def test_unfinished_games_keep_the_results_as_written(tmp_path):
+    # With an unfinished game the result columns are not numeric, so each game is written as in its JSON
+    write_json_files(tmp_path / "json", FILES["unfinished in a later file"])
+    rows = [line.split(",") for line in convert(tmp_path / "json", tmp_path / "csv").splitlines()]
+    header = rows[0]
+    results = [(row[header.index("WhiteResult")], row[header.index("BlackResult")]) for row in rows[1:]]
+    assert sorted(results) == [("...", "..."), ("0.5", "0.5"), ("1", "0")]
+    assert sorted(row[header.index("WhiteElo")] for row in rows[1:]) == ["2830", "2830", "?"]
+    assert [row[header.index("White")] for row in rows[1:]] == ["Carlsen"] * 3
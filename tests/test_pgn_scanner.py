@@ -0,0 +1,110 @@
+import contextlib
+import io
+
+import chess.pgn
+import pytest
+
+import corpus
+from pgn_evaluation_fast_analyzer import extract_pawn_evals_from_pgn, main
+from pgn_scanner import pawns_list_from_evals, scan_games, validate_scanner
+
+GAMES = {
+    "plain": '[Event "Open"]\n[White "Carlsen, Magnus"]\n[Black "Nakamura"]\n[WhiteElo "2830"]\n[Result "1-0"]\n\n'
+             '1. e4 {[%eval 0.3]} 1... e5 {[%eval 0.25]} 2. Nf3 {[%eval 0.31]} Nc6 {[%eval -0.2]} 1-0\n',
+    "mate in zero": '[Event "Mates"]\n[Result "1-0"]\n\n'
+                    '1. e4 {[%eval 0.2]} e5 {[%eval #4]} 2. Qh5 {[%eval #-3]} Nc6 {[%eval #0]} 1-0\n',
+    "illegal move": '[Event "Broken"]\n[Result "*"]\n\n'
+                    '1. e4 {[%eval 0.2]} e5 {[%eval 0.3]} 2. Ke3 {[%eval 5]} Nc6 {[%eval 6]} *\n',
+    "variations and comments": '[Event "T"]\n[White "A \\"q\\""]\n\n'
+                               '1. e4 {start [%eval 0.3]} {again [%eval 9]} 1... e5 ( 1... c5 {[%eval 5.0]} 2. Nf3 '
+                               '( 2. c3 ) ) 2. Nf3 $1 { multi\nline [%eval\n#-2] } 2... Nc6 ; [%eval 3]\n'
+                               '3. Bb5 {[%eval #0]} 1-0\n',
+    "no headers": '% escaped line\n1. d4 {[%eval 0.1]} d5 {[%eval -0.25]} *\n',
+    "from a position": '[FEN "rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq - 0 1"]\n\n'
+                       '{root [%eval 7]} 1... e5 {[%eval #0]} 2. Nf3 {[%eval 12.345]} {[%eval -3]} *\n',
+    "illegal move in a variation": '[Event "Broken"]\n\n1. e4 {[%eval 0.2]} ( 1. Ke3 {[%eval 9]} ) {[%eval 0.4]} '
+                                   '1... e5 {[%eval 0.3]} *\n',
+    "empty variation": '1. e4 {[%eval 0.2]} e5 ( ) {[%eval 0.3]} 2. Nf3 {[%eval 0.4]} *\n',
+    "invalid FEN": '[FEN "not a position"]\n\n1. e4 {[%eval 0.2]} e5 {[%eval 0.3]} *\n',
+    "no evals": '[Event "Blitz"]\n[Result "1/2-1/2"]\n\n1. e4 e5 2. Nf3 Nc6 1/2-1/2\n',
+}
+
+
+def read_games(text):
+    stream = io.StringIO(text)
+    games = []
+    while (game := chess.pgn.read_game(stream)) is not None:
+        games.append(game)
+    return games
+
+
+def scan_text(text):
+    return list(scan_games(io.BytesIO(text.encode("utf-8"))))
+
+
+@pytest.mark.parametrize("name", GAMES)
+def test_scanner_matches_read_game(name):
+    text = GAMES[name]
+    (game,) = read_games(text)
+    (scanned,) = scan_text(text)
+    assert scanned.headers == dict(game.headers)
+    assert pawns_list_from_evals(scanned.evals) == extract_pawn_evals_from_pgn(game)
+
+
+def test_illegal_move_stops_the_mainline():
+    # python-chess stops the mainline at an illegal move, so the evaluations after it are not part of the game
+    (game,) = read_games(GAMES["illegal move"])
+    assert game.errors
+    (scanned,) = scan_text(GAMES["illegal move"])
+    assert pawns_list_from_evals(scanned.evals) == extract_pawn_evals_from_pgn(game) == [0.2, 0.2, 0.3]
+
+
+def test_mate_in_zero():
+    (scanned,) = scan_text(GAMES["mate in zero"])
+    (game,) = read_games(GAMES["mate in zero"])
+    assert game.end().eval().is_mate() and game.end().eval().white().mate() == 0
+    assert pawns_list_from_evals(scanned.evals) == extract_pawn_evals_from_pgn(game)
+
+
+def test_offsets_delimit_the_games():
+    text = "\n".join(GAMES.values())
+    data = text.encode("utf-8")
+    scanned_games = scan_text(text)
+    games = read_games(text)
+    assert len(scanned_games) == len(games) == len(GAMES)
+    for scanned, game in zip(scanned_games, games):
+        (alone,) = read_games(data[scanned.offset:scanned.offset + scanned.length].decode("utf-8"))
+        assert alone.headers == game.headers
+        assert extract_pawn_evals_from_pgn(alone) == extract_pawn_evals_from_pgn(game)
+
+
+def test_validate_scanner(tmp_path):
+    path = tmp_path / "games.pgn"
+    path.write_text("﻿" + "\n".join(GAMES.values()), encoding="utf-8")
+    assert validate_scanner(str(path)) == []
+
+
+def test_unchecked_scanner_on_legal_games():
+    legal = "\n".join(text for name, text in GAMES.items() if name in ("plain", "mate in zero", "no headers", "no evals"))
+    data = io.BytesIO(legal.encode("utf-8"))
+    assert list(scan_games(data, check_moves=False)) == list(scan_games(data))
+
+
+def test_unchecked_scanner_is_reported_by_validation(tmp_path):
+    # fast_scan='unchecked' is only right without illegal moves: validate_scan=True shows where it differs
+    path = tmp_path / "games.pgn"
+    path.write_text(GAMES["plain"] + "\n" + GAMES["illegal move"], encoding="utf-8")
+    assert validate_scanner(str(path), check_moves=False) == [(2, "evals differ (2 versus 4 values)")]
+
+
+@pytest.mark.parametrize("fast_scan", [True, "unchecked"])
+def test_analyzer_output_with_the_scanner(tmp_path, fast_scan):
+    corpus.write_corpus(str(tmp_path / "pgn"), 20, annotated=True, games_per_file=10)
+    outputs = {}
+    for reader in (False, fast_scan):
+        output_dir = tmp_path / f"json_{reader}"
+        with contextlib.redirect_stdout(io.StringIO()):
+            main(str(tmp_path / "pgn"), str(output_dir), [1, 0.5, 0], True, fast_scan=reader)
+        outputs[reader] = {path.name: path.read_bytes() for path in output_dir.glob("*.json")}
+    assert len(outputs[False]) == 2
+    assert outputs[fast_scan] == outputs[False]
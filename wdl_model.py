@@ -0,0 +1,118 @@
+"""
+This script is a vectorized version of the WDL model behind python-chess's Cp(cp).wdl(), i.e. the default "sf" model
+(Stockfish 16.1) at ply 30. It converts whole arrays of centipawn evaluations to win/draw/loss counts per mille at once
+and gives exactly the same integers as calling Cp(cp).wdl() on each value.
+It also provides ExpectationTable, the WDL counts and expected values of every centipawn value in
+[-10000, 10000] precomputed once, which worker processes can share read-only through shared memory.
+"""
+
+from multiprocessing import shared_memory
+
+import numpy as np
+from chess.engine import Cp
+
+# https://github.com/official-stockfish/Stockfish/blob/sf_16.1/src/uci.cpp, as in chess.engine._sf16_1_wins
+NORMALIZE_TO_PAWN_VALUE = 356
+_m = min(120, max(8, 30 / 2 + 1)) / 32
+_a = (((-1.06249702 * _m + 7.42016937) * _m + 0.89425629) * _m) + 348.60356174
+_b = (((-5.33122190 * _m + 39.57831533) * _m + -90.84473771) * _m) + 123.40620748
+
+# Beyond this range the model is clipped, so checking it covers every possible input
+CHECK_RANGE = 4000 * 100 // NORMALIZE_TO_PAWN_VALUE + 1
+_checked = False
+
+
+def _wins(cp):
+    x = np.clip(cp * NORMALIZE_TO_PAWN_VALUE / 100, -4000, 4000)
+    # int(0.5 + y) in the scalar model; y is positive, so this is the floor
+    return np.floor(0.5 + 1000 / (1 + np.exp((_a - x) / _b))).astype(np.int64)
+
+
+def check_model():
+    # Make sure the installed python-chess uses the model implemented here
+    global _checked
+    if _checked:
+        return
+    cp = np.arange(-CHECK_RANGE, CHECK_RANGE + 1)
+    wins, draws, losses = _wdl(cp)
+    for i, value in enumerate(cp.tolist()):
+        wdl = Cp(value).wdl()
+        if (wdl.wins, wdl.draws, wdl.losses) != (wins[i], draws[i], losses[i]):
+            raise RuntimeError(f"python-chess WDL model differs from wdl_model.py at {value} cp: {wdl}")
+    _checked = True
+
+
+def _wdl(cp):
+    wins = _wins(cp)
+    losses = _wins(-cp)
+    return wins, 1000 - wins - losses, losses
+
+
+def wdl_arrays(cp):
+    # Win, draw and loss counts per mille (int64 arrays) for an array of integer centipawn evaluations
+    check_model()
+    return _wdl(np.asarray(cp, dtype=np.int64))
+
+
+# Evaluations are clamped by mate_score=10000; the model is constant beyond CHECK_RANGE, so clipping other values
+# to this range does not change their WDL
+TABLE_MIN_CP, TABLE_MAX_CP = -10000, 10000
+TABLE_SIZE = TABLE_MAX_CP - TABLE_MIN_CP + 1
+_tables = {}
+_shared_memory = {}
+
+
+class ExpectationTable:
+    # wins, draws, losses: Cp(cp).wdl() counts per mille; expected: the expected value the analyzer derives from them,
+    # (losses / 1000) * win_value + (draws / 1000) * draw_value, all indexed by cp - TABLE_MIN_CP
+    def __init__(self, wdl_values, buffer=None):
+        self.wdl_values = tuple(wdl_values)
+        if buffer is None:
+            buffer = bytearray(self.nbytes())
+            fill = True
+        else:
+            fill = False
+        self.wins, self.draws, self.losses = np.ndarray((3, TABLE_SIZE), dtype=np.int64, buffer=buffer)
+        self.expected = np.ndarray(TABLE_SIZE, dtype=np.float64, buffer=buffer, offset=3 * TABLE_SIZE * 8)
+        if fill:
+            self.wins[:], self.draws[:], self.losses[:] = wdl_arrays(np.arange(TABLE_MIN_CP, TABLE_MAX_CP + 1))
+            self.expected[:] = (self.losses / 1000) * self.wdl_values[0] + (self.draws / 1000) * self.wdl_values[1]
+        for array in (self.wins, self.draws, self.losses, self.expected):
+            array.flags.writeable = False
+
+    @staticmethod
+    def nbytes():
+        return 4 * TABLE_SIZE * 8
+
+    def index(self, cp):
+        # Table indices of an array of integer centipawn evaluations
+        return (np.clip(cp, TABLE_MIN_CP, TABLE_MAX_CP) - TABLE_MIN_CP).astype(np.intp)
+
+    def wdl(self, cp):
+        # Same as Cp(cp).wdl() for one value, as a (wins, draws, losses) tuple of ints
+        i = min(max(int(cp), TABLE_MIN_CP), TABLE_MAX_CP) - TABLE_MIN_CP
+        return int(self.wins[i]), int(self.draws[i]), int(self.losses[i])
+
+
+def expectation_table(wdl_values=(1, 0.5, 0)):
+    # The table for these wdl_values, built (or attached from shared memory) once per process
+    key = tuple(wdl_values)
+    if key not in _tables:
+        _tables[key] = ExpectationTable(key)
+    return _tables[key]
+
+
+def share_expectation_table(wdl_values):
+    # Copy the table into a new shared memory block for worker processes (see attach_expectation_table);
+    # the caller closes and unlinks the returned block when the workers are done
+    table = expectation_table(wdl_values)
+    block = shared_memory.SharedMemory(create=True, size=ExpectationTable.nbytes())
+    block.buf[:ExpectationTable.nbytes()] = np.concatenate([table.wins, table.draws, table.losses]).tobytes() + table.expected.tobytes()
+    return block
+
+
+def attach_expectation_table(name, wdl_values):
+    # Process pool initializer: use the shared table instead of building one in this process
+    block = shared_memory.SharedMemory(name=name)
+    _shared_memory[name] = block
+    _tables[tuple(wdl_values)] = ExpectationTable(wdl_values, block.buf)